@@ -0,0 +1,480 @@
+import asyncio
+import logging
+from struct import unpack
+
+import pygotu
+import segment
+
+log = logging.getLogger(__name__)
+
+# Response timeout, in s, like connections.SLOW_TIMEOUT
+READ_TIMEOUT = 2.0
+
+
+class AsyncTransport:
+    """
+    Asynchronous counterpart of the connections: write, read and flush are coroutines
+    """
+    __slots__ = []
+
+    async def write(self, data):
+        raise NotImplementedError
+
+    async def read(self, size: int=1) -> bytes:
+        raise NotImplementedError
+
+    async def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ExecutorTransport(AsyncTransport):
+    """
+    Blocking connection, like connections.USBSerial, whose calls run in an executor:
+    the default one of the loop is shared by the devices, a thread is only used for
+    the duration of a transfer. The calls of a transport run one at a time: a call
+    whose coroutine is cancelled, by a timeout, keeps running in its thread, and the
+    next one waits for it to end before using the connection.
+    """
+    __slots__ = ['connection', 'executor', 'lock', 'pending']
+
+    def __init__(self, connection, executor=None):
+        self.connection = connection
+        self.executor = executor
+        self.lock = asyncio.Lock()
+        # Future of the last call run in the executor
+        self.pending = None
+
+    async def _run(self, fn, *args):
+        async with self.lock:
+            pending = self.pending
+            if pending is not None and not pending.done():
+                log.debug("Waiting for the cancelled transfer to end")
+                await asyncio.wait([pending])
+            if pending is not None and not pending.cancelled():
+                # Its result was only awaited when it was not cancelled
+                pending.exception()
+            self.pending = asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+            return await asyncio.shield(self.pending)
+
+    async def write(self, data):
+        return await self._run(self.connection.write, data)
+
+    async def read(self, size: int=1) -> bytes:
+        return bytes(await self._run(self.connection.read, size))
+
+    async def flush(self):
+        await self._run(self.connection.flush)
+
+    def close(self):
+        self.connection.close()
+
+
+class SerialTransport(AsyncTransport):
+    """
+    pyserial port read from the event loop, when its file descriptor is readable
+    """
+    __slots__ = ['port', 'loop', 'receive_buffer', 'waiter']
+
+    def __init__(self, port):
+        self.port = port
+        self.port.timeout = 0
+        self.loop = asyncio.get_event_loop()
+        self.receive_buffer = bytearray()
+        self.waiter = None
+        self.loop.add_reader(port.fileno(), self._readable)
+
+    def _readable(self):
+        self.receive_buffer.extend(self.port.read(self.port.in_waiting or 1))
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def write(self, data):
+        return self.port.write(data)
+
+    async def read(self, size: int=1) -> bytes:
+        while len(self.receive_buffer) < size:
+            self.waiter = self.loop.create_future()
+            await self.waiter
+        data = bytes(self.receive_buffer[:size])
+        del self.receive_buffer[:size]
+        return data
+
+    async def flush(self):
+        self.port.reset_input_buffer()
+        self.receive_buffer.clear()
+
+    def close(self):
+        self.loop.remove_reader(self.port.fileno())
+        self.port.close()
+
+
+class SimulatorTransport(AsyncTransport):
+    """
+    simulator.SimulatedDevice whose latency and flush delay are awaited instead of slept
+    """
+    __slots__ = ['device', 'latency', 'flush_delay']
+
+    def __init__(self, device):
+        self.device = device
+        self.latency = device.latency
+        self.flush_delay = device.flush_delay
+        device.latency = device.flush_delay = 0.0
+
+    async def write(self, data):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.device.write(data)
+
+    async def read(self, size: int=1) -> bytes:
+        return self.device.read(size)
+
+    async def flush(self):
+        if self.flush_delay:
+            await asyncio.sleep(self.flush_delay)
+        self.device.flush()
+
+    def close(self):
+        self.device.close()
+
+
+def open_transport(connection) -> AsyncTransport:
+    """
+    Asynchronous transport over a connection returned by connections.get_connection()
+    """
+    import simulator
+
+    if isinstance(connection, AsyncTransport):
+        return connection
+    if isinstance(connection, simulator.SimulatedDevice):
+        return SimulatorTransport(connection)
+    if hasattr(connection, "in_waiting") and hasattr(connection, "fileno"):
+        try:
+            return SerialTransport(connection)
+        except (NotImplementedError, OSError):
+            # No file descriptor to watch on this platform
+            pass
+    return ExecutorTransport(connection)
+
+
+class AsyncGT200Dev:
+    """
+    Same commands as pygotu.GT200Dev, as coroutines: many devices can be driven by one
+    event loop. Each response read times out after timeout seconds; a command cancelled
+    while running leaves the connection out of sync, it is flushed before the next one.
+    all_pages(), all_records() and all_tracks() return async iterators. Like the rest of
+    the package (see setup.py), this module needs Python 3.7.
+    """
+    __slots__ = ['transport', 'timeout', 'model_code', 'model_info', 'serial', 'in_sync', 'resyncs',
+                 'retries', 'progress']
+
+    def __init__(self, transport: AsyncTransport, timeout: float=READ_TIMEOUT):
+        self.transport = transport
+        self.timeout = timeout
+        self.model_code = 0x13
+        self.model_info = pygotu.MODELS[0x13]
+        self.serial = None
+        # The connection is flushed before the first command
+        self.in_sync = False
+        self.resyncs = 0
+        self.retries = 0
+        self.progress = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.transport.close()
+
+    async def resync(self):
+        log.debug("Resynchronizing")
+        await self.transport.flush()
+        self.in_sync = True
+        self.resyncs += 1
+
+    async def write_cmd(self, cmd1, cmd2):
+        if not self.in_sync:
+            await self.resync()
+        cmd = pygotu.encode_command(cmd1, cmd2)
+        log.debug("Send1&2: %s", pygotu.HexDump(cmd))
+        await self.transport.write(cmd)
+
+    async def read(self, sz) -> bytes:
+        try:
+            result = await asyncio.wait_for(self.transport.read(sz), self.timeout)
+        except asyncio.TimeoutError as e:
+            if isinstance(e, TimeoutError):
+                # Same exception since Python 3.11
+                raise
+            raise TimeoutError("No response after {} s".format(self.timeout))
+        log.debug("Read: %s", pygotu.HexDump(result))
+        return result
+
+    async def read_resp(self, fmt=None):
+        recv = await self.read(3)
+        if len(recv) < 3 or recv[0] != 0x93:
+            self.in_sync = False
+            raise pygotu.FramingError("Unable to identify device")
+        _, sz = unpack(">ch", recv)
+        if sz < 0:
+            log.debug("Read Error: %s", sz)
+            return None
+
+        resp = await self.read(sz)
+        if len(resp) < sz:
+            self.in_sync = False
+            raise pygotu.FramingError("Truncated response: {} bytes out of {}".format(len(resp), sz))
+        if fmt:
+            return unpack(">" + fmt, resp)
+        return resp
+
+    async def transaction(self, cmd1, cmd2, fmt=None):
+        for attempt in range(2):
+            try:
+                await self.write_cmd(cmd1, cmd2)
+                return await self.read_resp(fmt)
+            except pygotu.FramingError:
+                if attempt:
+                    raise
+                log.warning("Response framing lost, sending the command again")
+            except BaseException:
+                # Timed out, cancelled or transport error: the connection state is unknown
+                self.in_sync = False
+                raise
+
+    async def nmea_switch(self, mode: int) -> None:
+        await self.write_cmd(*pygotu.nmea_switch_command(mode))
+        await self.read(1)
+        self.in_sync = False
+
+    async def retry(self, description: str, command, *args):
+        """
+        Same retries as GT200Dev.retry, the backoff being awaited
+        """
+        delay = pygotu.RETRY_BACKOFF
+        for attempt in range(pygotu.MAX_RETRIES + 1):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, pygotu.MAX_RETRY_BACKOFF)
+            try:
+                result = await command(*args)
+            except (TimeoutError, pygotu.FramingError) as e:
+                if attempt == pygotu.MAX_RETRIES:
+                    raise
+                log.warning("%s failed, retrying: %s", description, e)
+                await self.resync()
+                continue
+            if result is not None:
+                return result
+            log.warning("Device error on %s", description)
+        raise Exception("Unable to run {} after {} retries".format(description, pygotu.MAX_RETRIES))
+
+    async def identify(self) -> int:
+        serial, v_maj, v_min, model, v_lib = await self.retry("identify", self.transaction,
+                                                              *pygotu.CMD_IDENTIFY, "IbbHH")
+        log.debug("Serial: %s Ver: %s.%s Model: %s USBlib: %s", serial, v_maj, v_min, model, v_lib)
+        self.serial = serial
+        return serial
+
+    async def model(self):
+        checkcode, model_code = await self.retry("model query", self.transaction, *pygotu.CMD_MODEL, "Hb")
+        current_model = pygotu.model_from_response(checkcode, model_code)
+        if current_model:
+            self.model_code = model_code
+            self.model_info = current_model
+
+    async def count(self) -> int:
+        n1, n2 = await self.retry("count", self.transaction, *pygotu.CMD_COUNT, "HB")
+        return n1*256 + n2
+
+    async def flash_read(self, pos: int=0, size: int=0x1000) -> bytes:
+        return await self.transaction(*pygotu.flash_read_command(pos, size))
+
+    async def read_page(self, page: int) -> bytes:
+        return await self.retry("reading page {}".format(page), self.flash_read, page * pygotu.PAGE_SIZE)
+
+    async def is_block_empty(self, block: int) -> bool:
+        probe = await self.retry("probing block {}".format(block), self.flash_read, block * pygotu.PAGE_SIZE, 0x10)
+        return probe == (b"\xff" * 0x10)
+
+    async def plan_purge(self, max_block: int) -> pygotu.PurgePlan:
+        plan = pygotu.PurgePlan(max_block)
+        search = plan.search_blocks(await self.count())
+        try:
+            block = next(search)
+            while True:
+                block = search.send(await self.is_block_empty(block))
+        except StopIteration:
+            pass
+        return plan
+
+    async def wait_ready(self, plan: pygotu.PurgePlan=None):
+        while True:
+            # SPI status read, polled while the device is busy
+            status = await self.retry("status poll", self.transaction, *pygotu.unk_write2_command(0x01))
+            if plan:
+                plan.polls += 1
+            if status == b"\x00":
+                return
+
+    async def erase_block(self, block: int, plan: pygotu.PurgePlan=None):
+        await self.transaction(*pygotu.unk_write1_command(0))
+        await self.transaction(*pygotu.flash_write_purge_command(block * pygotu.PAGE_SIZE))
+        if plan:
+            plan.erases += 1
+
+    async def _end_purge(self):
+        if self.model_info[2]:
+            await self.transaction(*pygotu.unk_purge1_command(0x1d))
+        await self.transaction(*pygotu.unk_purge1_command(0x1e))
+        await self.transaction(*pygotu.unk_purge1_command(0x1f))
+
+    async def purge_all_120(self) -> pygotu.PurgePlan:
+        plan = await self.plan_purge(self.model_info[1])
+        for i in plan.blocks():
+            if plan.erases:
+                await self.wait_ready(plan)
+            await self.erase_block(i, plan)
+        if plan.erases:
+            await self._end_purge()
+            await self.wait_ready(plan)
+        await self._end_purge()
+        log.info("Purged: %s", plan)
+        return plan
+
+    async def purge_all_gt900(self) -> pygotu.PurgePlan:
+        plan = await self.plan_purge(0x700 - 1)
+        for i in plan.blocks():
+            await self.erase_block(i, plan)
+            await self.wait_ready(plan)
+        log.info("Purged: %s", plan)
+        return plan
+
+    def all_pages(self) -> 'AsyncPages':
+        return AsyncPages(self)
+
+    def all_records(self, valid_only: bool=True) -> 'AsyncRecords':
+        return AsyncRecords(self.all_pages(), valid_only)
+
+    def all_tracks(self, **split_rules) -> 'AsyncTracks':
+        return AsyncTracks(self.all_records(False), **split_rules)
+
+
+async def open_device(connection, timeout: float=READ_TIMEOUT) -> AsyncGT200Dev:
+    """
+    Same as pygotu.open_device, over an asynchronous transport of the connection
+    """
+    dev = AsyncGT200Dev(open_transport(connection), timeout)
+    await dev.nmea_switch(pygotu.MODE_CONFIGURE)
+    await dev.identify()
+    await dev.model()
+    return dev
+
+
+class AsyncPages:
+    """
+    async for over (first record index, page buffer), like GT200Dev.all_pages()
+    """
+    __slots__ = ['dev', 'num_rec_all', 'num_rec_read', 'rpos']
+
+    def __init__(self, dev: AsyncGT200Dev):
+        self.dev = dev
+        self.num_rec_all = None
+        self.num_rec_read = 0
+        self.rpos = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.num_rec_all is None:
+            self.num_rec_all = await self.dev.count()
+        if self.num_rec_read >= self.num_rec_all:
+            raise StopAsyncIteration
+
+        self.rpos += 1
+        buf = await self.dev.read_page(self.rpos)
+        first_idx = self.num_rec_read
+        n = min(len(buf) // pygotu.RECORD_SIZE, self.num_rec_all - first_idx)
+        self.num_rec_read += n
+        if self.dev.progress:
+            self.dev.progress(self.num_rec_read, self.num_rec_all)
+        return first_idx, buf[:n * pygotu.RECORD_SIZE]
+
+
+class AsyncRecords:
+    """
+    async for over the records, like GT200Dev.all_records()
+    """
+    __slots__ = ['pages', 'valid_only', 'records']
+
+    def __init__(self, pages: AsyncPages, valid_only: bool=True):
+        self.pages = pages
+        self.valid_only = valid_only
+        self.records = iter(())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            rec = next(self.records, None)
+            if rec is not None:
+                return rec
+            first_idx, buf = await self.pages.__anext__()
+            self.records = iter(pygotu.page_records(first_idx, buf, valid_only=self.valid_only))
+
+
+class AsyncTracks:
+    """
+    async for over the tracks, like GT200Dev.all_tracks(): each one is a pygotu.GTTrack,
+    returned once the record following it is read
+    """
+    __slots__ = ['records', 'segmenter', 'points', 'idx', 'done']
+
+    def __init__(self, records: AsyncRecords, **split_rules):
+        self.records = records
+        self.segmenter = segment.TrackSegmenter((), **split_rules)
+        self.points = []
+        self.idx = 0
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    def _track(self) -> pygotu.GTTrack:
+        track = pygotu.GTTrack(self.idx, self.points)
+        self.idx += 1
+        self.points = []
+        return track
+
+    async def __anext__(self):
+        while not self.done:
+            try:
+                rec = await self.records.__anext__()
+            except StopAsyncIteration:
+                self.done = True
+                break
+
+            rec = self.segmenter.classify(rec)
+            if rec is None:
+                continue
+            if rec is segment.SPLIT:
+                if self.points:
+                    return self._track()
+            elif self.points and self.segmenter.splits(self.points[-1], rec):
+                track = self._track()
+                self.points.append(rec)
+                return track
+            else:
+                self.points.append(rec)
+
+        if self.points:
+            return self._track()
+        raise StopAsyncIteration
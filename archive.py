@@ -0,0 +1,334 @@
+import logging
+import os.path
+import sqlite3
+from itertools import islice
+from operator import attrgetter
+
+import numpy as np
+
+import pygotu
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 1
+
+# Points inserted per transaction
+BATCH_POINTS = 20000
+# Consecutive points of a track sharing an R-tree entry: they are close to each other,
+# and the R-tree is much faster to build than with an entry per point
+POINTS_PER_BOX = 32
+# Wait for the transactions of the other devices archived in parallel, in s
+LOCK_TIMEOUT = 60.0
+
+# Point columns, as stored and as returned by the queries
+POINT_COLUMNS = ('epoch_ms', 'lat', 'lon', 'elevation', 'speed', 'course', 'ehpe', 'sat')
+_get_point = attrgetter(*POINT_COLUMNS)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    serial INTEGER NOT NULL,
+    start_ms INTEGER NOT NULL,
+    end_ms INTEGER NOT NULL,
+    num_points INTEGER NOT NULL,
+    UNIQUE (serial, start_ms)
+);
+CREATE INDEX IF NOT EXISTS tracks_time ON tracks (start_ms, end_ms);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_rtree USING rtree (id, min_lat, max_lat, min_lon, max_lon);
+
+CREATE TABLE IF NOT EXISTS points (
+    id INTEGER PRIMARY KEY,
+    track_id INTEGER NOT NULL,
+    serial INTEGER NOT NULL,
+    epoch_ms INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    elevation REAL,
+    speed REAL,
+    course REAL,
+    ehpe REAL,
+    sat INTEGER
+);
+-- Deduplicates the records of an unpurged device, and serves the time queries of a device
+CREATE UNIQUE INDEX IF NOT EXISTS points_device_time ON points (serial, epoch_ms);
+CREATE INDEX IF NOT EXISTS points_time ON points (epoch_ms);
+CREATE INDEX IF NOT EXISTS points_track ON points (track_id, epoch_ms);
+-- Bounding boxes of runs of up to POINTS_PER_BOX consecutive points of a track: points [id, last_id]
+CREATE VIRTUAL TABLE IF NOT EXISTS points_rtree USING rtree (id, min_lat, max_lat, min_lon, max_lon, +last_id INTEGER);
+"""
+
+
+class ArchivedTrack:
+    __slots__ = ['id', 'serial', 'start_ms', 'end_ms', 'num_points', 'min_lat', 'min_lon', 'max_lat', 'max_lon']
+
+    def __init__(self, id: int, serial: int, start_ms: int, end_ms: int, num_points: int,
+                 min_lat: float, max_lat: float, min_lon: float, max_lon: float):
+        self.id = id
+        self.serial = serial
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.num_points = num_points
+        self.min_lat = min_lat
+        self.min_lon = min_lon
+        self.max_lat = max_lat
+        self.max_lon = max_lon
+
+    @property
+    def bbox(self) -> tuple:
+        return self.min_lat, self.min_lon, self.max_lat, self.max_lon
+
+    def __str__(self):
+        return "{}: {:08x} {} - {} points:[{}]".format(
+            self.id, self.serial, pygotu.format_isotime(self.start_ms), pygotu.format_isotime(self.end_ms),
+            self.num_points)
+
+
+class PointSet:
+    """
+    Columns of archived points, as NumPy arrays. It has the columns of a gtbatch.RecordBatch
+    used by the export writers, so a PointSet can be written with TrackWriter.write_batch().
+    """
+    __slots__ = POINT_COLUMNS + ('serial', 'track_id')
+
+    def __init__(self, rows: list=None):
+        columns = list(zip(*rows)) if rows else [()] * len(self.__slots__)
+        for name, dtype, values in zip(self.__slots__, _POINT_DTYPES, columns):
+            setattr(self, name, np.array(values, dtype=dtype))
+
+    @classmethod
+    def from_columns(cls, **columns) -> 'PointSet':
+        """
+        Points of NumPy columns, named after __slots__
+        """
+        points = cls.__new__(cls)
+        for name, dtype in zip(cls.__slots__, _POINT_DTYPES):
+            setattr(points, name, np.asarray(columns[name], dtype=dtype))
+        return points
+
+    @classmethod
+    def from_records(cls, records, serial: int=0, track_id: int=0) -> 'PointSet':
+        """
+        Points of the valid waypoints of an iterable of records, like a GTTrack
+        """
+        rows = [_get_point(rec) for rec in records if rec.valid and rec.is_waypoint]
+        columns = dict(zip(POINT_COLUMNS, zip(*rows))) if rows else dict.fromkeys(POINT_COLUMNS, ())
+        return cls.from_columns(serial=np.full(len(rows), serial), track_id=np.full(len(rows), track_id), **columns)
+
+    def __len__(self):
+        return len(self.epoch_ms)
+
+    def select(self, mask) -> 'PointSet':
+        points = PointSet.__new__(PointSet)
+        for name in PointSet.__slots__:
+            setattr(points, name, getattr(self, name)[mask])
+        return points
+
+    def waypoints(self) -> 'PointSet':
+        # Only valid waypoints are archived
+        return self
+
+    def tracks(self):
+        """
+        Yields the points of each track, the points being ordered by track
+        """
+        bounds = np.flatnonzero(np.diff(self.track_id)) + 1
+        for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(self)]))):
+            yield self.select(slice(start, end))
+
+
+_POINT_DTYPES = (np.int64, np.float64, np.float64, np.float64, np.float64, np.float64, np.float64, np.int64,
+                 np.int64, np.int64)
+
+
+def _where(clauses: list) -> str:
+    return " WHERE " + " AND ".join(clauses) if clauses else ""
+
+
+class TrackArchive:
+    """
+    Local SQLite store of the tracks of several devices, fed from GT200Dev.stream_tracks()
+    or all_tracks(). Points are indexed by device and time (B-tree) and by position (R-tree
+    of the bounding boxes of runs of points);
+    a point already archived for its device, identified by its time, is not added again,
+    so the records of an unpurged device can be archived at each sync.
+    """
+    __slots__ = ['path', 'db']
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version, = self.db.execute("PRAGMA user_version").fetchone()
+        if version not in (0, ARCHIVE_VERSION):
+            raise Exception("Unsupported archive version {}: {}".format(version, path))
+        with self.db:
+            self.db.executescript(_SCHEMA)
+            self.db.execute("PRAGMA user_version={}".format(ARCHIVE_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _track_id(self, serial: int, start_ms: int) -> tuple:
+        """
+        Id of the track of a device starting at start_ms, and whether it was created
+        """
+        row = self.db.execute("SELECT id FROM tracks WHERE serial = ? AND start_ms = ?", (serial, start_ms)).fetchone()
+        if row is not None:
+            return row[0], False
+        return self.db.execute("INSERT INTO tracks (serial, start_ms, end_ms, num_points) VALUES (?, ?, ?, 0)",
+                               (serial, start_ms, start_ms)).lastrowid, True
+
+    def _insert_points(self, track_id: int, serial: int, points: list) -> int:
+        """
+        Inserts the points of a track, returning the number of new ones. Run in a write
+        transaction, so the ids after the last one read are the ones inserted here.
+        """
+        last_id, = self.db.execute("SELECT coalesce(max(id), 0) FROM points").fetchone()
+        changes = self.db.total_changes
+        self.db.executemany(
+            "INSERT OR IGNORE INTO points (track_id, serial, epoch_ms, lat, lon, elevation, speed, course, ehpe, sat) "
+            "VALUES ({:d}, {:d}, ?, ?, ?, ?, ?, ?, ?, ?)".format(track_id, serial), points)
+        added = self.db.total_changes - changes
+        if not added:
+            return 0
+        # The new points have consecutive ids
+        self.db.execute(
+            "INSERT INTO points_rtree SELECT min(id), min(lat), max(lat), min(lon), max(lon), max(id) FROM points "
+            "WHERE id > ? GROUP BY (id - ?) / {:d}".format(POINTS_PER_BOX), (last_id, last_id + 1))
+
+        # Extends the track with the new points only
+        end_ms, min_lat, max_lat, min_lon, max_lon = self.db.execute(
+            "SELECT max(epoch_ms), min(lat), max(lat), min(lon), max(lon) FROM points WHERE id > ?",
+            (last_id,)).fetchone()
+        self.db.execute("UPDATE tracks SET end_ms = max(end_ms, ?), num_points = num_points + ? WHERE id = ?",
+                        (end_ms, added, track_id))
+        bounds = self.db.execute("SELECT min_lat, max_lat, min_lon, max_lon FROM tracks_rtree WHERE id = ?",
+                                 (track_id,)).fetchone()
+        if bounds is not None:
+            min_lat, max_lat = min(min_lat, bounds[0]), max(max_lat, bounds[1])
+            min_lon, max_lon = min(min_lon, bounds[2]), max(max_lon, bounds[3])
+        self.db.execute("INSERT OR REPLACE INTO tracks_rtree VALUES (?, ?, ?, ?, ?)",
+                        (track_id, min_lat, max_lat, min_lon, max_lon))
+        return added
+
+    def add_track(self, serial: int, track) -> int:
+        """
+        Archives the valid waypoints of a track of records (GTTrack, segment.StreamingTrack...),
+        by transactions of BATCH_POINTS points. Returns the number of points added.
+        """
+        records = (rec for rec in track if rec.valid and rec.is_waypoint)
+        added = 0
+        track_id = None
+        while True:
+            points = list(map(_get_point, islice(records, BATCH_POINTS)))
+            if not points:
+                return added
+            with self.db:
+                # Taking the write lock first: the other writers, like the devices archived in
+                # parallel, cannot insert points between the read of the last id and the inserts
+                self.db.execute("BEGIN IMMEDIATE")
+                created = False
+                if track_id is None:
+                    track_id, created = self._track_id(serial, points[0][0])
+                batch_added = self._insert_points(track_id, serial, points)
+                if created and not batch_added:
+                    # All the points were already archived, in another track
+                    self.db.execute("DELETE FROM tracks WHERE id = ?", (track_id,))
+                    track_id = None
+                added += batch_added
+
+    def add_tracks(self, serial: int, tracks) -> tuple:
+        """
+        Archives tracks of records of a device, returning the numbers of tracks and points added
+        """
+        num_tracks = 0
+        num_points = 0
+        for track in tracks:
+            added = self.add_track(serial, track)
+            if added:
+                num_tracks += 1
+                num_points += added
+            log.debug("Archived %s new points of track %s", added, track)
+        log.info("Archived %s new points in %s tracks of device %08x", num_points, num_tracks, serial)
+        return num_tracks, num_points
+
+    def add_device(self, dev: pygotu.GT200Dev, cache=None, window: pygotu.TimeWindow=None, **split_rules) -> tuple:
+        """
+        Downloads and archives the tracks of a device, streamed from it
+        """
+        return self.add_tracks(dev.serial, dev.stream_tracks(cache, window, **split_rules))
+
+    def _point_filters(self, bbox: tuple, window: pygotu.TimeWindow, serial: int) -> tuple:
+        clauses = []
+        params = []
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            # The R-tree coordinates are rounded outwards to 32 bit floats
+            clauses.append("r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?")
+            clauses.append("p.lat BETWEEN ? AND ? AND p.lon BETWEEN ? AND ?")
+            params += [max_lat, min_lat, max_lon, min_lon, min_lat, max_lat, min_lon, max_lon]
+        if window is not None and window.since is not None:
+            clauses.append("p.epoch_ms >= ?")
+            params.append(window.since)
+        if window is not None and window.until is not None:
+            clauses.append("p.epoch_ms <= ?")
+            params.append(window.until)
+        if serial is not None:
+            clauses.append("p.serial = ?")
+            params.append(serial)
+        return clauses, params
+
+    def query_points(self, bbox: tuple=None, window: pygotu.TimeWindow=None, serial: int=None,
+                     limit: int=None) -> PointSet:
+        """
+        Points within a bounding box (min lat, min lon, max lat, max lon), a time window
+        and of a device, all optional, ordered by track and time
+        """
+        clauses, params = self._point_filters(bbox, window, serial)
+        tables = "points_rtree r JOIN points p ON p.id BETWEEN r.id AND r.last_id" if bbox is not None else "points p"
+        sql = "SELECT {} FROM {}{} ORDER BY p.track_id, p.epoch_ms".format(
+            ", ".join("p." + name for name in PointSet.__slots__), tables, _where(clauses))
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+        return PointSet(self.db.execute(sql, params).fetchall())
+
+    def query_tracks(self, bbox: tuple=None, window: pygotu.TimeWindow=None, serial: int=None) -> list:
+        """
+        Tracks whose bounding box intersects bbox and whose time range intersects the window
+        """
+        clauses = []
+        params = []
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            clauses.append("r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?")
+            params += [max_lat, min_lat, max_lon, min_lon]
+        if window is not None and window.since is not None:
+            clauses.append("t.end_ms >= ?")
+            params.append(window.since)
+        if window is not None and window.until is not None:
+            clauses.append("t.start_ms <= ?")
+            params.append(window.until)
+        if serial is not None:
+            clauses.append("t.serial = ?")
+            params.append(serial)
+        sql = ("SELECT t.id, t.serial, t.start_ms, t.end_ms, t.num_points, r.min_lat, r.max_lat, r.min_lon, r.max_lon "
+               "FROM tracks t JOIN tracks_rtree r ON r.id = t.id{} ORDER BY t.serial, t.start_ms").format(_where(clauses))
+        return [ArchivedTrack(*row) for row in self.db.execute(sql, params)]
+
+    def track_points(self, track_id: int) -> PointSet:
+        return PointSet(self.db.execute(
+            "SELECT {} FROM points WHERE track_id = ? ORDER BY epoch_ms".format(", ".join(PointSet.__slots__)),
+            (track_id,)).fetchall())
+
+    def __str__(self):
+        num_tracks, = self.db.execute("SELECT count(*) FROM tracks").fetchone()
+        num_points, num_devices = self.db.execute("SELECT count(*), count(DISTINCT serial) FROM points").fetchone()
+        return "{}: {} devices, {} tracks, {} points".format(
+            os.path.basename(self.path), num_devices, num_tracks, num_points)
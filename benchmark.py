@@ -0,0 +1,631 @@
+import argparse
+import array
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import archive
+import connections
+import export
+import gt2gpx
+import gtbatch
+import integrity
+import nmea
+import pygotu
+import recording
+import segment
+import simplify
+import simulator
+import trackfile
+import trackstats
+
+log = logging.getLogger(__name__)
+
+BENCH_DOWNLOAD = "download"
+BENCH_PIPELINE = "pipeline"
+BENCH_PURGE = "purge"
+BENCH_USB_RECEIVE = "usb-receive"
+BENCH_RECORDS = "records"
+BENCH_EXPORT = "export"
+BENCH_REPLAY = "replay"
+BENCH_INTEGRITY = "integrity"
+BENCH_ARCHIVE = "archive"
+BENCH_TRACK_FILE = "trackfile"
+BENCH_NMEA = "nmea"
+BENCH_SIMPLIFY = "simplify"
+BENCH_TRACK_STATS = "trackstats"
+
+MODEL_NAMES = [info[0] for info in pygotu.MODELS.values()]
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='pygotu benchmarks, run against a simulated device')
+    parser.add_argument("--verbose", "-v", action='store_const', const=logging.DEBUG,
+                        default=logging.WARNING, help="Display debugging information in the output")
+    parser.add_argument("--model", choices=MODEL_NAMES, default=MODEL_NAMES[-1],
+                        help="Simulated device model")
+    parser.add_argument("--records", type=int, default=100000,
+                        help="Number of records in the simulated flash")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Simulated latency per transfer, in seconds")
+    parser.add_argument("--flush-delay", type=float, default=connections.FAST_TIMEOUT / 1000.0,
+                        help="Simulated duration of a connection flush, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Probability of a device error response per command")
+    parser.add_argument("--timeout-rate", type=float, default=0.0,
+                        help="Probability of a command never answered per command")
+    parser.add_argument("--corrupt-rate", type=float, default=0.02,
+                        help="Probability of a garbled flash read response, in the integrity benchmark")
+    parser.add_argument("--usb-packets", action='store_true',
+                        help="Download through connections.USBSerial, the simulated device sending its "
+                             "responses in padded packets like the loggers")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs")
+    parser.add_argument("--trace", action='append', default=[],
+                        help="Trace recorded with gt2gpx --record, replayed by the replay benchmark "
+                             "instead of traces of the simulated models")
+    parser.add_argument("--replay-speed", type=float, action='append',
+                        help="Speed factors of the replays, 1 (recorded durations) and 0 (no wait) by default")
+    parser.add_argument("--nmea-capture",
+                        help="NMEA stream recorded with gt2gpx --record TRACE live, replayed by the nmea "
+                             "benchmark instead of a capture of the simulated device")
+    parser.add_argument("--fixes", type=int, default=100,
+                        help="Number of fixes of the simulated NMEA capture")
+    parser.add_argument("--nmea-interval", type=float, default=0.05,
+                        help="Interval between the fixes of the simulated NMEA capture, in seconds")
+
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks to run among {}, all by default".format(", ".join(sorted(BENCHMARKS))))
+
+    arguments = parser.parse_args()
+    for name in arguments.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+    return arguments
+
+
+def _simulated_connection(arguments):
+    return connections.get_connection(
+        connections.CONNECTION_TYPE_SIMULATOR,
+        model=arguments.model,
+        num_records=arguments.records,
+        latency=arguments.latency,
+        flush_delay=arguments.flush_delay,
+        error_rate=arguments.error_rate,
+        timeout_rate=arguments.timeout_rate)
+
+
+def report(name: str, elapsed: float, records: int, sim):
+    print("{:<10} {:>8.3f} s {:>12.0f} records/s {:>12.0f} bytes/s  ({} transfers, {} flushes, {} bytes in, {} bytes out)".format(
+        name, elapsed, records / elapsed, (sim.bytes_in + sim.bytes_out) / elapsed,
+        sim.transfers, sim.flushes, sim.bytes_in, sim.bytes_out))
+
+
+def _bench_download(arguments, name: str, **download_args):
+    sim = _simulated_connection(arguments)
+    connection = sim
+    if arguments.usb_packets:
+        usb = simulator.SimulatedUSB(sim)
+        connection = connections.USBSerial(usb, usb)
+    fd, destination = tempfile.mkstemp(suffix=".gpx")
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        gt2gpx.download_track(connection, destination, **download_args)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.remove(destination)
+    report(name, elapsed, arguments.records, sim)
+
+
+def bench_download(arguments):
+    _bench_download(arguments, BENCH_DOWNLOAD)
+
+
+def bench_pipeline(arguments):
+    _bench_download(arguments, BENCH_PIPELINE, pipelined=True)
+
+
+def bench_purge(arguments):
+    sim = _simulated_connection(arguments)
+    start = time.perf_counter()
+    plan = gt2gpx.purge(sim)
+    elapsed = time.perf_counter() - start
+    report(BENCH_PURGE, elapsed, arguments.records, sim)
+    print("{:<10} {}".format("", plan))
+
+
+class FakeEndpoint:
+    """
+    Endpoint serving flash_read responses in packets, ending each transfer
+    with a short packet like the device does
+    """
+    __slots__ = ['wMaxPacketSize', 'response', 'pos', 'transfers']
+
+    def __init__(self, packet_size: int=0x10):
+        self.wMaxPacketSize = packet_size
+        self.response = b"\x93\x10\x00" + os.urandom(pygotu.PAGE_SIZE)
+        self.pos = 0
+        self.transfers = 0
+
+    def read(self, size_or_buffer, timeout=None):
+        self.transfers += 1
+        size = size_or_buffer if isinstance(size_or_buffer, int) else len(size_or_buffer)
+        data = self.response[self.pos:self.pos + size]
+        self.pos = (self.pos + len(data)) % len(self.response)
+        if isinstance(size_or_buffer, int):
+            return array.array('B', data)
+        size_or_buffer[:len(data)] = array.array('B', data)
+        return len(data)
+
+
+class LegacyUSBReceive:
+    """
+    Receive path of USBSerial before the ReceiveBuffer, counting its copies
+    """
+    __slots__ = ['receive_buffer', 'endpoint', 'copies']
+
+    def __init__(self, endpoint):
+        self.receive_buffer = bytearray()
+        self.endpoint = endpoint
+        self.copies = 0
+
+    def read(self, size=1):
+        while len(self.receive_buffer) < size:
+            data = self.endpoint.read(0x10, timeout=connections.FAST_TIMEOUT).tobytes()
+            self.receive_buffer.extend(data)
+            self.copies += 2
+        data = self.receive_buffer[:size]
+        self.receive_buffer = self.receive_buffer[size:]
+        self.copies += 2
+        return data
+
+
+def _read_pages(read, pages: int):
+    for _ in range(pages):
+        header = read(3)
+        read(header[1] << 8 | header[2])
+
+
+def bench_usb_receive(arguments):
+    pages = max(1, arguments.records // pygotu.RECORDS_PER_PAGE)
+    size = pages * (pygotu.PAGE_SIZE + 3)
+
+    endpoint = FakeEndpoint()
+    legacy = LegacyUSBReceive(endpoint)
+    start = time.perf_counter()
+    _read_pages(legacy.read, pages)
+    elapsed = time.perf_counter() - start
+    print("{:<18} {:>8.3f} s {:>12.0f} bytes/s  ({} transfers, {} copies)".format(
+        "usb-receive legacy", elapsed, size / elapsed, endpoint.transfers, legacy.copies))
+
+    endpoint = FakeEndpoint()
+    usb_serial = connections.USBSerial(dev=None, endpoint=endpoint)
+    start = time.perf_counter()
+    _read_pages(usb_serial.read_view, pages)
+    elapsed = time.perf_counter() - start
+    receive_buffer = usb_serial.receive_buffer
+    print("{:<18} {:>8.3f} s {:>12.0f} bytes/s  ({} transfers, {} copies, {} allocations, {} wraps)".format(
+        BENCH_USB_RECEIVE, elapsed, size / elapsed, endpoint.transfers, receive_buffer.copies,
+        receive_buffer.allocations, receive_buffer.wraps))
+
+
+def _decode_dump(dump: bytes, record_type) -> list:
+    records = []
+    for first_idx in range(0, len(dump) // pygotu.RECORD_SIZE, pygotu.RECORDS_PER_PAGE):
+        page = dump[first_idx * pygotu.RECORD_SIZE:(first_idx + pygotu.RECORDS_PER_PAGE) * pygotu.RECORD_SIZE]
+        records.extend(pygotu.page_records(first_idx, page, record_type))
+    return records
+
+
+def bench_records(arguments):
+    dump = simulator.synthesize_records(arguments.records).tobytes()
+
+    for name, record_type in (("eager", pygotu.GTRecord), ("lazy", pygotu.LazyGTRecord)):
+        start = time.perf_counter()
+        records = _decode_dump(dump, record_type)
+        decoded = time.perf_counter() - start
+        # Fields written to GPX
+        for rec in records:
+            rec.lat, rec.lon, rec.elevation, rec.isotime, rec.sat, rec.speed, rec.course, rec.ehpe
+        elapsed = time.perf_counter() - start
+        del records
+
+        tracemalloc.start()
+        records = _decode_dump(dump, record_type)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del records
+
+        print("{:<10} decode {:>8.3f} s  with GPX fields {:>8.3f} s {:>12.0f} records/s  peak {:>8.1f} MiB".format(
+            name, decoded, elapsed, arguments.records / elapsed, peak / 1024.0 / 1024.0))
+
+
+LEGACY_GPX_RECORD = """      <trkpt lat="{0.lat}" lon="{0.lon}">
+        <ele>{0.elevation}</ele>
+        <time>{0.isotime}</time>
+        <sat>{0.sat}</sat>
+        <extensions>
+          <pygotu:speed>{0.speed}</pygotu:speed>
+          <pygotu:course>{0.course}</pygotu:course>
+          <pygotu:ehpe>{0.ehpe}</pygotu:ehpe>
+        </extensions>
+      </trkpt>
+"""
+
+
+def _legacy_write_gpx(f, records):
+    """
+    GPX writing before the export module: one str.format and one write per record
+    """
+    f.write(export.GPXWriter.header)
+    f.write(export.GPXWriter.track_start.format(name="Track"))
+    for rec in records:
+        if not rec.valid or not rec.is_waypoint:
+            continue
+        f.write(LEGACY_GPX_RECORD.format(rec))
+    f.write(export.GPXWriter.track_end)
+    f.write(export.GPXWriter.footer)
+
+
+def _bench_export(name: str, num_records: int, write):
+    fd, destination = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with open(destination, "w") as f:
+            start = time.perf_counter()
+            write(f)
+            elapsed = time.perf_counter() - start
+        size = os.path.getsize(destination)
+    finally:
+        os.remove(destination)
+    print("{:<24} {:>8.3f} s {:>12.0f} records/s {:>12.0f} bytes/s".format(
+        name, elapsed, num_records / elapsed, size / elapsed))
+
+
+def bench_export(arguments):
+    dump = simulator.synthesize_records(arguments.records).tobytes()
+    batches = [gtbatch.decode_page(dump[first_idx * pygotu.RECORD_SIZE:(first_idx + pygotu.RECORDS_PER_PAGE) * pygotu.RECORD_SIZE], first_idx)
+               for first_idx in range(0, arguments.records, pygotu.RECORDS_PER_PAGE)]
+
+    # Records are decoded again before each run, their fields being cached once accessed
+    records = _decode_dump(dump, pygotu.LazyGTRecord)
+    _bench_export("export gpx legacy", arguments.records, lambda f: _legacy_write_gpx(f, records))
+    for name, writer in sorted(export.WRITERS.items()):
+        records = _decode_dump(dump, pygotu.LazyGTRecord)
+        _bench_export("export {} records".format(name), arguments.records,
+                      lambda f: writer(f).write_tracks([pygotu.GTTrack(0, records)]))
+        _bench_export("export {} columnar".format(name), arguments.records,
+                      lambda f: writer(f).write_batches(batches))
+
+
+def _timed(name: str, num_points: int, call):
+    start = time.perf_counter()
+    result = call()
+    elapsed = time.perf_counter() - start
+    print("{:<24} {:>8.3f} s {:>12.0f} points/s".format(name, elapsed, num_points / elapsed))
+    return result
+
+
+def bench_trackfile(arguments):
+    """
+    Writes the compact track file and the GPX of a log, reads them back, whole and by time range
+    """
+    dump = simulator.synthesize_records(arguments.records).tobytes()
+    batch = gtbatch.decode_dump(dump)
+    n = len(batch.waypoints())
+    directory = tempfile.mkdtemp()
+    try:
+        track_file = os.path.join(directory, "log.gtt")
+        gpx_file = os.path.join(directory, "log.gpx")
+        with open(track_file, "wb") as f:
+            _timed("write gtt", n, lambda: trackfile.TrackFileWriter(f).write_batches([batch]))
+        with open(gpx_file, "w") as f:
+            _timed("write gpx", n, lambda: export.GPXWriter(f).write_batches([batch]))
+        print("{:<24} gtt {:.1f} bytes/point, gpx {:.1f} bytes/point".format(
+            "", os.path.getsize(track_file) / n, os.path.getsize(gpx_file) / n))
+
+        with trackfile.TrackFile(track_file) as tf:
+            points = _timed("read gtt", n, tf.read)
+            start_ms = int(points.epoch_ms[len(points) // 2])
+            window = pygotu.TimeWindow(start_ms, start_ms + 3600000)
+            hour = _timed("read gtt one hour", n, lambda: tf.read(window))
+            print("{:<24} {} points".format("", len(hour)))
+            _timed("read gtt records", n, lambda: sum(1 for _ in tf.records()))
+        _timed("read gpx", n, lambda: list(trackfile.read_gpx(gpx_file)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_simplify(arguments):
+    """
+    Exports a log to GPX as is and through each simplification, reporting the output size
+    """
+    dump = simulator.synthesize_records(arguments.records).tobytes()
+    batch = gtbatch.decode_dump(dump).waypoints()
+    n = len(batch)
+    stages = (
+        ("gpx", None),
+        ("gpx dp 5 m", simplify.TrackSimplifier(5.0)),
+        ("gpx vw 5 m", simplify.TrackSimplifier(5.0, simplify.METHOD_VISVALINGAM)),
+        ("gpx resample 30 s", simplify.TrackSimplifier(interval=30.0)),
+        ("gpx jitter", simplify.TrackSimplifier(jitter=True)),
+    )
+    fd, destination = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for name, simplifier in stages:
+            with open(destination, "w") as f:
+                writer = export.GPXWriter(f)
+                _timed(name, n, lambda: writer.write_batch_tracks(
+                    [batch] if simplifier is None else simplifier.process_batches([batch])))
+            print("{:<24} {} points, {} bytes".format("", writer.num_points, os.path.getsize(destination)))
+    finally:
+        os.remove(destination)
+
+
+def _record_loop_stats(records) -> tuple:
+    """
+    Track statistics computed record by record in the caller, as before trackstats
+    """
+    distance = moving_ms = gain = loss = max_speed = 0.0
+    sat_total = 0
+    last = None
+    for rec in records:
+        if not rec.valid or not rec.is_waypoint:
+            continue
+        if last is not None:
+            distance += segment.haversine(last.lat, last.lon, rec.lat, rec.lon)
+            if rec.speed >= trackstats.MOVING_SPEED:
+                moving_ms += rec.epoch_ms - last.epoch_ms
+            climb = rec.elevation - last.elevation
+            if climb > 0:
+                gain += climb
+            else:
+                loss -= climb
+        max_speed = max(max_speed, rec.speed)
+        sat_total += rec.sat
+        last = rec
+    return distance, moving_ms, gain, loss, max_speed, sat_total
+
+
+def bench_trackstats(arguments):
+    """
+    Track statistics of a log: record by record, from records by chunks, and on the columns
+    """
+    dump = simulator.synthesize_records(arguments.records).tobytes()
+    batch = gtbatch.decode_dump(dump).waypoints()
+    n = len(batch)
+    # Records are decoded again before each run, their fields being cached once accessed
+    records = _decode_dump(dump, pygotu.LazyGTRecord)
+    _timed("stats record loop", n, lambda: _record_loop_stats(records))
+    records = _decode_dump(dump, pygotu.LazyGTRecord)
+    _timed("stats records", n, lambda: pygotu.GTTrack(0, records).statistics())
+    track_stats = _timed("stats columnar", n, lambda: trackstats.TrackStats.of_points(batch))
+    print("{:<24} {}".format("", track_stats))
+
+
+def _consume_fixes(stream: nmea.NMEAStream, delay: float=0.0) -> int:
+    n = 0
+    for _ in stream:
+        n += 1
+        if delay:
+            time.sleep(delay)
+    return n
+
+
+async def _consume_fixes_async(stream: nmea.NMEAStream) -> int:
+    n = 0
+    async for _ in stream:
+        n += 1
+    return n
+
+
+def bench_nmea(arguments):
+    """
+    Replays an NMEA capture: at the recorded pace for the latency from the reception
+    of the data completing each fix to its delivery, without waiting for the parsing
+    throughput, then with a consumer slower than the stream, which gets the latest
+    fixes while the oldest ones are dropped
+    """
+    capture = arguments.nmea_capture
+    if capture is None:
+        fd, capture = tempfile.mkstemp(suffix=".trace")
+        os.close(fd)
+    try:
+        if not arguments.nmea_capture:
+            sim = simulator.SimulatedDevice(model=arguments.model, num_records=arguments.fixes,
+                                            nmea_interval=arguments.nmea_interval)
+            connection = recording.RecordingConnection(sim, capture, gt2gpx.ACTION_LIVE)
+            with nmea.NMEAStream(connection) as stream:
+                for i, _ in enumerate(stream, 1):
+                    if i >= arguments.fixes:
+                        break
+            connection.close()
+        trace = recording.Trace(capture)
+
+        runs = (
+            ("live", 1.0, nmea.DEFAULT_MAX_FIXES, _consume_fixes),
+            ("live async", 1.0, nmea.DEFAULT_MAX_FIXES, lambda stream: asyncio.run(_consume_fixes_async(stream))),
+            ("no wait", 0.0, 1 << 20, _consume_fixes),
+            ("slow", 0.0, 8, lambda stream: _consume_fixes(stream, 0.001)),
+        )
+        for name, speed, max_fixes, consume in runs:
+            stream = nmea.NMEAStream(recording.ReplayConnection(trace, speed), max_fixes)
+            start = time.perf_counter()
+            with stream:
+                fixes = consume(stream)
+            elapsed = time.perf_counter() - start
+            latency = stream.latency
+            print("{:<10} {:>8.3f} s {:>10.0f} fixes/s {:>12.0f} bytes/s  latency mean {:.3f} ms p50 {:g} ms "
+                  "p95 {:g} ms max {:.3f} ms  ({} fixes, {} dropped)".format(
+                      name, elapsed, fixes / elapsed, stream.parser.bytes_in / elapsed,
+                      latency.total / max(1, latency.count), latency.percentile(0.5), latency.percentile(0.95),
+                      latency.max, fixes, stream.dropped))
+    finally:
+        if not arguments.nmea_capture:
+            os.remove(capture)
+
+
+def bench_integrity(arguments):
+    """
+    Downloads without and with the page checks, then with garbled responses: the checked
+    download must match the clean one when all the corrupted pages are detected
+    """
+    records = simulator.synthesize_records(arguments.records)
+    outputs = []
+    for name, corrupt_rate, validator in (("unchecked", 0.0, None),
+                                          ("checked", 0.0, integrity.PageValidator()),
+                                          ("corrupted", arguments.corrupt_rate, integrity.PageValidator())):
+        sim = simulator.SimulatedDevice(model=arguments.model, records=records, latency=arguments.latency,
+                                        flush_delay=arguments.flush_delay, corrupt_rate=corrupt_rate)
+        fd, destination = tempfile.mkstemp(suffix=".gpx")
+        os.close(fd)
+        try:
+            start = time.perf_counter()
+            gt2gpx.download_track(sim, destination, validator=validator)
+            elapsed = time.perf_counter() - start
+            outputs.append(_read_file(destination))
+        finally:
+            os.remove(destination)
+        report(name, elapsed, arguments.records, sim)
+        if validator is not None:
+            print("{:<10} {} garbled responses; {}".format("", sim.corruptions, validator))
+    print("{:<10} output {} the clean download".format(
+        "", "matches" if outputs[2] == outputs[0] else "differs from"))
+
+
+def bench_archive(arguments):
+    """
+    Archives a device twice, the second sync only finding points already archived,
+    then queries the archive by area and by period
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(directory, "archive.db")
+        records = simulator.synthesize_records(arguments.records)
+        for name in ("archive", "re-archive"):
+            sim = simulator.SimulatedDevice(model=arguments.model, records=records, latency=arguments.latency,
+                                            flush_delay=arguments.flush_delay)
+            start = time.perf_counter()
+            num_tracks, num_points = gt2gpx.archive_tracks(sim, db_file)
+            report(name, time.perf_counter() - start, arguments.records, sim)
+            print("{:<10} {} tracks, {} points added".format("", num_tracks, num_points))
+
+        with archive.TrackArchive(db_file) as track_archive:
+            start_ms, end_ms = track_archive.db.execute("SELECT min(epoch_ms), max(epoch_ms) FROM points").fetchone()
+            lat, lon = track_archive.db.execute("SELECT avg(lat), avg(lon) FROM points").fetchone()
+            queries = (
+                ("bbox", dict(bbox=(lat - 0.002, lon - 0.002, lat + 0.002, lon + 0.002))),
+                ("window", dict(window=pygotu.TimeWindow(start_ms + (end_ms - start_ms) // 2,
+                                                         start_ms + (end_ms - start_ms) // 2 + 3600000))),
+            )
+            for name, query in queries:
+                start = time.perf_counter()
+                points = track_archive.query_points(**query)
+                elapsed = time.perf_counter() - start
+                start = time.perf_counter()
+                tracks = track_archive.query_tracks(**query)
+                print("{:<10} {:>8.3f} s {:>8} points, tracks in {:.3f} s: {}".format(
+                    name, elapsed, len(points), time.perf_counter() - start, len(tracks)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def _run_action(action: str, connection, destination: str):
+    if action == gt2gpx.ACTION_GET:
+        gt2gpx.download_track(connection, destination)
+    elif action == gt2gpx.ACTION_DUMP:
+        gt2gpx.dump_flash(connection, destination)
+    elif action == gt2gpx.ACTION_PURGE:
+        gt2gpx.purge(connection)
+    else:
+        raise Exception("Unknown traced action: {}".format(action))
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _record_simulated(arguments, model: str, action: str, trace_file: str, destination: str):
+    sim = connections.get_connection(
+        connections.CONNECTION_TYPE_SIMULATOR,
+        model=model,
+        num_records=arguments.records,
+        latency=arguments.latency,
+        flush_delay=arguments.flush_delay,
+        error_rate=arguments.error_rate,
+        timeout_rate=arguments.timeout_rate)
+    start = time.perf_counter()
+    _run_action(action, recording.RecordingConnection(sim, trace_file, action), destination)
+    elapsed = time.perf_counter() - start
+    report("record", elapsed, arguments.records, sim)
+
+
+def bench_replay(arguments):
+    """
+    Replays traces at each speed, checking the output matches the recorded session.
+    Without --trace, a download and a purge of each simulated model are recorded first.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        # The recorded traces are removed with the directory, at each run
+        traces = list(arguments.trace or [])
+        outputs = {}
+        if not traces:
+            for model in MODEL_NAMES:
+                for action in (gt2gpx.ACTION_GET, gt2gpx.ACTION_PURGE):
+                    trace_file = os.path.join(directory, "{}-{}.trace".format(model.replace("/", "_"), action))
+                    destination = trace_file + ".out"
+                    print("{} {}".format(model, action))
+                    _record_simulated(arguments, model, action, trace_file, destination)
+                    if os.path.exists(destination):
+                        outputs[trace_file] = _read_file(destination)
+                    traces.append(trace_file)
+
+        for trace_file in traces:
+            trace = recording.Trace(trace_file)
+            print("{} bytes: {}".format(os.path.getsize(trace_file), trace))
+            for speed in arguments.replay_speed or (1.0, 0.0):
+                destination = os.path.join(directory, "replay.out")
+                replay = recording.ReplayConnection(trace, speed)
+                start = time.perf_counter()
+                _run_action(trace.label, replay, destination)
+                elapsed = time.perf_counter() - start
+                report("x{:g}".format(speed) if speed else "no wait", elapsed, arguments.records, replay)
+                if trace_file in outputs and _read_file(destination) != outputs[trace_file]:
+                    print("{:<10} output differs from the recorded session".format(""))
+
+
+BENCHMARKS = {
+    BENCH_DOWNLOAD: bench_download,
+    BENCH_PIPELINE: bench_pipeline,
+    BENCH_PURGE: bench_purge,
+    BENCH_USB_RECEIVE: bench_usb_receive,
+    BENCH_RECORDS: bench_records,
+    BENCH_EXPORT: bench_export,
+    BENCH_REPLAY: bench_replay,
+    BENCH_INTEGRITY: bench_integrity,
+    BENCH_ARCHIVE: bench_archive,
+    BENCH_TRACK_FILE: bench_trackfile,
+    BENCH_NMEA: bench_nmea,
+    BENCH_SIMPLIFY: bench_simplify,
+    BENCH_TRACK_STATS: bench_trackstats,
+}
+
+
+def main():
+    arguments = _parse_arguments()
+
+    logging.basicConfig(level=arguments.verbose)
+
+    for _ in range(arguments.repeat):
+        for name in arguments.benchmarks or sorted(BENCHMARKS):
+            BENCHMARKS[name](arguments)
+
+
+if __name__ == '__main__':
+    main()
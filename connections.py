@@ -1,4 +1,9 @@
+import array
+import collections
+import errno
 import logging
+import time
+
 import serial
 import usb.core
 import usb.util
@@ -7,23 +12,207 @@ log = logging.getLogger(__name__)
 
 CONNECTION_TYPE_USB = "USB"
 CONNECTION_TYPE_SERIAL = "SERIAL"
+CONNECTION_TYPE_SIMULATOR = "SIMULATOR"
+CONNECTION_TYPE_REPLAY = "REPLAY"
 
 VENDOR_ID = 0x0df7
 PRODUCT_ID = 0x0900
 
 SLOW_TIMEOUT = 2000
 FAST_TIMEOUT = 20
-CUTOFF_TIMEOUT = 2
+# Read timeout of the NMEA stream of the GPS dongle mode, in ms: the reader checks
+# whether it is stopped at this interval when nothing is received
+STREAM_TIMEOUT = 200
+
+# Adaptive timeouts, in ms: a percentile of the last RTT_WINDOW transfer durations,
+# times RTT_FACTOR plus RTT_MARGIN, within [MIN_TIMEOUT, SLOW_TIMEOUT]. The command
+# writes and single packet responses, like the status polls during an erase, are
+# not retried by all callers: their timeout is at least COMMAND_MIN_TIMEOUT.
+MIN_TIMEOUT = 5
+COMMAND_MIN_TIMEOUT = 100
+RTT_WINDOW = 64
+RTT_MIN_SAMPLES = 8
+RTT_PERCENTILE = 0.95
+RTT_FACTOR = 2.0
+RTT_MARGIN = 5
+
+# Largest single endpoint read, enough for a flash page and its response header
+MAX_TRANSFER = 0x1040
+ARENA_SIZE = 0x10000
+
+# flush() drains what the device still sends, a late response included, with a fixed
+# timeout in ms, reading at most FLUSH_READS transfers
+FLUSH_TIMEOUT = 100
+FLUSH_READS = 4
+
+
+class AdaptiveTimeout(object):
+    """
+    Timeout of one kind of transfer, following its measured durations. SLOW_TIMEOUT is
+    used until RTT_MIN_SAMPLES transfers are measured, to match the slow start of some
+    iGotU devices. Each timeout doubles the next ones until a transfer succeeds.
+    """
+    __slots__ = ['name', 'min_timeout', 'samples', 'timeout', 'backoff', 'transfers', 'timeouts']
+
+    def __init__(self, name: str="", min_timeout: int=MIN_TIMEOUT):
+        self.name = name
+        self.min_timeout = min_timeout
+        self.samples = collections.deque(maxlen=RTT_WINDOW)
+        self.timeout = SLOW_TIMEOUT
+        self.backoff = 1
+        self.transfers = 0
+        self.timeouts = 0
+
+    def record(self, duration_ms: float):
+        self.transfers += 1
+        self.samples.append(duration_ms)
+        self.backoff = 1
+        self._update()
+
+    def timed_out(self):
+        self.timeouts += 1
+        self.backoff = min(self.backoff * 2, SLOW_TIMEOUT // MIN_TIMEOUT)
+        self._update()
+
+    def _update(self):
+        if len(self.samples) < RTT_MIN_SAMPLES:
+            self.timeout = SLOW_TIMEOUT
+            return
+        ordered = sorted(self.samples)
+        rtt = ordered[int(RTT_PERCENTILE * (len(ordered) - 1))]
+        timeout = (rtt * RTT_FACTOR + RTT_MARGIN) * self.backoff
+        self.timeout = int(min(max(timeout, self.min_timeout), SLOW_TIMEOUT))
+
+    def stats(self) -> dict:
+        ordered = sorted(self.samples)
+        return {
+            "timeout_ms": self.timeout,
+            "transfers": self.transfers,
+            "timeouts": self.timeouts,
+            "rtt_median_ms": ordered[len(ordered) // 2] if ordered else None,
+            "rtt_max_ms": ordered[-1] if ordered else None,
+        }
+
+
+def _is_timeout(e: usb.core.USBError) -> bool:
+    timeout_error = getattr(usb.core, "USBTimeoutError", None)
+    return (timeout_error is not None and isinstance(e, timeout_error)) or e.errno == errno.ETIMEDOUT
+
+
+class ReceiveBuffer(object):
+    """
+    Preallocated receive buffer. Transfers are appended after the unread data and
+    read_view() hands out memoryviews without copying. When the arena is full, the
+    unread data wraps around to its start, unless handed out views still reference
+    it: a new one is then allocated instead of overwriting it, so they stay valid.
+    """
+    __slots__ = ['arena', 'view', 'head', 'tail', 'copies', 'allocations', 'wraps']
+
+    def __init__(self, capacity: int=ARENA_SIZE):
+        self.arena = bytearray(capacity)
+        self.view = memoryview(self.arena)
+        self.head = 0
+        self.tail = 0
+        self.copies = 0
+        self.allocations = 1
+        self.wraps = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def append(self, data):
+        size = len(data)
+        if self.tail + size > len(self.arena):
+            pending = self.tail - self.head
+            if pending + size <= len(self.arena) and not self._referenced():
+                self.view[:pending] = self.arena[self.head:self.tail]
+                self.wraps += 1
+            else:
+                arena = bytearray(max(ARENA_SIZE, pending + size))
+                arena[:pending] = self.view[self.head:self.tail]
+                self.arena = arena
+                self.view = memoryview(self.arena)
+                self.allocations += 1
+            self.head = 0
+            self.tail = pending
+        self.view[self.tail:self.tail + size] = data
+        self.tail += size
+        self.copies += 1
+
+    def _referenced(self) -> bool:
+        """
+        Whether views handed out by read_view() are still alive: a bytearray cannot
+        be resized while memoryviews of it exist
+        """
+        self.view.release()
+        try:
+            self.arena.append(0)
+        except BufferError:
+            return True
+        else:
+            del self.arena[-1]
+            return False
+        finally:
+            self.view = memoryview(self.arena)
+
+    def read_view(self, size: int) -> memoryview:
+        size = min(size, self.tail - self.head)
+        data = self.view[self.head:self.head + size]
+        self.head += size
+        return data
+
+    def clear(self):
+        # Data may still be referenced by handed out views: only the unread part is dropped
+        self.head = self.tail
+
+
+def usb_address(dev) -> str:
+    """
+    Location of a USB device on the host, as "bus-port[.port...]"
+    """
+    ports = getattr(dev, "port_numbers", None) or (dev.address,)
+    return "{}-{}".format(dev.bus, ".".join(str(port) for port in ports))
+
+
+def find_usb_devices() -> list:
+    """
+    All attached iGotU loggers, sorted by USB address
+    """
+    return sorted(usb.core.find(find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID), key=usb_address)
+
+
+def find_usb_device(address: str):
+    for dev in find_usb_devices():
+        if usb_address(dev) == address:
+            return dev
+    raise Exception("No matching device found at {}".format(address))
 
 
 class USBSerial(object):
-    __slots__ = ['receive_buffer', 'dev', 'endpoint', 'number_of_requests']
+    __slots__ = ['receive_buffer', 'dev', 'endpoint', 'transfer_buffers', 'packet_size',
+                 'write_timeout', 'read_timeout', 'bulk_read_timeout', 'stats']
+
+    def __init__(self, dev=None, endpoint=None):
+        self.receive_buffer = ReceiveBuffer()
+        self.transfer_buffers = {}
+        # Single packet reads and whole page reads have very different durations
+        self.write_timeout = AdaptiveTimeout("write", COMMAND_MIN_TIMEOUT)
+        self.read_timeout = AdaptiveTimeout("read", COMMAND_MIN_TIMEOUT)
+        self.bulk_read_timeout = AdaptiveTimeout("bulk_read")
+        # stats.Stats collecting the transfer statistics, see GT200Dev.attach_stats()
+        self.stats = None
 
-    def __init__(self):
-        self.receive_buffer = bytearray()
-        self.number_of_requests = 0
+        if endpoint is None:
+            dev, endpoint = self._open_device(dev)
 
-        dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+        self.dev = dev
+        self.endpoint = endpoint
+        self.packet_size = endpoint.wMaxPacketSize or 0x10
+
+    @staticmethod
+    def _open_device(dev=None):
+        if dev is None:
+            dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
         if not dev:
             raise Exception("No matching device found")
         dev.set_configuration()
@@ -42,54 +231,137 @@ class USBSerial(object):
         if not ep:
             raise Exception("No matching endpoint found")
 
-        self.dev = dev
-        self.endpoint = ep
+        return dev, ep
 
-    @property
-    def timeout(self):
+    def _transfer(self, timeout: AdaptiveTimeout, transfer, *args):
         """
-        This method allows to start with long timeout and then accelerate, to match the behavior 
-        on some iGotU devices
+        Runs a pyusb transfer with an adaptive timeout, raising TimeoutError when it expires
         """
-        self.number_of_requests += 1
-        return FAST_TIMEOUT if self.number_of_requests > CUTOFF_TIMEOUT else SLOW_TIMEOUT
+        start = time.perf_counter()
+        try:
+            result = transfer(*args, timeout=timeout.timeout)
+        except usb.core.USBError as e:
+            if not _is_timeout(e):
+                raise
+            duration_ms = (time.perf_counter() - start) * 1000
+            timeout.timed_out()
+            if self.stats is not None:
+                self.stats.transfer(timeout.name, duration_ms, 0, timed_out=True)
+            raise TimeoutError("USB transfer timed out after {} ms".format(int(duration_ms))) from e
+        duration_ms = (time.perf_counter() - start) * 1000
+        timeout.record(duration_ms)
+        if self.stats is not None:
+            # Control writes and endpoint reads into a buffer both return a size
+            self.stats.transfer(timeout.name, duration_ms, result)
+        return result
+
+    def timeout_stats(self) -> dict:
+        return {
+            "write": self.write_timeout.stats(),
+            "read": self.read_timeout.stats(),
+            "bulk_read": self.bulk_read_timeout.stats(),
+        }
 
     def write(self, data):
+        # The responses are sent in whole packets: what is left of the last one read is
+        # padding, not the start of the response to this command
+        self.receive_buffer.clear()
         # Using control write, 8 bytes per transfer
-        result = self.dev.ctrl_transfer(0x21, 0x09, 0x0200, 0x0000, data[:8], timeout=self.timeout)
+        result = self._transfer(self.write_timeout, self.dev.ctrl_transfer, 0x21, 0x09, 0x0200, 0x0000, data[:8])
         assert result == 8
         self.read(3)
-        result = self.dev.ctrl_transfer(0x21, 0x09, 0x0200, 0x0000, data[8:], timeout=self.timeout)
+        # Same for the rest of the packet answering the first half
+        self.receive_buffer.clear()
+        result = self._transfer(self.write_timeout, self.dev.ctrl_transfer, 0x21, 0x09, 0x0200, 0x0000, data[8:])
         assert result == 8
 
     def read(self, size=1):
+        return self.read_view(size).tobytes()
+
+    def read_view(self, size=1) -> memoryview:
+        """
+        Same as read(), without copying: the view stays valid as long as it is referenced
+        """
         self._fill_receive_buffer(size)
-        data = self.receive_buffer[:size]
-        self.receive_buffer = self.receive_buffer[size:]
+        return self.receive_buffer.read_view(size)
 
-        return data
+    def read_some(self, size=1) -> memoryview:
+        """
+        Up to size bytes, as soon as some are received, for the NMEA stream of the GPS
+        dongle mode. Returns an empty view when nothing comes within STREAM_TIMEOUT.
+        """
+        if not len(self.receive_buffer):
+            packets = min(max(1, size // self.packet_size), MAX_TRANSFER // self.packet_size)
+            buf = self._transfer_buffer(packets * self.packet_size)
+            try:
+                n = self.endpoint.read(buf, timeout=STREAM_TIMEOUT)
+            except usb.core.USBError as e:
+                if not _is_timeout(e):
+                    raise
+                n = 0
+            self.receive_buffer.append(memoryview(buf)[:n])
+        return self.receive_buffer.read_view(size)
+
+    def _transfer_buffer(self, size):
+        buf = self.transfer_buffers.get(size)
+        if buf is None:
+            buf = array.array('B', bytes(size))
+            self.transfer_buffers[size] = buf
+        return buf
 
     def _fill_receive_buffer(self, size):
-        while(len(self.receive_buffer) < size):
-            raw_data = self.endpoint.read(0x10, timeout=self.timeout)
-            data = raw_data.tobytes()
-            self.receive_buffer.extend(data)
+        while len(self.receive_buffer) < size:
+            # Request whole packets covering the missing data, in a single transfer:
+            # the device ends it with a short packet, so it never waits for more data than asked
+            missing = size - len(self.receive_buffer)
+            packets = min(-(-missing // self.packet_size), MAX_TRANSFER // self.packet_size)
+            buf = self._transfer_buffer(packets * self.packet_size)
+            timeout = self.read_timeout if packets == 1 else self.bulk_read_timeout
+            n = self._transfer(timeout, self.endpoint.read, buf)
+            self.receive_buffer.append(memoryview(buf)[:n])
 
     def flush(self):
+        """
+        Drops the received data and drains the endpoint: a late response left there
+        would be read as the response to the next command
+        """
         self.receive_buffer.clear()
-        try:
-            self.endpoint.read(0x10, timeout=self.timeout)
-        except:
-            pass
+        for _ in range(FLUSH_READS):
+            try:
+                if not len(self.endpoint.read(MAX_TRANSFER, timeout=FLUSH_TIMEOUT)):
+                    return
+            except:
+                return
     
     def close(self):
         pass
 
 
-def get_connection(connection_type: str=CONNECTION_TYPE_USB, port_name: str=None):
+def read_some(connection, size: int=1):
+    """
+    Up to size bytes of a connection as soon as some are received, empty when nothing
+    comes for a while: read_some() of the connections providing it, pyserial ports
+    returning what they already received or the next byte
+    """
+    reader = getattr(connection, "read_some", None)
+    if reader is not None:
+        return reader(size)
+    return connection.read(max(1, min(size, getattr(connection, "in_waiting", 1))))
+
+
+def get_connection(connection_type: str=CONNECTION_TYPE_USB, port_name: str=None, **kwargs):
     if connection_type == CONNECTION_TYPE_USB:
-        return USBSerial()
+        # With several loggers attached, port_name is the USB address of one of them
+        return USBSerial(find_usb_device(port_name) if port_name else None)
     elif port_name and connection_type == CONNECTION_TYPE_SERIAL:
         return serial.Serial(port_name, 9600)
+    elif connection_type == CONNECTION_TYPE_SIMULATOR:
+        # kwargs are forwarded to the simulated device (model, num_records, latency...)
+        import simulator
+        return simulator.SimulatedDevice(**kwargs)
+    elif port_name and connection_type == CONNECTION_TYPE_REPLAY:
+        # port_name is a trace written by recording.RecordingConnection, kwargs are the replay speed
+        import recording
+        return recording.ReplayConnection(port_name, **kwargs)
     
     raise Exception("Unable to find connection type %s on port %s", connection_type, port_name)
@@ -0,0 +1,371 @@
+import logging
+import os.path
+from itertools import chain, islice
+from operator import attrgetter
+
+import gtbatch
+import pygotu
+
+log = logging.getLogger(__name__)
+
+# Number of points formatted at once
+CHUNK_POINTS = 4096
+
+# Point fields, in the order of the columns handed to the writers
+COLUMNS = ('lat', 'lon', 'elevation', 'isotime', 'sat', 'speed', 'course', 'ehpe')
+_get_columns = attrgetter(*COLUMNS)
+
+
+def _track_name(first_time) -> str:
+    return "Track {:%Y/%m/%d %H:%M:%S}".format(first_time)
+
+
+def batch_track_name(batch) -> str:
+    return _track_name(pygotu.epoch_ms_to_datetime(int(batch.epoch_ms[0])) - pygotu.LOCAL_OFFSET)
+
+
+def record_columns(records) -> dict:
+    """
+    Columns of a sequence of records, as lists of Python values
+    """
+    return dict(zip(COLUMNS, zip(*map(_get_columns, records))))
+
+
+def batch_columns(batch) -> dict:
+    """
+    Columns of a gtbatch.RecordBatch, converted to lists of Python values in bulk
+    """
+    import numpy as np
+    isotime = np.char.add(np.datetime_as_string(batch.epoch_ms.astype('datetime64[ms]'), unit='ms'), '000Z')
+    return {
+        'lat': batch.lat.tolist(),
+        'lon': batch.lon.tolist(),
+        'elevation': batch.elevation.tolist(),
+        'isotime': isotime.tolist(),
+        'sat': batch.sat.tolist(),
+        'speed': batch.speed.tolist(),
+        'course': batch.course.tolist(),
+        'ehpe': batch.ehpe.tolist(),
+    }
+
+
+class TrackWriter:
+    """
+    Base of the export formats. Points are formatted by chunks of CHUNK_POINTS:
+    the point template of the format is repeated for the whole chunk and filled
+    with a single % operation, then written at once.
+    Subclasses define the header, footer, track and point templates, and the
+    columns filling the point template.
+    With collect_stats(), the trackstats.TrackStats of the points written are
+    accumulated per track in track_stats, as (name, TrackStats) pairs.
+    """
+    __slots__ = ['f', 'track_idx', 'track_points', 'num_points', 'stats', 'track_stats']
+
+    extension = None
+    header = ""
+    footer = ""
+    # Formatted with the track index and name
+    track_start = ""
+    track_end = ""
+    point = ""
+    point_columns = ()
+
+    def __init__(self, f):
+        self.f = f
+        self.track_idx = 0
+        self.track_points = 0
+        self.num_points = 0
+        # stats.Stats collecting the export and decoding times
+        self.stats = None
+        self.track_stats = None
+
+    def collect_stats(self):
+        self.track_stats = []
+
+    def _start_stats(self, name: str):
+        if self.track_stats is not None:
+            import trackstats
+            self.track_stats.append((name, trackstats.TrackStats()))
+
+    def _add_stats(self, batch):
+        """
+        Adds the points of a batch, as columns, to the statistics of the current track
+        """
+        if self.track_stats is not None:
+            self.track_stats[-1][1].add(batch)
+
+    def begin(self):
+        self.f.write(self.header)
+
+    def end(self):
+        self.f.write(self.footer)
+
+    def begin_track(self, name: str):
+        self.track_points = 0
+        self._start_stats(name)
+        self.f.write(self.track_start.format(idx=self.track_idx, name=name))
+
+    def end_track(self):
+        self.f.write(self.track_end.format(idx=self.track_idx))
+        self.track_idx += 1
+
+    def _format_points(self, columns: dict, n: int) -> str:
+        values = tuple(chain.from_iterable(zip(*[columns[name] for name in self.point_columns])))
+        return (self.point * n) % values
+
+    def write_columns(self, columns: dict):
+        """
+        Writes points of the current track, given as columns (see COLUMNS)
+        """
+        n = len(columns['lat'])
+        if n == 0:
+            return
+        if self.stats is None:
+            self._write_points(columns, n)
+        else:
+            with self.stats.timer("export"):
+                self._write_points(columns, n)
+        self.track_points += n
+        self.num_points += n
+
+    def _write_points(self, columns: dict, n: int):
+        self.f.write(self._format_points(columns, n))
+
+    def _write_waypoints(self, batch):
+        self._add_stats(batch)
+        for start in range(0, len(batch), CHUNK_POINTS):
+            self.write_columns(batch_columns(batch.select(slice(start, start + CHUNK_POINTS))))
+
+    def write_batch(self, batch):
+        """
+        Writes the valid waypoints of a gtbatch.RecordBatch to the current track
+        """
+        self._write_waypoints(batch.waypoints())
+
+    def write_records(self, records):
+        """
+        Writes the valid waypoints of an iterable of records to the current track
+        """
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, CHUNK_POINTS))
+            if not chunk:
+                return
+            if self.stats is None:
+                batch = gtbatch.decode_records(chunk)
+            else:
+                with self.stats.timer("decode"):
+                    batch = gtbatch.decode_records(chunk)
+            if batch is not None:
+                # Records held in page buffers are written and accumulated as columns
+                self._write_waypoints(batch.waypoints())
+                continue
+            if self.stats is None:
+                points = [rec for rec in chunk if rec.valid and rec.is_waypoint]
+                columns = record_columns(points)
+            else:
+                # Record fields are decoded when accessed
+                with self.stats.timer("decode"):
+                    points = [rec for rec in chunk if rec.valid and rec.is_waypoint]
+                    columns = record_columns(points)
+            if points:
+                self.write_columns(columns)
+                if self.track_stats is not None:
+                    self.track_stats[-1][1].add_waypoints(points)
+
+    def write_tracks(self, tracks):
+        """
+        Writes a whole file from tracks of records, like GTTrack or segment.StreamingTrack
+        """
+        self.begin()
+        for track in tracks:
+            self.begin_track(_track_name(track.first_time))
+            self.write_records(track)
+            self.end_track()
+            log.info("Imported track: %s", track)
+        self.end()
+
+    def write_batches(self, batches):
+        """
+        Writes a whole file with a single track from gtbatch.RecordBatch objects
+        """
+        self.begin()
+        started = False
+        for batch in batches:
+            batch = batch.waypoints()
+            if len(batch) == 0:
+                continue
+            if not started:
+                self.begin_track(batch_track_name(batch))
+                started = True
+            self._write_waypoints(batch)
+        if started:
+            self.end_track()
+        self.end()
+
+    def write_batch_tracks(self, batches):
+        """
+        Writes a whole file with a track per batch, like the archive.PointSet tracks of a query
+        """
+        self.begin()
+        for batch in batches:
+            batch = batch.waypoints()
+            if len(batch) == 0:
+                continue
+            self.begin_track(batch_track_name(batch))
+            self._write_waypoints(batch)
+            self.end_track()
+        self.end()
+
+
+class GPXWriter(TrackWriter):
+    __slots__ = []
+
+    extension = ".gpx"
+    header = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:pygotu="http://www.sunaga-lab.net/pygotu" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" creator="pygotu" version="1.1" xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">
+"""
+    footer = "</gpx>"
+    track_start = """  <trk>
+    <name>{name}</name>
+    <desc>pygotu imported track</desc>
+    <trkseg>
+"""
+    track_end = "    </trkseg>\n  </trk>\n"
+    point = """      <trkpt lat="%s" lon="%s">
+        <ele>%s</ele>
+        <time>%s</time>
+        <sat>%s</sat>
+        <extensions>
+          <pygotu:speed>%s</pygotu:speed>
+          <pygotu:course>%s</pygotu:course>
+          <pygotu:ehpe>%s</pygotu:ehpe>
+        </extensions>
+      </trkpt>
+"""
+    point_columns = COLUMNS
+
+
+class KMLWriter(TrackWriter):
+    __slots__ = []
+
+    extension = ".kml"
+    header = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <Document>
+    <name>pygotu</name>
+"""
+    footer = "  </Document>\n</kml>\n"
+    track_start = """    <Placemark>
+      <name>{name}</name>
+      <LineString>
+        <altitudeMode>absolute</altitudeMode>
+        <coordinates>
+"""
+    track_end = "        </coordinates>\n      </LineString>\n    </Placemark>\n"
+    point = "%s,%s,%s\n"
+    point_columns = ('lon', 'lat', 'elevation')
+
+
+class CSVWriter(TrackWriter):
+    __slots__ = []
+
+    extension = ".csv"
+    header = "track,time,lat,lon,elevation,sat,speed,course,ehpe\n"
+
+    def _format_points(self, columns: dict, n: int) -> str:
+        point = "{},%s,%s,%s,%s,%s,%s,%s,%s\n".format(self.track_idx)
+        values = tuple(chain.from_iterable(zip(
+            columns['isotime'], columns['lat'], columns['lon'], columns['elevation'],
+            columns['sat'], columns['speed'], columns['course'], columns['ehpe'])))
+        return (point * n) % values
+
+
+class GeoJSONWriter(TrackWriter):
+    """
+    FeatureCollection with a LineString feature per track, the point times being
+    in its coordTimes property. The coordinates are streamed, the times of the
+    current track are kept formatted until its end.
+    """
+    __slots__ = ['times']
+
+    extension = ".geojson"
+    header = '{"type":"FeatureCollection","features":[\n'
+    footer = "\n]}\n"
+    track_start = '{{"type":"Feature","geometry":{{"type":"LineString","coordinates":['
+    point = ",[%s,%s,%s]"
+    point_columns = ('lon', 'lat', 'elevation')
+
+    def __init__(self, f):
+        super().__init__(f)
+        self.times = []
+
+    def begin_track(self, name: str):
+        if self.track_idx:
+            self.f.write(",\n")
+        super().begin_track(name)
+        self.times = ['"name":"{}","coordTimes":['.format(name)]
+
+    def _write_points(self, columns: dict, n: int):
+        points = self._format_points(columns, n)
+        times = (',"%s"' * n) % tuple(columns['isotime'])
+        if self.track_points == 0:
+            points = points[1:]
+            times = times[1:]
+        self.f.write(points)
+        self.times.append(times)
+
+    def end_track(self):
+        self.f.write(']},"properties":{')
+        self.f.write("".join(self.times))
+        self.f.write("]}}")
+        self.times = []
+        self.track_idx += 1
+
+
+WRITERS = {
+    "gpx": GPXWriter,
+    "geojson": GeoJSONWriter,
+    "csv": CSVWriter,
+    "kml": KMLWriter,
+}
+
+# Compact binary format of trackfile, written to files opened in binary mode
+TRACK_FILE_FORMAT = "gtt"
+TRACK_FILE_EXTENSION = ".gtt"
+
+FORMATS = sorted(WRITERS) + [TRACK_FILE_FORMAT]
+
+
+def format_for(path: str, export_format: str=None) -> str:
+    """
+    Given format, or the format matching the extension of path, GPX by default
+    """
+    if export_format is not None:
+        return export_format
+    extension = os.path.splitext(path)[1].lower()
+    if extension == TRACK_FILE_EXTENSION:
+        return TRACK_FILE_FORMAT
+    return next((name for name, writer in WRITERS.items() if writer.extension == extension), "gpx")
+
+
+def extension_for(export_format: str=None) -> str:
+    if export_format == TRACK_FILE_FORMAT:
+        return TRACK_FILE_EXTENSION
+    return WRITERS[export_format or "gpx"].extension
+
+
+def is_binary(export_format: str) -> bool:
+    return export_format == TRACK_FILE_FORMAT
+
+
+def writer_for(f, path: str, export_format: str=None) -> TrackWriter:
+    """
+    Writer of the given format, or of the format matching the extension of path, GPX by default.
+    f is opened in binary mode for the formats for which is_binary() is True.
+    """
+    export_format = format_for(path, export_format)
+    if export_format == TRACK_FILE_FORMAT:
+        import trackfile
+        return trackfile.TrackFileWriter(f)
+    return WRITERS[export_format](f)
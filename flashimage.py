@@ -0,0 +1,259 @@
+import logging
+import mmap
+import os
+import time
+from struct import calcsize, pack, unpack_from
+
+import pygotu
+
+log = logging.getLogger(__name__)
+
+IMAGE_MAGIC = b"GTFI"
+IMAGE_VERSION = 1
+
+# magic, version, model code, record size, device serial, record count, page size,
+# number of stored pages, capacity of the page map, creation time (epoch ms)
+HEADER_FORMAT = ">4sBBHIIIIIQ"
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+# The page map lists the flash page number of each stored page
+PAGE_MAP_ENTRY = ">I"
+PAGE_MAP_ENTRY_SIZE = calcsize(PAGE_MAP_ENTRY)
+
+
+def _data_offset(map_capacity: int) -> int:
+    # Pages are aligned on the page size, so they are aligned in the memory map too
+    size = HEADER_SIZE + map_capacity * PAGE_MAP_ENTRY_SIZE
+    return -(-size // pygotu.PAGE_SIZE) * pygotu.PAGE_SIZE
+
+
+class FlashImageWriter:
+    """
+    Writes the raw flash pages read from a device to a self-describing image.
+    The image is written to a temporary file, renamed once complete.
+    """
+    __slots__ = ['path', 'tmp_path', 'f', 'serial', 'model_code', 'num_records', 'page_map',
+                 'map_capacity']
+
+    def __init__(self, path: str, serial: int, model_code: int, num_records: int):
+        self.path = path
+        self.tmp_path = path + ".part"
+        self.serial = serial
+        self.model_code = model_code
+        self.num_records = num_records
+        self.page_map = []
+        self.map_capacity = -(-num_records // pygotu.RECORDS_PER_PAGE)
+        self.f = open(self.tmp_path, "wb")
+        self.f.seek(_data_offset(self.map_capacity))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_page(self, page: int, buf):
+        if len(self.page_map) >= self.map_capacity:
+            raise Exception("Image page map is full: {} pages".format(self.map_capacity))
+        self.f.write(bytes(buf).ljust(pygotu.PAGE_SIZE, b"\xff"))
+        self.page_map.append(page)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(pack(HEADER_FORMAT, IMAGE_MAGIC, IMAGE_VERSION, self.model_code, pygotu.RECORD_SIZE,
+                          self.serial, self.num_records, pygotu.PAGE_SIZE, len(self.page_map),
+                          self.map_capacity, int(time.time() * 1000)))
+        for page in self.page_map:
+            self.f.write(pack(PAGE_MAP_ENTRY, page))
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+        log.info("Wrote %s pages to %s", len(self.page_map), self.path)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp_path)
+
+
+class FlashImage:
+    """
+    Memory mapped flash image: pages are handed out as memoryviews of the map,
+    so images larger than the memory can be decoded
+    """
+    __slots__ = ['path', 'f', 'map', 'view', 'serial', 'model_code', 'num_records', 'created',
+                 'pages', 'page_numbers', 'data_offset']
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, "rb")
+        if os.fstat(self.f.fileno()).st_size < HEADER_SIZE:
+            self.f.close()
+            raise Exception("Not a flash image: {}".format(path))
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        try:
+            num_pages, map_capacity = self._read_header()
+        except Exception:
+            self.close()
+            raise
+
+        self.data_offset = _data_offset(map_capacity)
+        self.pages = {}
+        for i in range(num_pages):
+            page, = unpack_from(PAGE_MAP_ENTRY, self.map, HEADER_SIZE + i * PAGE_MAP_ENTRY_SIZE)
+            self.pages[page] = self.data_offset + i * pygotu.PAGE_SIZE
+        self.page_numbers = sorted(self.pages)
+
+    def _read_header(self) -> tuple:
+        """
+        Reads and checks the header, returning the number of stored pages and the page map capacity
+        """
+        (magic, version, self.model_code, record_size, self.serial, self.num_records, page_size,
+         num_pages, map_capacity, self.created) = unpack_from(HEADER_FORMAT, self.map)
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+            raise Exception("Not a flash image: {}".format(self.path))
+        if record_size != pygotu.RECORD_SIZE or page_size != pygotu.PAGE_SIZE:
+            raise Exception("Unsupported flash layout: {}/{}".format(record_size, page_size))
+        if num_pages > map_capacity:
+            raise Exception("Corrupted flash image {}: {} pages for a map of {}".format(
+                self.path, num_pages, map_capacity))
+        if len(self.map) < _data_offset(map_capacity) + num_pages * pygotu.PAGE_SIZE:
+            raise Exception("Truncated flash image {}: {} bytes for {} pages".format(
+                self.path, len(self.map), num_pages))
+        return num_pages, map_capacity
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Records still reference pages, the map is closed once they are collected
+            log.debug("Flash image %s still in use", self.path)
+        self.f.close()
+
+    def read(self, pos: int, size: int) -> memoryview:
+        """
+        Flash content at pos, None when the page was not dumped
+        """
+        page, offset = divmod(pos, pygotu.PAGE_SIZE)
+        start = self.pages.get(page)
+        if start is None:
+            return None
+        size = min(size, pygotu.PAGE_SIZE - offset)
+        return self.view[start + offset:start + offset + size]
+
+    def __str__(self):
+        return "{}: serial {:08x} model {} records {} pages {}".format(
+            self.path, self.serial, pygotu.MODELS.get(self.model_code, ("unknown",))[0],
+            self.num_records, len(self.pages))
+
+
+class ImageConnection:
+    """
+    Connection of an ImageDev: there is no device behind an image, the commands
+    that ImageDev does not answer from it fail instead of being sent
+    """
+    __slots__ = ['path']
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, data):
+        raise Exception("Device commands cannot be run on the flash image {}".format(self.path))
+
+    def read(self, size=1):
+        raise Exception("Device commands cannot be run on the flash image {}".format(self.path))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ImageDev(pygotu.GT200Dev):
+    """
+    GT200Dev reading a flash image instead of a device, so that all_records(),
+    all_tracks() and the other download methods decode it offline
+    """
+    __slots__ = ['image']
+
+    def __init__(self, image: FlashImage):
+        super().__init__(ImageConnection(image.path))
+        self.image = image
+        self.serial = image.serial
+        self.model_code = image.model_code
+        self.model_info = pygotu.MODELS.get(image.model_code, pygotu.MODELS[0x13])
+        # The pages were validated when dumped
+        self.validator = None
+
+    def close(self):
+        self.image.close()
+
+    def nmea_switch(self, mode: int) -> None:
+        pass
+
+    def identify(self):
+        return self.serial
+
+    def model(self):
+        log.info("Image of device: %s", self.model_info[0])
+
+    def count(self) -> int:
+        return self.image.num_records
+
+    def flash_read(self, pos: int=0, size: int=0x1000) -> memoryview:
+        return self.image.read(pos, size)
+
+    def read_page(self, page: int) -> memoryview:
+        buf = self.image.read(page * pygotu.PAGE_SIZE, pygotu.PAGE_SIZE)
+        if buf is None:
+            raise Exception("Page {} is not in the image {}".format(page, self.image.path))
+        return buf
+
+    def _find_stored_page(self, epoch_ms: int) -> int:
+        """
+        Same as find_page, among the stored pages: index of the last one starting
+        at or before epoch_ms
+        """
+        pages = self.image.page_numbers
+        lo, hi = 0, len(pages) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            first_time = self.page_first_time(pages[mid])
+            if first_time is None or first_time > epoch_ms:
+                hi = mid - 1
+            else:
+                lo = mid
+        return lo
+
+    def all_pages(self, cache=None, window: pygotu.TimeWindow=None):
+        """
+        Yields the pages stored in the image, which may only cover a time window.
+        There is nothing to cache: the pages are views of the memory map.
+        """
+        num_rec_all = self.count()
+        pages = self.image.page_numbers
+        first, last = 0, len(pages)
+        if window is not None and pages:
+            if window.since is not None:
+                first = self._find_stored_page(window.since)
+            if window.until is not None:
+                last = self._find_stored_page(window.until) + 1
+
+        for i, page in enumerate(pages[first:last], 1):
+            first_idx = (page - 1) * pygotu.RECORDS_PER_PAGE
+            n = min(pygotu.RECORDS_PER_PAGE, num_rec_all - first_idx)
+            yield first_idx, self.read_page(page)[:n * pygotu.RECORD_SIZE]
+            if self.progress:
+                self.progress(i * pygotu.RECORDS_PER_PAGE, (last - first) * pygotu.RECORDS_PER_PAGE)
+
+    def transaction(self, cmd1, cmd2, fmt=None):
+        raise Exception("Flash images are read only")
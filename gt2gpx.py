@@ -1,47 +1,155 @@
 import argparse
+import datetime
+import json
 import logging
 import os
 import os.path
+import re
 import sys
+import time
 
-import pygotu
+import archive
 import connections
+import export
+import flashimage
+import integrity
+import journal
+import multidevice
+import nmea
+import pagecache
+import pipeline
+import pygotu
+import recording
+import simplify
+import stats
+import trackfile
+import trackstats
 
 log = logging.getLogger(__name__)
 
 ACTION_GET = "get"
 ACTION_PURGE = "purge"
+ACTION_DUMP = "dump"
+ACTION_LIST = "list"
+ACTION_ARCHIVE = "archive"
+ACTION_QUERY = "query"
+ACTION_CONVERT = "convert"
+ACTION_LIVE = "live"
+
+DEVICES_ALL = "all"
+
+STATS_TEXT = "text"
+STATS_JSON = "json"
+
+TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_time(value: str) -> int:
+    """
+    Parses a local date and time, or a duration before now like "12h" or "2d", to epoch ms
+    """
+    match = re.match(r"^(\d+(?:\.\d*)?)([smhd])$", value)
+    if match:
+        return int((time.time() - float(match.group(1)) * DURATION_UNITS[match.group(2)]) * 1000)
+
+    for time_format in TIME_FORMATS:
+        try:
+            local_time = datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return pygotu.datetime_to_epoch_ms(local_time + pygotu.LOCAL_OFFSET)
+    raise argparse.ArgumentTypeError("invalid date, time or duration: {}".format(value))
+
+
+def parse_positive(value: str) -> float:
+    """
+    Parses a number greater than 0
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0.0
+    if not number > 0:
+        raise argparse.ArgumentTypeError("expected a number greater than 0: {}".format(value))
+    return number
+
+
+def parse_bbox(value: str) -> tuple:
+    """
+    Parses a bounding box given as min_lat,min_lon,max_lat,max_lon in degrees
+    """
+    try:
+        lat1, lon1, lat2, lon2 = (float(v) for v in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid bounding box, expected lat1,lon1,lat2,lon2: {}".format(value))
+    return min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2)
+
+
+def _add_split_arguments(parser):
+    parser.add_argument("--split-gap", type=float,
+                        help="Start a new track after a gap longer than this, in seconds")
+    parser.add_argument("--split-distance", type=float,
+                        help="Start a new track after a jump longer than this, in m")
+    parser.add_argument("--split-flags", action='store_true',
+                        help="Start and end tracks on the TSTART/TSTOP point flags")
+
+
+def _add_cache_arguments(parser):
+    parser.add_argument("--cache", action='store_true',
+                        help="Keep the flash pages in a local cache, to only download the new records. Only the "
+                             "last cached record is checked against the device: a device modified by another "
+                             "tool may be served stale pages")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="Directory of the page cache, implying --cache ({} by default)".format(
+                            pagecache.default_directory()))
+
+
+def _cache_directory(arguments) -> str:
+    if arguments.cache_dir:
+        return arguments.cache_dir
+    return pagecache.default_directory() if arguments.cache else None
 
-GPXDATA_START = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:pygotu="http://www.sunaga-lab.net/pygotu" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" creator="pygotu" version="1.1" xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">
-"""
 
-GPXDATA_TRACK = """  <trk>
-    <name>{trackname}</name>
-    <desc>pygotu imported track</desc>
-    <trkseg>
-"""
+def _add_track_stats_argument(parser):
+    parser.add_argument("--track-stats", action='store_true',
+                        help="Save the distance, moving time, speeds, elevation gain and loss and satellites "
+                             "of each track written to DEST{}, measured on the recorded points "
+                             "before any simplification".format(trackstats.STATS_EXTENSION))
 
-GPXDATA_RECORD = """      <trkpt lat="{0.lat}" lon="{0.lon}">
-        <ele>{0.elevation}</ele>
-        <time>{0.datetime:%Y-%m-%dT%H:%M:%S.%fZ}</time>
-        <sat>{0.sat}</sat>
-        <extensions>
-          <pygotu:speed>{0.speed}</pygotu:speed>
-          <pygotu:course>{0.course}</pygotu:course>
-          <pygotu:ehpe>{0.ehpe}</pygotu:ehpe>
-        </extensions>
-      </trkpt>
-"""
 
-GPXDATA_TRACK_END = "    </trkseg>\n  </trk>\n"
-GPXDATA_END = "</gpx>"
+def _add_simplify_arguments(parser):
+    parser.add_argument("--simplify", type=float, metavar="METRES",
+                        help="Simplify the tracks, keeping them within this distance of the points, in m")
+    parser.add_argument("--simplify-method", choices=simplify.METHODS, default=simplify.METHOD_DOUGLAS_PEUCKER,
+                        help="Simplification algorithm: Douglas-Peucker (dp) or Visvalingam-Whyatt (vw)")
+    parser.add_argument("--resample", type=parse_positive, metavar="SECONDS",
+                        help="Keep at most one point per interval of this duration, in seconds")
+    parser.add_argument("--drop-jitter", action='store_true',
+                        help="Drop the points moving within their position error while stationary")
+    parser.add_argument("--jitter-speed", type=float, default=simplify.STATIONARY_SPEED,
+                        help="Speed below which a point is stationary for --drop-jitter, in km/h")
 
 
 def _parse_arguments():
     parser = argparse.ArgumentParser(description='iGotU GPS manipulation tool')
     parser.add_argument("--verbose", "-v", action='store_const', const=logging.DEBUG,
                         default=logging.INFO, help="Display debugging information in the output")
+    parser.add_argument("--stats", action='store_true',
+                        help="Print the protocol statistics of the action: command counts and latencies, "
+                             "transfers, timeouts, retries, decoding and export times")
+    parser.add_argument("--stats-format", choices=[STATS_TEXT, STATS_JSON], default=STATS_TEXT,
+                        help="Format of the --stats output")
+
+    parser.add_argument("--no-check", action='store_true',
+                        help="Do not check the flash pages read, nor read the suspect ones again")
+    parser.add_argument("--reread-budget", type=int, default=integrity.DEFAULT_REREAD_BUDGET,
+                        help="Maximum number of suspect page re-reads per device")
+    parser.add_argument("--record",
+                        help="Record the transfers with the device to a trace file, to be replayed with --replay")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="Speed factor of --replay: 1 to take the recorded transfer durations, "
+                             "0 not to wait at all")
 
     # Connection type
     group = parser.add_mutually_exclusive_group()
@@ -49,51 +157,416 @@ def _parse_arguments():
                        help="Connect to the device using USB")
     group.add_argument('--serial',
                        help="Connect to the device using the specified serial port")
+    group.add_argument('--image',
+                       help="Read a flash image written by the dump action instead of a device")
+    group.add_argument('--replay',
+                       help="Play back a trace written by --record instead of a device")
+    group.add_argument('--devices', nargs='?', const=DEVICES_ALL,
+                       help="Run the action on several USB loggers in parallel: all of them, or a comma "
+                            "separated list of USB addresses (bus-port) and serials. The destination "
+                            "is then a directory, holding a file per serial")
 
     # Actions
     subparsers = parser.add_subparsers(dest="action", help='sub-command help')
 
     parser_get = subparsers.add_parser(ACTION_GET, help='Download track from GPS logger')
-    parser_get.add_argument("dest", help="Destination GPX file")
+    parser_get.add_argument("dest", help="Destination file")
+    parser_get.add_argument("--format", choices=export.FORMATS,
+                            help="Format of the destination file, guessed from its extension by default (GPX)")
+    _add_cache_arguments(parser_get)
+    parser_get.add_argument("--no-resume", action='store_true',
+                            help="Download from the first page again, discarding the journal of an "
+                                 "interrupted download to the same destination. With --cache, the pages "
+                                 "are kept in the cache instead of a journal: an interrupted download "
+                                 "resumes from the cache, which --no-resume does not discard")
+    parser_get.add_argument("--since", type=parse_time,
+                            help="Only download records from this local time (YYYY-MM-DD[THH:MM[:SS]]) "
+                                 "or duration before now (30m, 12h, 2d...)")
+    parser_get.add_argument("--until", type=parse_time,
+                            help="Only download records up to this local time or duration before now")
+    _add_split_arguments(parser_get)
+    _add_simplify_arguments(parser_get)
+    _add_track_stats_argument(parser_get)
+    parser_get.add_argument("--pipeline", action='store_true',
+                            help="Overlap the device transfers with the decoding and the GPX writing")
+    parser_get.add_argument("--decode-processes", type=int, default=0,
+                            help="With --pipeline, number of processes decoding the flash pages. "
+                                 "0 by default, decoding them in a thread, which is faster unless "
+                                 "the decoding dominates")
 
     subparsers.add_parser(ACTION_PURGE, help='Clear GPS logger memory')
 
+    parser_dump = subparsers.add_parser(ACTION_DUMP, help='Save the raw flash of the GPS logger to an image')
+    parser_dump.add_argument("dest", help="Destination image file")
+    parser_dump.add_argument("--since", type=parse_time,
+                             help="Only save the pages holding records from this local time or duration before now")
+    parser_dump.add_argument("--until", type=parse_time,
+                             help="Only save the pages holding records up to this local time or duration before now")
+
+    subparsers.add_parser(ACTION_LIST, help='List the attached USB loggers')
+
+    parser_archive = subparsers.add_parser(
+        ACTION_ARCHIVE, help='Add the tracks of GPS loggers to a local archive, skipping the points already in it')
+    parser_archive.add_argument("db", help="Archive database file, created if needed")
+    _add_cache_arguments(parser_archive)
+    parser_archive.add_argument("--since", type=parse_time,
+                                help="Only archive records from this local time or duration before now")
+    parser_archive.add_argument("--until", type=parse_time,
+                                help="Only archive records up to this local time or duration before now")
+    _add_split_arguments(parser_archive)
+
+    parser_query = subparsers.add_parser(ACTION_QUERY, help='Export the archived points of an area or a period')
+    parser_query.add_argument("db", help="Archive database file")
+    parser_query.add_argument("dest", help="Destination file")
+    parser_query.add_argument("--format", choices=export.FORMATS,
+                              help="Format of the destination file, guessed from its extension by default (GPX)")
+    parser_query.add_argument("--bbox", type=parse_bbox,
+                              help="Only export the points within this box: lat1,lon1,lat2,lon2 in degrees")
+    parser_query.add_argument("--since", type=parse_time,
+                              help="Only export points from this local time or duration before now")
+    parser_query.add_argument("--until", type=parse_time,
+                              help="Only export points up to this local time or duration before now")
+    parser_query.add_argument("--device", type=lambda value: int(value, 16),
+                              help="Only export the points of the logger with this serial, in hexadecimal")
+    _add_simplify_arguments(parser_query)
+    _add_track_stats_argument(parser_query)
+
+    parser_convert = subparsers.add_parser(
+        ACTION_CONVERT, help='Convert a compact track file (.gtt) or a GPX file to another format')
+    parser_convert.add_argument("source", help="Track file or GPX file")
+    parser_convert.add_argument("dest", help="Destination file")
+    parser_convert.add_argument("--format", choices=export.FORMATS,
+                                help="Format of the destination file, guessed from its extension by default (GPX)")
+    parser_convert.add_argument("--since", type=parse_time,
+                                help="Only convert points from this local time or duration before now")
+    parser_convert.add_argument("--until", type=parse_time,
+                                help="Only convert points up to this local time or duration before now")
+    _add_simplify_arguments(parser_convert)
+    _add_track_stats_argument(parser_convert)
+
+    parser_live = subparsers.add_parser(
+        ACTION_LIVE, help='Switch the GPS logger to the GPS dongle mode and print its live positions')
+    parser_live.add_argument("--count", type=int,
+                             help="Stop after this number of positions, run until interrupted by default")
+    parser_live.add_argument("--max-fixes", type=int, default=nmea.DEFAULT_MAX_FIXES,
+                             help="Positions kept when the output falls behind, the oldest ones being dropped")
+
     return parser.parse_args()
 
 
-def _init_device(connection) -> pygotu.GT200Dev:
-    dev = pygotu.GT200Dev(connection)
-    dev.nmea_switch(pygotu.MODE_CONFIGURE)
-    dev.identify()
-    dev.model()
+def _time_window(arguments) -> pygotu.TimeWindow:
+    if arguments.since is None and arguments.until is None:
+        return None
+    return pygotu.TimeWindow(arguments.since, arguments.until)
+
+
+def _split_rules(arguments) -> dict:
+    return {
+        "max_gap": arguments.split_gap,
+        "max_jump": arguments.split_distance,
+        "split_on_flags": arguments.split_flags,
+    }
+
+
+def _simplifier(arguments) -> simplify.TrackSimplifier:
+    if arguments.simplify is None and arguments.resample is None and not arguments.drop_jitter:
+        return None
+    return simplify.TrackSimplifier(arguments.simplify, arguments.simplify_method, arguments.resample,
+                                    arguments.drop_jitter, arguments.jitter_speed)
+
+
+def _init_device(connection, sync_stats: stats.Stats=None,
+                 validator: integrity.PageValidator=None) -> pygotu.GT200Dev:
+    if isinstance(connection, flashimage.FlashImage):
+        dev = flashimage.ImageDev(connection)
+        if sync_stats is not None:
+            dev.attach_stats(sync_stats)
+    else:
+        # Attached before opening the device, so that the whole session is counted
+        dev = pygotu.open_device(connection, sync_stats)
+        dev.validator = validator
     return dev
 
 
-def download_track(connection, destination_file: str):
-    with _init_device(connection) as dev:
-        #log.debug("numData: %s", dev.count())
+def _validator(arguments) -> integrity.PageValidator:
+    return None if arguments.no_check else integrity.PageValidator(arguments.reread_budget)
+
+
+def _log_integrity(dev: pygotu.GT200Dev):
+    if dev.validator is not None and dev.validator.pages:
+        log.info("Integrity of device %08x: %s", dev.serial, dev.validator)
+
+
+def write_gpx(f, tracks):
+    export.GPXWriter(f).write_tracks(tracks)
 
-        with open(destination_file, "w") as f:
-            f.write(GPXDATA_START)
 
-            for track in dev.all_tracks():
-                log.info("Importing track: %s", track)
-                trackname = "Track {0.first_time:%Y/%m/%d %H:%M:%S}".format(track)
-                f.write(GPXDATA_TRACK.format(trackname = trackname))
-                
-                for rec in track.records:
-                    if not rec.valid or not rec.is_waypoint:
-                        continue
-                    data = GPXDATA_RECORD.format(rec)
-                    f.write(data)
+def download_track(connection, destination_file: str, cache_directory: str=None,
+                   pipelined: bool=False, decode_processes: int=0, split_rules: dict=None,
+                   window: pygotu.TimeWindow=None, export_format: str=None, sync_stats: stats.Stats=None,
+                   resumable: bool=True, validator: integrity.PageValidator=None,
+                   simplifier: simplify.TrackSimplifier=None, track_stats: bool=False):
+    with _init_device(connection, sync_stats, validator) as dev:
+        download_device(dev, destination_file, cache_directory, pipelined, decode_processes,
+                        split_rules, window, export_format, resumable, simplifier, track_stats)
 
-                f.write(GPXDATA_TRACK_END)
-            f.write(GPXDATA_END)
 
+def _open_journal(dev: pygotu.GT200Dev, destination_file: str, resumable: bool) -> journal.DownloadJournal:
+    path = journal.journal_path(destination_file)
+    if not resumable:
+        if os.path.exists(path):
+            log.info("Discarding the journal of the interrupted download: %s", path)
+            os.remove(path)
+        return None
+    return journal.DownloadJournal(dev.serial, path)
 
-def purge(connection):
-    with _init_device(connection) as dev:
-        dev.purge_all_120()
+
+def _write_tracks(writer: export.TrackWriter, tracks, simplifier: simplify.TrackSimplifier=None,
+                  download: pipeline.DownloadPipeline=None):
+    """
+    Writes tracks, with the writer stage of a download pipeline when given
+    """
+    if simplifier is None:
+        if download is None:
+            writer.write_tracks(tracks)
+        else:
+            download.write_tracks(writer, tracks)
+        return
+    if download is None:
+        writer.write_batch_tracks(simplifier.process_tracks(tracks))
+    else:
+        download.write_batch_tracks(writer, simplifier.process_tracks(tracks))
+    log.info("Tracks simplified: %s", simplifier)
+
+
+def download_device(dev: pygotu.GT200Dev, destination_file: str, cache_directory: str=None,
+                    pipelined: bool=False, decode_processes: int=0, split_rules: dict=None,
+                    window: pygotu.TimeWindow=None, export_format: str=None, resumable: bool=True,
+                    simplifier: simplify.TrackSimplifier=None, track_stats: bool=False):
+    """
+    Downloads the tracks of a device to destination_file, written to a temporary file renamed
+    once complete. Without a page cache, which already keeps the downloaded pages synced to
+    disk, they are journaled: an interrupted download to the same destination resumes from the last page read.
+    Ranged downloads and flash images are not journaled.
+    The tracks go through simplifier, when given, before being written. With track_stats,
+    the statistics of the tracks, before their simplification, are saved to a sidecar JSON file.
+    """
+    cache = pagecache.PageCache(dev.serial, cache_directory) if cache_directory else None
+    download_journal = None
+    if cache is None and window is None and not isinstance(dev, flashimage.ImageDev):
+        download_journal = _open_journal(dev, destination_file, resumable)
+    pages = cache if cache is not None else download_journal
+
+    tmp_file = destination_file + ".part"
+    try:
+        export_format = export.format_for(destination_file, export_format)
+        with open(tmp_file, "wb" if export.is_binary(export_format) else "w") as f:
+            writer = export.writer_for(f, destination_file, export_format)
+            writer.stats = dev.stats
+            if track_stats:
+                (writer if simplifier is None else simplifier).collect_stats()
+            if pipelined:
+                with dev.pipeline(pages, decode_processes=decode_processes, window=window) as download:
+                    _write_tracks(writer, download.stream_tracks(**(split_rules or {})), simplifier, download)
+            else:
+                _write_tracks(writer, dev.stream_tracks(pages, window, **(split_rules or {})), simplifier)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, destination_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        if download_journal is not None:
+            download_journal.close()
+            log.info("Download interrupted, run it again to resume it from %s records",
+                     download_journal.num_records)
+        raise
+    finally:
+        if cache:
+            cache.close()
+
+    if download_journal is not None:
+        download_journal.remove()
+    if track_stats:
+        trackstats.save_stats(destination_file, (writer if simplifier is None else simplifier).track_stats)
+    _log_integrity(dev)
+    if dev.retries:
+        log.info("Commands retried %s times", dev.retries)
+    if hasattr(dev.dev, "timeout_stats"):
+        log.debug("Transfer timeouts: %s", dev.dev.timeout_stats())
+    return destination_file
+
+
+def dump_flash(connection, destination_file: str, window: pygotu.TimeWindow=None,
+               sync_stats: stats.Stats=None, validator: integrity.PageValidator=None):
+    with _init_device(connection, sync_stats, validator) as dev:
+        dump_device(dev, destination_file, window)
+
+
+def dump_device(dev: pygotu.GT200Dev, destination_file: str, window: pygotu.TimeWindow=None):
+    num_records = dev.count()
+    with flashimage.FlashImageWriter(destination_file, dev.serial, dev.model_code, num_records) as image:
+        for first_idx, buf in dev.all_pages(window=window):
+            image.write_page(first_idx // pygotu.RECORDS_PER_PAGE + 1, buf)
+    log.info("Saved %s records of device %08x", num_records, dev.serial)
+    _log_integrity(dev)
+    return destination_file
+
+
+def archive_tracks(connection, db_file: str, cache_directory: str=None, split_rules: dict=None,
+                   window: pygotu.TimeWindow=None, sync_stats: stats.Stats=None,
+                   validator: integrity.PageValidator=None):
+    with _init_device(connection, sync_stats, validator) as dev:
+        return archive_device(dev, db_file, cache_directory, split_rules, window)
+
+
+def archive_device(dev: pygotu.GT200Dev, db_file: str, cache_directory: str=None, split_rules: dict=None,
+                   window: pygotu.TimeWindow=None) -> tuple:
+    """
+    Adds the tracks of a device to an archive, returning the numbers of tracks and points added
+    """
+    cache = pagecache.PageCache(dev.serial, cache_directory) if cache_directory else None
+    try:
+        with archive.TrackArchive(db_file) as track_archive:
+            added = track_archive.add_device(dev, cache, window, **(split_rules or {}))
+    finally:
+        if cache:
+            cache.close()
+    _log_integrity(dev)
+    return added
+
+
+def query_archive(db_file: str, destination_file: str, bbox: tuple=None, window: pygotu.TimeWindow=None,
+                  serial: int=None, export_format: str=None, simplifier: simplify.TrackSimplifier=None,
+                  track_stats: bool=False) -> int:
+    """
+    Exports the archived points matching the filters, a track per archived track,
+    simplified by simplifier when given. With track_stats, the statistics of the tracks,
+    before their simplification, are saved to a sidecar JSON file. Returns the number of
+    points written.
+    """
+    if not os.path.exists(db_file):
+        raise FileNotFoundError("No archive: {}".format(db_file))
+    with archive.TrackArchive(db_file) as track_archive:
+        points = track_archive.query_points(bbox, window, serial)
+    export_format = export.format_for(destination_file, export_format)
+    with open(destination_file, "wb" if export.is_binary(export_format) else "w") as f:
+        writer = export.writer_for(f, destination_file, export_format)
+        if track_stats:
+            (writer if simplifier is None else simplifier).collect_stats()
+        tracks = points.tracks() if len(points) else ()
+        writer.write_batch_tracks(tracks if simplifier is None else simplifier.process_batches(tracks))
+    log.info("Exported %s archived points in %s tracks", writer.num_points, writer.track_idx)
+    if track_stats:
+        trackstats.save_stats(destination_file, (writer if simplifier is None else simplifier).track_stats)
+    return writer.num_points
+
+
+def stream_fixes(connection, count: int=None, max_fixes: int=nmea.DEFAULT_MAX_FIXES, out=sys.stdout) -> nmea.NMEAStream:
+    """
+    Prints the live positions of a device, one line per fix
+    """
+    with nmea.NMEAStream(connection, max_fixes) as stream:
+        try:
+            for i, fix in enumerate(stream, 1):
+                print("\t".join(str(value) for value in (fix.isotime, fix.lat, fix.lon, fix.elevation, fix.speed,
+                                                        fix.course, fix.sat, "" if fix.valid else "no fix")),
+                      file=out, flush=True)
+                if count and i >= count:
+                    break
+        except KeyboardInterrupt:
+            pass
+    log.info("NMEA stream: %s", stream)
+    return stream
+
+
+def purge(connection, sync_stats: stats.Stats=None):
+    with _init_device(connection, sync_stats) as dev:
+        return dev.purge_all_120()
+
+
+def _device_task(arguments):
+    """
+    Task run on each device with --devices: the destination is a directory
+    holding a file per device, named after its serial
+    """
+    action = arguments.action
+    if action == ACTION_GET:
+        cache_directory = _cache_directory(arguments)
+        extension = export.extension_for(arguments.format)
+
+        def task(dev, job):
+            destination_file = os.path.join(arguments.dest, "{:08x}{}".format(dev.serial, extension))
+            return download_device(dev, destination_file, cache_directory,
+                                   pipelined=arguments.pipeline, decode_processes=arguments.decode_processes,
+                                   split_rules=_split_rules(arguments), window=_time_window(arguments),
+                                   export_format=arguments.format, resumable=not arguments.no_resume,
+                                   simplifier=_simplifier(arguments), track_stats=arguments.track_stats)
+    elif action == ACTION_DUMP:
+        def task(dev, job):
+            destination_file = os.path.join(arguments.dest, "{:08x}.img".format(dev.serial))
+            return dump_device(dev, destination_file, _time_window(arguments))
+    elif action == ACTION_PURGE:
+        def task(dev, job):
+            return dev.purge_all_120()
+    elif action == ACTION_ARCHIVE:
+        cache_directory = _cache_directory(arguments)
+
+        def task(dev, job):
+            # Each device writes to the archive in its own transactions
+            return "{} tracks, {} points added".format(*archive_device(
+                dev, arguments.db, cache_directory, _split_rules(arguments), _time_window(arguments)))
+    else:
+        task = multidevice.count_records
+
+    def device_task(dev, job):
+        dev.validator = _validator(arguments)
+        return task(dev, job)
+    return device_task
+
+
+def print_stats(arguments, device_stats: dict):
+    """
+    Prints the statistics of each device, by device name
+    """
+    if arguments.stats_format == STATS_JSON:
+        print(json.dumps({name: sync_stats.to_dict() for name, sync_stats in device_stats.items()},
+                         indent=2, sort_keys=True))
+        return
+    for name, sync_stats in sorted(device_stats.items()):
+        print("{}:".format(name))
+        print(sync_stats.summary())
+
+
+def sync_devices(arguments, device_connections: dict=None) -> bool:
+    """
+    Runs the action on the selected loggers in parallel, the attached USB ones by default.
+    Returns False if one of them failed.
+    """
+    devices = None
+    if arguments.devices != DEVICES_ALL:
+        # USB addresses are bus-port, serials are in hexadecimal
+        devices = [device if "-" in device else int(device, 16) for device in arguments.devices.split(",")]
+    if device_connections is None:
+        device_connections = multidevice.usb_connections()
+    if not device_connections:
+        log.error("No device found")
+        return False
+
+    if arguments.action in (ACTION_GET, ACTION_DUMP):
+        os.makedirs(arguments.dest, exist_ok=True)
+    orchestrator = multidevice.SyncOrchestrator(device_connections, _device_task(arguments), devices,
+                                                collect_stats=arguments.stats)
+    jobs = orchestrator.run()
+    if arguments.stats:
+        print_stats(arguments, {job.name: job.stats for job in jobs if job.stats is not None})
+    for job in jobs:
+        if job.state == multidevice.STATE_SKIPPED:
+            continue
+        serial = "" if job.serial is None else "{:08x}".format(job.serial)
+        outcome = job.error or job.result or job.records_total
+        print("\t".join(str(value) for value in (job.address, serial, job.model or "", job.state, outcome)))
+    return not orchestrator.failed
 
 
 def main():
@@ -101,18 +574,69 @@ def main():
     
     logging.basicConfig(level=arguments.verbose)
 
+    if arguments.action == ACTION_LIST:
+        arguments.devices = arguments.devices or DEVICES_ALL
+    if arguments.action == ACTION_QUERY:
+        # Only reads the archive
+        query_archive(arguments.db, arguments.dest, arguments.bbox, _time_window(arguments), arguments.device,
+                      arguments.format, _simplifier(arguments), arguments.track_stats)
+        return
+    if arguments.action == ACTION_CONVERT:
+        trackfile.convert(arguments.source, arguments.dest, arguments.format, _time_window(arguments),
+                          _simplifier(arguments), arguments.track_stats)
+        return
+    if arguments.action == ACTION_LIVE and (arguments.devices or arguments.image):
+        log.error("The live positions are streamed from a single device")
+        sys.exit(1)
+    if arguments.record and (arguments.devices or arguments.image):
+        log.error("--record only records the transfers with a single device")
+        sys.exit(1)
+    if arguments.devices:
+        if not sync_devices(arguments):
+            sys.exit(1)
+        return
+
     # Connection
-    if arguments.serial:
+    if arguments.image:
+        connection = flashimage.FlashImage(arguments.image)
+    elif arguments.replay:
+        connection = connections.get_connection(connections.CONNECTION_TYPE_REPLAY, arguments.replay,
+                                                speed=arguments.replay_speed)
+    elif arguments.serial:
         connection = connections.get_connection(connections.CONNECTION_TYPE_SERIAL, arguments.serial)
     else:
         connection = connections.get_connection(connections.CONNECTION_TYPE_USB)
+    if arguments.record:
+        connection = recording.RecordingConnection(connection, arguments.record, arguments.action)
+
+    sync_stats = stats.Stats() if arguments.stats else None
 
     # Performing the requested action
     action = arguments.action
     if action == ACTION_GET:        
-        download_track(connection, arguments.dest)
+        # Images are read whole, and the pages read in a traced session must not depend on the cache
+        traced = arguments.image or arguments.record or arguments.replay
+        cache_directory = None if traced else _cache_directory(arguments)
+        download_track(connection, arguments.dest, cache_directory,
+                       pipelined=arguments.pipeline, decode_processes=arguments.decode_processes,
+                       split_rules=_split_rules(arguments), window=_time_window(arguments),
+                       export_format=arguments.format, sync_stats=sync_stats,
+                       resumable=not arguments.no_resume, validator=_validator(arguments),
+                       simplifier=_simplifier(arguments), track_stats=arguments.track_stats)
+    elif action == ACTION_DUMP:
+        dump_flash(connection, arguments.dest, _time_window(arguments), sync_stats, _validator(arguments))
+    elif action == ACTION_ARCHIVE:
+        traced = arguments.image or arguments.record or arguments.replay
+        cache_directory = None if traced else _cache_directory(arguments)
+        archive_tracks(connection, arguments.db, cache_directory, _split_rules(arguments), _time_window(arguments),
+                       sync_stats, _validator(arguments))
     elif action == ACTION_PURGE:
-        purge(connection)
+        purge(connection, sync_stats)
+    elif action == ACTION_LIVE:
+        stream_fixes(connection, arguments.count, arguments.max_fixes)
+
+    if sync_stats is not None:
+        print_stats(arguments, {"device": sync_stats})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+import logging
+
+import numpy as np
+
+import pygotu
+
+log = logging.getLogger(__name__)
+
+KIND_WAYPOINT = 0
+KIND_LOG = 1
+KIND_HEARTBEAT = 2
+
+FLAG_INVALID = 0x20
+FLAG_DEVICE_LOG = 0xF1
+FLAG_HEARTBEAT = 0xF5
+
+# Same layout as the one decoded by pygotu.GTRecord
+RECORD_DTYPE = np.dtype([
+    ('flag', 'u1'),
+    ('ym', 'u1'),
+    ('dhm', '>u2'),
+    ('ms', '>u2'),
+    ('ae', '>u2'),
+    ('sat_map', '>u4'),
+    ('lat', '>i4'),
+    ('lon', '>i4'),
+    ('ele', '>i4'),
+    ('speed', '>u2'),
+    ('course', '>u2'),
+    ('f2', '>u2'),
+    ('plr', '>u2'),
+])
+assert RECORD_DTYPE.itemsize == pygotu.RECORD_SIZE
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _year_table() -> np.ndarray:
+    return np.array([pygotu.get_year(i) for i in range(16)], dtype=np.int64)
+
+
+def popcount32(values: np.ndarray) -> np.ndarray:
+    v = values.astype(np.uint32)
+    return (_POPCOUNT[v & 0xFF] + _POPCOUNT[(v >> 8) & 0xFF] +
+            _POPCOUNT[(v >> 16) & 0xFF] + _POPCOUNT[v >> 24])
+
+
+def decode_timestamps(raw: np.ndarray):
+    """
+    Decodes the packed date fields to UTC epoch milliseconds.
+    Returns (epoch_ms, date_ok), with the same normalisation rules as GTRecord.
+    """
+    ym = raw['ym'].astype(np.int64)
+    dhm = raw['dhm'].astype(np.int64)
+    ms = raw['ms'].astype(np.int64)
+
+    year = _year_table()[ym >> 4]
+    month = (ym & 0x0F) % 13
+    day = np.maximum(dhm >> 11, 1)
+    hour = ((dhm >> 6) & 0b00011111) % 24
+    minutes = (dhm & 0b00111111) % 60
+    sec = (ms // 1000) % 60
+    milli = ms % 1000
+
+    month_ok = month >= 1
+    month_start = ((year - 1970) * 12 + np.where(month_ok, month, 1) - 1).astype('datetime64[M]')
+    start_day = month_start.astype('datetime64[D]').astype(np.int64)
+    days_in_month = (month_start + 1).astype('datetime64[D]').astype(np.int64) - start_day
+    date_ok = month_ok & (day <= days_in_month)
+
+    epoch_ms = ((((start_day + day - 1) * 24 + hour) * 60 + minutes) * 60 + sec) * 1000 + milli
+    return epoch_ms, date_ok
+
+
+class RecordBatch:
+    """
+    Columnar view over consecutive flash records. Columns are NumPy arrays,
+    GTRecord objects are only built by record()/records().
+    """
+    __slots__ = ['raw', 'idx', 'epoch_ms', 'lat', 'lon', 'elevation', 'speed', 'course',
+                 'ehpe', 'sat', 'flag', 'kind', 'valid']
+
+    def __init__(self, raw: np.ndarray, first_idx: int=0):
+        self.raw = raw
+        self.idx = np.arange(first_idx, first_idx + len(raw), dtype=np.int64)
+        self.flag = raw['flag']
+
+        self.kind = np.full(len(raw), KIND_WAYPOINT, dtype=np.uint8)
+        self.kind[self.flag == FLAG_DEVICE_LOG] = KIND_LOG
+        self.kind[self.flag == FLAG_HEARTBEAT] = KIND_HEARTBEAT
+
+        self.epoch_ms, date_ok = decode_timestamps(raw)
+
+        self.lat = raw['lat'] / 10000000.0
+        self.lon = raw['lon'] / 10000000.0
+        self.elevation = raw['ele'] / 100.0  # in m
+        self.speed = (raw['speed'] / 100.0) / 1000.0 * 3600.0  # km/h
+        self.course = raw['course'] / 100.0  # degree
+        self.ehpe = (raw['ae'] & 0b0000111111111111) * 1e-2 * 0x10  # in m
+        self.sat = popcount32(raw['sat_map'])
+
+        self.valid = date_ok & (self.flag & FLAG_INVALID == 0)
+        self.valid &= ~((self.kind == KIND_WAYPOINT) & (raw['lat'] == 0) & (raw['lon'] == 0))
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def is_waypoint(self) -> np.ndarray:
+        return self.kind == KIND_WAYPOINT
+
+    def select(self, mask) -> 'RecordBatch':
+        """
+        Returns a new batch holding only the selected records (boolean mask or indices)
+        """
+        batch = RecordBatch.__new__(RecordBatch)
+        for name in RecordBatch.__slots__:
+            setattr(batch, name, getattr(self, name)[mask])
+        return batch
+
+    def waypoints(self) -> 'RecordBatch':
+        """
+        Valid waypoints only, as exported to GPX
+        """
+        return self.select(self.valid & self.is_waypoint)
+
+    def record(self, i: int) -> pygotu.GTRecord:
+        return pygotu.GTRecord(int(self.idx[i]), self.raw[i:i+1].tobytes())
+
+    def records(self):
+        for i in range(len(self.raw)):
+            if self.raw['flag'][i] == FLAG_HEARTBEAT:
+                # Not decoded by GTRecord
+                continue
+            yield self.record(i)
+
+
+def concatenate(batches) -> RecordBatch:
+    batches = list(batches)
+    batch = RecordBatch.__new__(RecordBatch)
+    for name in RecordBatch.__slots__:
+        setattr(batch, name, np.concatenate([getattr(b, name) for b in batches]))
+    return batch
+
+
+def decode_page(buf, first_idx: int=0) -> RecordBatch:
+    """
+    Decodes a flash page (or any whole number of records) without copying it
+    """
+    n = len(buf) // pygotu.RECORD_SIZE
+    raw = np.frombuffer(buf, dtype=RECORD_DTYPE, count=n)
+    return RecordBatch(raw, first_idx)
+
+
+def page_fields(buf) -> tuple:
+    """
+    Validity and epoch_ms (None for an invalid date) of the records of a page, as lists,
+    decoded at once for pygotu.page_records(): small enough to leave a process pool
+    """
+    raw = np.frombuffer(buf, dtype=RECORD_DTYPE, count=len(buf) // pygotu.RECORD_SIZE)
+    epoch_ms, date_ok = decode_timestamps(raw)
+    flag = raw['flag']
+    valid = date_ok & (flag & FLAG_INVALID == 0)
+    valid &= ~((flag != FLAG_DEVICE_LOG) & (flag != FLAG_HEARTBEAT) & (raw['lat'] == 0) & (raw['lon'] == 0))
+    return valid.tolist(), [ms if ok else None for ms, ok in zip(epoch_ms.tolist(), date_ok.tolist())]
+
+
+def decode_records(records) -> RecordBatch:
+    """
+    Columns of records held in page buffers, like pygotu.LazyGTRecord: each page is
+    decoded once and its records selected. None when a record has no page buffer.
+    """
+    pages = []
+    buf = None
+    for rec in records:
+        rec_buf = getattr(rec, 'buf', None)
+        if rec_buf is None:
+            return None
+        if rec_buf is not buf:
+            buf = rec_buf
+            rows = []
+            pages.append((buf, rec.idx - rec.offset // pygotu.RECORD_SIZE, rows))
+        rows.append(rec.offset // pygotu.RECORD_SIZE)
+    if not pages:
+        return decode_page(b"")
+    return concatenate(decode_page(buf, first_idx).select(np.array(rows, dtype=np.int64))
+                       for buf, first_idx, rows in pages)
+
+
+def decode_dump(buf, num_records: int=None, first_idx: int=0) -> RecordBatch:
+    """
+    Decodes a whole dump made of consecutive flash pages, optionally limited to
+    the number of records reported by GT200Dev.count()
+    """
+    n = len(buf) // pygotu.RECORD_SIZE
+    if num_records is not None:
+        n = min(n, num_records)
+    return decode_page(memoryview(buf)[:n * pygotu.RECORD_SIZE], first_idx)
@@ -0,0 +1,189 @@
+import calendar
+import logging
+
+import numpy as np
+
+import gtbatch
+import pygotu
+
+log = logging.getLogger(__name__)
+
+# Issues found in a record, as bits
+ISSUE_DATE = 0x01
+ISSUE_FLAG = 0x02
+ISSUE_ERASED = 0x04
+ISSUE_TIME_ORDER = 0x08
+ISSUE_POSITION = 0x10
+
+ISSUE_NAMES = {
+    ISSUE_DATE: "date",
+    ISSUE_FLAG: "flag",
+    ISSUE_ERASED: "erased",
+    ISSUE_TIME_ORDER: "time_order",
+    ISSUE_POSITION: "position",
+}
+
+# Plausible waypoint elevations, in cm
+MIN_ELEVATION = -100000
+MAX_ELEVATION = 2000000
+
+# Re-reads of a suspect page, and of all the pages of a download
+MAX_PAGE_REREADS = 3
+DEFAULT_REREAD_BUDGET = 32
+
+# Flags whose 4 high bits are set: only the device log and heartbeat records,
+# the waypoint flags never have TSTART and TSTOP set together
+_SPECIAL_FLAGS = (gtbatch.FLAG_DEVICE_LOG, gtbatch.FLAG_HEARTBEAT)
+
+# Year of each year field value, whether it is leap, and days in each month field value by leap
+_YEARS = np.array([pygotu.get_year(i) for i in range(16)], dtype=np.int64)
+_LEAP = np.array([calendar.isleap(year) for year in _YEARS], dtype=np.uint8)
+_DAYS_IN_MONTH = np.zeros((2, 16), dtype=np.uint16)
+for _leap, _year in enumerate((2001, 2000)):
+    _DAYS_IN_MONTH[_leap, 1:13] = [calendar.monthrange(_year, month)[1] for month in range(1, 13)]
+
+_ERASED = 0xFFFFFFFFFFFFFFFF
+
+
+def check_records(buf, prev_time_key: int=None) -> tuple:
+    """
+    Checks the records of a page, or any whole number of records, all of them being
+    counted by the device. Returns (issue bits per record, time key of the last dated
+    record). The time keys order the record dates without decoding them: prev_time_key,
+    the one of the last dated record of the previous page, checks the chronological
+    order across pages too.
+    """
+    n = len(buf) // pygotu.RECORD_SIZE
+    raw = np.frombuffer(buf, dtype=gtbatch.RECORD_DTYPE, count=n)
+    issues = np.zeros(n, dtype=np.uint8)
+
+    # Records counted by the device are never erased: a 0xFF tail is a short transfer
+    erased = (np.frombuffer(buf, dtype=np.uint64, count=n * 4).reshape(n, 4) == _ERASED).all(axis=1)
+    issues[erased] |= ISSUE_ERASED
+
+    flag = raw['flag']
+    special = (flag == _SPECIAL_FLAGS[0]) | (flag == _SPECIAL_FLAGS[1])
+    issues[((flag & 0xF0) == 0xF0) & ~special & ~erased] |= ISSUE_FLAG
+
+    # Fields out of range are normalised by the decoding, the device never writes them
+    year = raw['ym'] >> 4
+    month = raw['ym'] & 0x0F
+    dhm = raw['dhm']
+    day = dhm >> 11
+    hour = (dhm >> 6) & 0x1F
+    minutes = dhm & 0x3F
+    ms = raw['ms']
+    date_ok = (day >= 1) & (day <= _DAYS_IN_MONTH[_LEAP[year], month]) & (hour < 24) & (minutes < 60) & (ms < 60000)
+    checked = ~erased & ((flag & gtbatch.FLAG_INVALID) == 0)
+    issues[checked & ~date_ok] |= ISSUE_DATE
+
+    # Waypoint coordinates out of range, in 1e-7 degrees, and elevations, in cm
+    waypoint = checked & ~special
+    lat = raw['lat']
+    lon = raw['lon']
+    ele = raw['ele']
+    issues[waypoint & ((lat < -900000000) | (lat > 900000000) | (lon < -1800000000) | (lon > 1800000000) |
+                       (ele < MIN_ELEVATION) | (ele > MAX_ELEVATION))] |= ISSUE_POSITION
+
+    dated = np.flatnonzero(checked & date_ok)
+    last_time_key = prev_time_key
+    if len(dated):
+        keys = (((((_YEARS[year[dated]] * 16 + month[dated]) * 32 + day[dated]) * 32 + hour[dated]) * 64 +
+                 minutes[dated]) << 16) + ms[dated]
+        if prev_time_key is not None:
+            keys = np.concatenate(([prev_time_key], keys))
+        backwards = np.flatnonzero(np.diff(keys) < 0)
+        if len(backwards):
+            # The record after each step back, keys starting with prev_time_key when given
+            issues[dated[backwards + 1 - (len(keys) - len(dated))]] |= ISSUE_TIME_ORDER
+        last_time_key = int(keys[-1])
+    return issues, last_time_key
+
+
+def issue_names(issues: int) -> list:
+    return [name for bit, name in sorted(ISSUE_NAMES.items()) if issues & bit]
+
+
+class PageValidator:
+    """
+    Validates the pages read by GT200Dev.all_pages(), see GT200Dev.validator. A suspect
+    page is read again, up to MAX_PAGE_REREADS times and budget re-reads per download:
+    - a re-read passing the checks replaces the page,
+    - a re-read identical to the previous read shows the flash really holds these
+      records: they are kept as read.
+    """
+    __slots__ = ['budget', 'rereads', 'pages', 'suspect_pages', 'repaired_pages', 'stable_pages',
+                 'unresolved_pages', 'issue_counts', 'last_page', 'last_time_key']
+
+    def __init__(self, budget: int=DEFAULT_REREAD_BUDGET):
+        self.budget = budget
+        self.rereads = 0
+        self.pages = 0
+        self.suspect_pages = 0
+        self.repaired_pages = 0
+        self.stable_pages = 0
+        self.unresolved_pages = 0
+        # Records with each issue, in the pages finally kept
+        self.issue_counts = dict.fromkeys(ISSUE_NAMES.values(), 0)
+        self.last_page = None
+        self.last_time_key = None
+
+    def validate(self, dev: pygotu.GT200Dev, page: int, buf):
+        """
+        Returns the page buffer to use, read again from dev when buf looks corrupted
+        """
+        self.pages += 1
+        size = len(buf)
+        prev_time_key = self.last_time_key if self.last_page == page - 1 else None
+        issues, last_time_key = check_records(buf, prev_time_key)
+        if issues.any():
+            self.suspect_pages += 1
+            log.warning("Page %s looks corrupted (%s), reading it again",
+                        page, ", ".join(issue_names(int(np.bitwise_or.reduce(issues)))))
+            buf, issues, last_time_key = self._reread(dev, page, buf, size, prev_time_key, issues, last_time_key)
+
+        for bit, name in ISSUE_NAMES.items():
+            count = int(np.count_nonzero(issues & bit))
+            if count:
+                self.issue_counts[name] += count
+        self.last_page = page
+        self.last_time_key = last_time_key
+        return buf
+
+    def _reread(self, dev: pygotu.GT200Dev, page: int, buf, size: int, prev_time_key: int,
+                issues: np.ndarray, last_time_key: int) -> tuple:
+        for _ in range(MAX_PAGE_REREADS):
+            if self.rereads >= self.budget:
+                log.warning("Re-read budget exhausted, keeping page %s as read", page)
+                break
+            self.rereads += 1
+            reread = dev.read_page(page)[:size]
+            if bytes(reread) == bytes(buf):
+                log.info("Page %s read again identically, keeping its records", page)
+                self.stable_pages += 1
+                return buf, issues, last_time_key
+            buf = reread
+            issues, last_time_key = check_records(buf, prev_time_key)
+            if not issues.any():
+                log.info("Page %s repaired by reading it again", page)
+                self.repaired_pages += 1
+                return buf, issues, last_time_key
+        self.unresolved_pages += 1
+        return buf, issues, last_time_key
+
+    def to_dict(self) -> dict:
+        return {
+            "pages": self.pages,
+            "suspect_pages": self.suspect_pages,
+            "repaired_pages": self.repaired_pages,
+            "stable_pages": self.stable_pages,
+            "unresolved_pages": self.unresolved_pages,
+            "rereads": self.rereads,
+            "records_with_issues": dict(self.issue_counts),
+        }
+
+    def __str__(self):
+        issues = ", ".join("{} {}".format(count, name) for name, count in self.issue_counts.items() if count)
+        return "{} pages checked, {} suspect: {} repaired, {} stable, {} unresolved, {} re-reads{}".format(
+            self.pages, self.suspect_pages, self.repaired_pages, self.stable_pages, self.unresolved_pages,
+            self.rereads, "; records kept with issues: " + issues if issues else "")
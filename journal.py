@@ -0,0 +1,135 @@
+import logging
+import os
+import time
+import zlib
+from struct import calcsize, pack, unpack_from
+
+import pygotu
+
+log = logging.getLogger(__name__)
+
+JOURNAL_MAGIC = b"GTDJ"
+JOURNAL_VERSION = 1
+
+# magic, version, device serial, creation time (epoch ms)
+HEADER_FORMAT = ">4sBIQ"
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+# Each completed page is appended as: page number, number of records downloaded once
+# it is written, data size, CRC32 of the data, followed by the data
+ENTRY_FORMAT = ">IIHI"
+ENTRY_SIZE = calcsize(ENTRY_FORMAT)
+
+# Entries appended between two syncs
+SYNC_ENTRIES = 64
+
+
+def journal_path(destination_file: str) -> str:
+    return destination_file + ".journal"
+
+
+class DownloadJournal:
+    """
+    Crash-safe log of the flash pages downloaded to a destination file. Each page is
+    appended once read, the journal being synced every SYNC_ENTRIES pages and on close():
+    a torn or corrupted tail, like the unsynced pages lost by a crash, is dropped when
+    the journal is opened again. It has the interface of pagecache.PageCache, so
+    GT200Dev.all_pages() reads the journaled pages instead of the device: the output
+    of an interrupted download is rebuilt from them, then completed from the device.
+    """
+    __slots__ = ['serial', 'path', 'num_records', 'pages', 'unsynced', 'f']
+
+    def __init__(self, serial: int, path: str):
+        self.serial = serial
+        self.path = path
+        self.num_records = 0
+        # Offset of the data of each journaled page
+        self.pages = {}
+        # Entries appended since the last sync
+        self.unsynced = 0
+
+        exists = os.path.exists(path)
+        self.f = open(path, "r+b" if exists else "w+b")
+        buf = self.f.read() if exists else b""
+        if len(buf) >= HEADER_SIZE:
+            magic, version, journal_serial, _ = unpack_from(HEADER_FORMAT, buf)
+            if magic == JOURNAL_MAGIC and version == JOURNAL_VERSION and journal_serial == serial:
+                self._load(buf)
+                return
+            log.warning("Ignoring the journal of another download: %s", path)
+        self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _load(self, buf: bytes):
+        pos = HEADER_SIZE
+        while pos + ENTRY_SIZE <= len(buf):
+            page, num_records, size, crc = unpack_from(ENTRY_FORMAT, buf, pos)
+            data = buf[pos + ENTRY_SIZE:pos + ENTRY_SIZE + size]
+            if len(data) < size or zlib.crc32(data) != crc:
+                break
+            self.pages[page] = pos + ENTRY_SIZE
+            self.num_records = num_records
+            pos += ENTRY_SIZE + size
+        if pos < len(buf):
+            log.warning("Dropping the incomplete end of the journal %s", self.path)
+            self.f.truncate(pos)
+        log.info("Resuming download from journal %s: %s records", self.path, self.num_records)
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def clear(self):
+        self.num_records = 0
+        self.pages = {}
+        self.f.seek(0)
+        self.f.truncate()
+        self.f.write(pack(HEADER_FORMAT, JOURNAL_MAGIC, JOURNAL_VERSION, self.serial, int(time.time() * 1000)))
+        self._sync()
+
+    def read_page(self, page: int) -> bytes:
+        self.f.seek(self.pages[page])
+        return self.f.read(pygotu.PAGE_SIZE).ljust(pygotu.PAGE_SIZE, b"\xff")
+
+    def read_record(self, idx: int) -> bytes:
+        page, i = divmod(idx, pygotu.RECORDS_PER_PAGE)
+        return self.read_page(page + 1)[i * pygotu.RECORD_SIZE:(i + 1) * pygotu.RECORD_SIZE]
+
+    def store_page(self, page: int, buf: bytes, num_records: int):
+        """
+        Appends a page read from the device, num_records being the number of records
+        downloaded once this page is written. A page stored again replaces the previous one.
+        """
+        data = bytes(buf)
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(pack(ENTRY_FORMAT, page, num_records, len(data), zlib.crc32(data)))
+        self.pages[page] = self.f.tell()
+        self.f.write(data)
+        self.num_records = num_records
+        self.unsynced += 1
+        if self.unsynced >= SYNC_ENTRIES:
+            self._sync()
+
+    def full_pages(self, num_records: int) -> int:
+        """
+        Number of complete pages that can be served from the journal for a device
+        holding num_records records
+        """
+        return min(self.num_records, num_records) // pygotu.RECORDS_PER_PAGE
+
+    def close(self):
+        if self.unsynced:
+            self._sync()
+        self.f.close()
+
+    def remove(self):
+        """
+        Deletes the journal, once the download it covers is complete
+        """
+        self.f.close()
+        os.remove(self.path)
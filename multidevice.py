@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import connections
+import pygotu
+import stats
+
+log = logging.getLogger(__name__)
+
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+STATE_SKIPPED = "skipped"
+
+# Progress is logged every PROGRESS_STEP of the records of a device
+PROGRESS_STEP = 0.1
+
+
+def usb_connections() -> dict:
+    """
+    Connection factories of every attached USB logger, by USB address
+    """
+    return {connections.usb_address(dev): partial(connections.USBSerial, dev)
+            for dev in connections.find_usb_devices()}
+
+
+class DeviceJob:
+    """
+    State of one device synchronized by a SyncOrchestrator
+    """
+    __slots__ = ['address', 'open_connection', 'serial', 'model', 'state', 'records_read',
+                 'records_total', 'logged_step', 'result', 'error', 'elapsed', 'stats']
+
+    def __init__(self, address: str, open_connection):
+        self.address = address
+        self.open_connection = open_connection
+        self.serial = None
+        self.model = None
+        self.state = STATE_PENDING
+        self.records_read = 0
+        self.records_total = 0
+        self.logged_step = 0
+        self.result = None
+        self.error = None
+        self.elapsed = 0.0
+        # stats.Stats of the device session, see SyncOrchestrator collect_stats
+        self.stats = None
+
+    @property
+    def name(self) -> str:
+        if self.serial is None:
+            return self.address
+        return "{} ({:08x})".format(self.address, self.serial)
+
+    def __str__(self):
+        if self.state == STATE_FAILED:
+            return "{}: {} after {:.1f} s: {}".format(self.name, self.state, self.elapsed, self.error)
+        return "{}: {} {}/{} records in {:.1f} s".format(
+            self.name, self.state, self.records_read, self.records_total, self.elapsed)
+
+
+class SyncOrchestrator:
+    """
+    Runs a task on several devices in parallel, one worker thread per device: the
+    total duration is the one of the slowest device. The task is called with the
+    identified pygotu.GT200Dev and its DeviceJob. A failing device does not stop
+    the others, its exception is kept in its job.
+    Devices can be selected by USB address (str) or serial (int): the serials are
+    only known once identified, the other devices are then skipped.
+    With collect_stats, the protocol statistics of each device session are collected in
+    the stats of its job.
+    """
+    __slots__ = ['jobs', 'task', 'devices', 'progress', 'lock', 'collect_stats']
+
+    def __init__(self, device_connections: dict, task, devices=None, progress=None,
+                 collect_stats: bool=False):
+        self.devices = None if devices is None else set(devices)
+        if self.devices is not None and all(isinstance(device, str) for device in self.devices):
+            device_connections = {address: open_connection
+                                  for address, open_connection in device_connections.items()
+                                  if address in self.devices}
+        self.jobs = [DeviceJob(address, open_connection)
+                     for address, open_connection in sorted(device_connections.items())]
+        self.task = task
+        self.progress = progress or self._log_progress
+        self.lock = threading.Lock()
+        self.collect_stats = collect_stats
+
+    def _log_progress(self, job: DeviceJob):
+        if not job.records_total:
+            return
+        step = int(job.records_read / job.records_total / PROGRESS_STEP)
+        if step > job.logged_step:
+            job.logged_step = step
+            log.info("%s: %s/%s records", job.name, job.records_read, job.records_total)
+
+    def _update_progress(self, job: DeviceJob, records_read: int, records_total: int):
+        job.records_read = min(records_read, records_total)
+        job.records_total = records_total
+        with self.lock:
+            self.progress(job)
+
+    def _run(self, job: DeviceJob):
+        start = time.perf_counter()
+        job.state = STATE_RUNNING
+        try:
+            if self.collect_stats:
+                job.stats = stats.Stats()
+            with pygotu.open_device(job.open_connection(), job.stats) as dev:
+                job.serial = dev.serial
+                job.model = dev.model_info[0]
+                if self.devices is not None and not {job.address, job.serial} & self.devices:
+                    job.state = STATE_SKIPPED
+                    return job
+                dev.progress = partial(self._update_progress, job)
+                job.result = self.task(dev, job)
+            job.state = STATE_DONE
+        except Exception as e:
+            job.state = STATE_FAILED
+            job.error = e
+            log.debug("%s: %s", job.name, traceback.format_exc())
+        finally:
+            job.elapsed = time.perf_counter() - start
+        log.info("%s", job)
+        return job
+
+    def run(self) -> list:
+        """
+        Runs the task on every device, returning the jobs once all of them are over
+        """
+        if not self.jobs:
+            return []
+        with ThreadPoolExecutor(len(self.jobs), thread_name_prefix="pygotu-device") as executor:
+            return list(executor.map(self._run, self.jobs))
+
+    @property
+    def failed(self) -> list:
+        return [job for job in self.jobs if job.state == STATE_FAILED]
+
+
+def count_records(dev: pygotu.GT200Dev, job: DeviceJob) -> int:
+    job.records_total = dev.count()
+    return job.records_total
+
+
+def enumerate_devices(device_connections: dict=None) -> list:
+    """
+    Identifies every attached logger, in parallel, returning their DeviceJob
+    with the serial, model and record count (as records_total)
+    """
+    if device_connections is None:
+        device_connections = usb_connections()
+    return SyncOrchestrator(device_connections, count_records).run()
@@ -0,0 +1,424 @@
+import asyncio
+import collections
+import datetime
+import logging
+import threading
+import time
+from functools import reduce
+from operator import xor
+
+import numpy as np
+
+import connections
+import pygotu
+import stats
+
+log = logging.getLogger(__name__)
+
+# Bytes asked per read of the stream: a few USB packets, the sentences of a fix
+# arriving over several reads
+READ_SIZE = 0x200
+# Fixes kept for a slow consumer, the oldest ones being dropped beyond
+DEFAULT_MAX_FIXES = 64
+# NMEA 0183 sentences are at most 82 characters: longer lines are noise
+MAX_LINE = 128
+
+KNOTS_TO_KMH = 1.852
+
+DAY_MS = 86400000
+
+_NEWLINE = 0x0a
+_CR = 0x0d
+_DOLLAR = 0x24
+_STAR = 0x2a
+
+
+def checksum(body) -> int:
+    """
+    XOR of the characters between $ and *
+    """
+    return reduce(xor, body, 0)
+
+
+def format_sentence(body: str) -> bytes:
+    """
+    Sentence of the fields in body, like "GPRMC,...", with its checksum and line end
+    """
+    data = body.encode("ascii")
+    return b"$" + data + "*{:02X}\r\n".format(checksum(data)).encode("ascii")
+
+
+class LineSplitter:
+    """
+    Splits a byte stream into lines without copying them: the lines complete in a
+    chunk are memoryviews of it. Only a line spanning chunks is copied, to the
+    partial line buffer.
+    """
+    __slots__ = ['partial', 'overflows']
+
+    def __init__(self):
+        self.partial = bytearray()
+        # Lines dropped for being longer than MAX_LINE
+        self.overflows = 0
+
+    def feed(self, data) -> list:
+        """
+        Lines ended in data, without their CR LF end
+        """
+        view = memoryview(data)
+        ends = np.flatnonzero(np.frombuffer(view, dtype=np.uint8) == _NEWLINE).tolist()
+        lines = []
+        start = 0
+        for end in ends:
+            if self.partial:
+                self.partial += view[:end]
+                line = memoryview(bytes(self.partial))
+                self.partial.clear()
+            else:
+                line = view[start:end]
+            if len(line) and line[-1] == _CR:
+                line = line[:-1]
+            if len(line) <= MAX_LINE:
+                lines.append(line)
+            else:
+                self.overflows += 1
+            start = end + 1
+        if start < len(view):
+            if len(self.partial) + len(view) - start > MAX_LINE:
+                self.partial.clear()
+                self.overflows += 1
+            else:
+                self.partial += view[start:]
+        return lines
+
+
+class Fix:
+    """
+    Position of the live stream, from the RMC and GGA sentences of a time.
+    received is the time.perf_counter() when the data completing it was read.
+    """
+    __slots__ = ['epoch_ms', 'lat', 'lon', 'elevation', 'speed', 'course', 'sat', 'hdop', 'quality',
+                 'status', 'received']
+
+    def __init__(self):
+        self.epoch_ms = None
+        self.lat = None
+        self.lon = None
+        self.elevation = None
+        self.speed = None
+        self.course = None
+        self.sat = None
+        self.hdop = None
+        # GGA fix quality, 0 for no fix
+        self.quality = None
+        # RMC status: A for a valid position, V otherwise
+        self.status = None
+        self.received = None
+
+    @property
+    def valid(self) -> bool:
+        if self.status is not None:
+            return self.status == "A"
+        return bool(self.quality)
+
+    @property
+    def isotime(self) -> str:
+        return None if self.epoch_ms is None else pygotu.format_isotime(self.epoch_ms)
+
+    def __str__(self):
+        return "{0.isotime} LATLON:({0.lat}, {0.lon}) ele:{0.elevation} speed:{0.speed} course:{0.course} sat:{0.sat}{1}".format(
+            self, "" if self.valid else " no fix")
+
+
+def _parse_latlon(value: bytes, hemisphere: bytes, degree_digits: int) -> float:
+    if not value:
+        return None
+    degrees = int(value[:degree_digits]) + float(value[degree_digits:]) / 60.0
+    return -degrees if hemisphere in (b"S", b"W") else degrees
+
+
+def _parse_time_of_day(value: bytes) -> int:
+    """
+    hhmmss[.sss] as ms since midnight
+    """
+    return (int(value[0:2]) * 3600 + int(value[2:4]) * 60) * 1000 + int(round(float(value[4:]) * 1000))
+
+
+def _float(value: bytes) -> float:
+    return float(value) if value else None
+
+
+class NMEAParser:
+    """
+    Assembles the fixes of an NMEA stream, fed by chunks of any size. A fix is emitted
+    as soon as both the RMC and the GGA sentences of its time are read, or when a
+    sentence of a later time shows that the other one will not come.
+    Other sentences and the ones with a wrong checksum are skipped.
+    """
+    __slots__ = ['splitter', 'date_ms', 'last_time', 'pending', 'pending_time', 'pending_sentences', 'sentences',
+                 'checksum_errors', 'bytes_in']
+
+    def __init__(self):
+        self.splitter = LineSplitter()
+        # Epoch ms of the last date given by an RMC sentence, GGA ones only having the time
+        self.date_ms = None
+        # Time of day of the last sentence dated from date_ms
+        self.last_time = None
+        self.pending = None
+        self.pending_time = None
+        self.pending_sentences = set()
+        self.sentences = 0
+        self.checksum_errors = 0
+        self.bytes_in = 0
+
+    def feed(self, data, received: float=None) -> list:
+        self.bytes_in += len(data)
+        fixes = []
+        for line in self.splitter.feed(data):
+            emitted = self._sentence(line, received)
+            if emitted:
+                fixes.extend(emitted)
+        return fixes
+
+    def _sentence(self, line: memoryview, received: float) -> list:
+        if len(line) and line[0] != _DOLLAR:
+            # Noise before the sentence, like the end of the response to the mode switch
+            start = bytes(line).rfind(b"$")
+            if start < 0:
+                return None
+            line = line[start:]
+        # The sentence type is checked before copying the line
+        if len(line) < 10 or line[-3] != _STAR:
+            return None
+        kind = line[3:6]
+        if kind != b"RMC" and kind != b"GGA":
+            return None
+        self.sentences += 1
+        try:
+            valid = checksum(line[1:-3]) == int(bytes(line[-2:]), 16)
+        except ValueError:
+            valid = False
+        if not valid:
+            self.checksum_errors += 1
+            return None
+
+        fields = bytes(line[7:-3]).split(b",")
+        try:
+            time_of_day = _parse_time_of_day(fields[0])
+        except (ValueError, IndexError):
+            return None
+        emitted = []
+        if self.pending is not None and time_of_day != self.pending_time:
+            emitted.append(self.pending)
+            self.pending = None
+        if self.pending is None:
+            self.pending = Fix()
+            self.pending_time = time_of_day
+            self.pending_sentences = set()
+
+        fix = self.pending
+        try:
+            if kind == b"RMC":
+                self._rmc(fix, fields, time_of_day)
+            else:
+                self._gga(fix, fields, time_of_day)
+        except (ValueError, IndexError):
+            log.debug("Invalid sentence: %s", bytes(line))
+            return emitted
+        self.pending_sentences.add(bytes(kind))
+        fix.received = received
+        if len(self.pending_sentences) == 2:
+            emitted.append(fix)
+            self.pending = None
+        return emitted
+
+    def _rmc(self, fix: Fix, fields: list, time_of_day: int):
+        # time, status, lat, N/S, lon, E/W, speed (knots), course, date (ddmmyy)...
+        fix.status = fields[1].decode("ascii")
+        fix.lat = _parse_latlon(fields[2], fields[3], 2)
+        fix.lon = _parse_latlon(fields[4], fields[5], 3)
+        speed = _float(fields[6])
+        fix.speed = None if speed is None else speed * KNOTS_TO_KMH
+        fix.course = _float(fields[7])
+        date = fields[8]
+        if date:
+            self.date_ms = pygotu.datetime_to_epoch_ms(
+                datetime.datetime(2000 + int(date[4:6]), int(date[2:4]), int(date[0:2])))
+            self.last_time = time_of_day
+        date_ms = self._date_ms(time_of_day)
+        if date_ms is not None:
+            fix.epoch_ms = date_ms + time_of_day
+
+    def _gga(self, fix: Fix, fields: list, time_of_day: int):
+        # time, lat, N/S, lon, E/W, quality, satellites, hdop, altitude, M...
+        fix.lat = _parse_latlon(fields[1], fields[2], 2)
+        fix.lon = _parse_latlon(fields[3], fields[4], 3)
+        fix.quality = int(fields[5] or 0)
+        fix.sat = int(fields[6] or 0)
+        fix.hdop = _float(fields[7])
+        fix.elevation = _float(fields[8])
+        date_ms = self._date_ms(time_of_day)
+        if fix.epoch_ms is None and date_ms is not None:
+            fix.epoch_ms = date_ms + time_of_day
+
+    def _date_ms(self, time_of_day: int) -> int:
+        """
+        Epoch ms of the date of a sentence: the last RMC date, advanced by a day when the
+        time of day went back by more than half a day since, past midnight
+        """
+        if self.date_ms is None:
+            return None
+        if self.last_time is not None and time_of_day < self.last_time - DAY_MS // 2:
+            self.date_ms += DAY_MS
+        self.last_time = time_of_day
+        return self.date_ms
+
+    def flush(self) -> list:
+        """
+        Fix waiting for its other sentence, at the end of the stream
+        """
+        fix = self.pending
+        self.pending = None
+        return [] if fix is None else [fix]
+
+
+class NMEAStream:
+    """
+    Live fixes of a logger switched to the GPS dongle mode. A reader thread parses the
+    stream as it is received; the fixes are kept for the consumer, iterating with for
+    or async for, up to max_fixes: the oldest ones are dropped when it falls behind,
+    so it always gets the most recent positions.
+    latency collects the time from the reception of the data completing a fix to its
+    delivery to the consumer, in ms.
+    """
+    __slots__ = ['connection', 'switch', 'parser', 'fixes', 'dropped', 'delivered', 'latency', 'condition',
+                 'thread', 'running', 'error', 'waiters']
+
+    def __init__(self, connection, max_fixes: int=DEFAULT_MAX_FIXES, switch: bool=True):
+        self.connection = connection
+        # Whether the device is switched to the dongle mode, and back to the tracker mode when closed
+        self.switch = switch
+        self.parser = NMEAParser()
+        self.fixes = collections.deque(maxlen=max_fixes)
+        self.dropped = 0
+        self.delivered = 0
+        self.latency = stats.Histogram()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.error = None
+        # (loop, event) of the async consumers waiting for a fix
+        self.waiters = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        if self.switch:
+            pygotu.GT200Dev(self.connection).nmea_switch(pygotu.MODE_GPS_DONGLE)
+            log.info("Switched to the GPS dongle mode")
+        self.running = True
+        self.thread = threading.Thread(target=self._read_stream, name="nmea-stream", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        if self.switch and self.thread is not None:
+            try:
+                pygotu.GT200Dev(self.connection).nmea_switch(pygotu.MODE_GPS_TRACKER)
+            except Exception as e:
+                log.warning("Unable to switch back to the tracker mode: %s", e)
+        self.thread = None
+
+    def _read_stream(self):
+        try:
+            while self.running:
+                data = connections.read_some(self.connection, READ_SIZE)
+                if len(data):
+                    self._push(self.parser.feed(data, time.perf_counter()))
+        except EOFError:
+            log.debug("End of the NMEA stream")
+        except Exception as e:
+            log.warning("NMEA stream interrupted: %s", e)
+            self.error = e
+        self._push(self.parser.flush(), end=True)
+
+    def _push(self, fixes: list, end: bool=False):
+        if not fixes and not end:
+            return
+        with self.condition:
+            for fix in fixes:
+                if len(self.fixes) == self.fixes.maxlen:
+                    self.dropped += 1
+                self.fixes.append(fix)
+            if end:
+                self.running = False
+            self.condition.notify_all()
+            waiters = self.waiters
+            self.waiters = []
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _deliver(self) -> Fix:
+        fix = self.fixes.popleft()
+        self.delivered += 1
+        if fix.received is not None:
+            self.latency.record((time.perf_counter() - fix.received) * 1000.0)
+        return fix
+
+    def _end(self):
+        if self.error is not None:
+            raise self.error
+
+    def __iter__(self):
+        self.start()
+        while True:
+            with self.condition:
+                while not self.fixes and self.running:
+                    self.condition.wait()
+                if not self.fixes:
+                    break
+                fix = self._deliver()
+            yield fix
+        self._end()
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self) -> Fix:
+        while True:
+            with self.condition:
+                if self.fixes:
+                    return self._deliver()
+                if not self.running:
+                    break
+                event = asyncio.Event()
+                self.waiters.append((asyncio.get_event_loop(), event))
+            await event.wait()
+        self._end()
+        raise StopAsyncIteration
+
+    def to_dict(self) -> dict:
+        return {
+            "bytes_in": self.parser.bytes_in,
+            "sentences": self.parser.sentences,
+            "checksum_errors": self.parser.checksum_errors,
+            "line_overflows": self.parser.splitter.overflows,
+            "fixes_delivered": self.delivered,
+            "fixes_dropped": self.dropped,
+            "latency_ms": self.latency.to_dict(),
+        }
+
+    def __str__(self):
+        return "{} bytes, {} sentences ({} bad checksums), {} fixes delivered, {} dropped, latency p50 {:.3f} ms p99 {:.3f} ms".format(
+            self.parser.bytes_in, self.parser.sentences, self.parser.checksum_errors, self.delivered, self.dropped,
+            self.latency.percentile(0.5), self.latency.percentile(0.99))
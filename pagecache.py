@@ -0,0 +1,122 @@
+import logging
+import os
+import os.path
+from struct import calcsize, pack, unpack
+
+import pygotu
+
+log = logging.getLogger(__name__)
+
+CACHE_MAGIC = b"GTPC"
+CACHE_VERSION = 1
+
+# magic, version, device serial, number of cached records
+HEADER_FORMAT = ">4sBII"
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+
+# Pages stored between two updates of the header
+SYNC_PAGES = 64
+
+
+def default_directory() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pygotu")
+
+
+class PageCache:
+    """
+    On-disk copy of the flash pages of one device, stored contiguously from page 1.
+    Every SYNC_PAGES pages, and on close(), the pages are synced to disk, then the header
+    counting their records is rewritten and synced, so an interrupted download, even by
+    a crash, never leaves records counted that were not stored: like the download
+    journal, the cache resumes it from the last pages counted.
+    """
+    __slots__ = ['serial', 'path', 'num_records', 'unsynced', 'f']
+
+    def __init__(self, serial: int, directory: str=None):
+        directory = directory or default_directory()
+        os.makedirs(directory, exist_ok=True)
+        self.serial = serial
+        self.path = os.path.join(directory, "{:08x}.pages".format(serial))
+        self.num_records = 0
+        # Pages stored since the last header update
+        self.unsynced = 0
+
+        mode = "r+b" if os.path.exists(self.path) else "w+b"
+        self.f = open(self.path, mode)
+        header = self.f.read(HEADER_SIZE)
+        if len(header) == HEADER_SIZE:
+            magic, version, cached_serial, num_records = unpack(HEADER_FORMAT, header)
+            if magic == CACHE_MAGIC and version == CACHE_VERSION and cached_serial == serial:
+                self.num_records = num_records
+            else:
+                log.warning("Ignoring invalid page cache: %s", self.path)
+                self.clear()
+        else:
+            self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.unsynced:
+            self.commit()
+        self.f.close()
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def _write_header(self):
+        self.f.seek(0)
+        self.f.write(pack(HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, self.serial, self.num_records))
+        self._sync()
+
+    def commit(self):
+        """
+        Syncs the stored pages, then the header counting their records
+        """
+        self._sync()
+        self._write_header()
+        self.unsynced = 0
+
+    def clear(self):
+        log.info("Clearing page cache of device %s", self.serial)
+        self.num_records = 0
+        self.unsynced = 0
+        self.f.truncate(0)
+        self._write_header()
+
+    def _offset(self, page: int) -> int:
+        return HEADER_SIZE + (page - 1) * pygotu.PAGE_SIZE
+
+    def read_page(self, page: int) -> bytes:
+        self.f.seek(self._offset(page))
+        return self.f.read(pygotu.PAGE_SIZE)
+
+    def read_record(self, idx: int) -> bytes:
+        page, i = divmod(idx, pygotu.RECORDS_PER_PAGE)
+        self.f.seek(self._offset(page + 1) + i * pygotu.RECORD_SIZE)
+        return self.f.read(pygotu.RECORD_SIZE)
+
+    def store_page(self, page: int, buf: bytes, num_records: int):
+        """
+        Stores a page read from the device, num_records being the number of records
+        available in the cache once this page is written
+        """
+        self.f.seek(self._offset(page))
+        self.f.write(bytes(buf).ljust(pygotu.PAGE_SIZE, b"\xff"))
+        self.num_records = num_records
+        self.unsynced += 1
+        if self.unsynced >= SYNC_PAGES:
+            self.commit()
+
+    def full_pages(self, num_records: int) -> int:
+        """
+        Number of complete pages that can be served from the cache for a device
+        holding num_records records
+        """
+        return min(self.num_records, num_records) // pygotu.RECORDS_PER_PAGE
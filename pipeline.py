@@ -0,0 +1,276 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+
+import export
+import gtbatch
+import pygotu
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 16
+POLL_INTERVAL = 0.1
+
+# Marks the end of a stage output
+_END = object()
+
+
+def _completed(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class DownloadPipeline:
+    """
+    Overlaps the device transfers with the decoding and the consumer of the records:
+    - a reader thread owns the device and streams the flash pages in a bounded queue,
+    - a decoder thread decodes the validity and the dates of the pages at once,
+    - the caller consumes records() or tracks() in order in its own thread,
+    - with write_tracks(), a writer thread formats and writes the points the caller
+      hands over by chunks, see WriterStage.
+    Bounded queues stop the reader when the consumer lags behind. Leaving the iteration
+    early, or close(), cancels the download after the page being read.
+    With decode_processes > 0, the decoder thread hands the pages to a process pool, only
+    the decoded lists being sent back. This is off by default and slower than decoding in
+    the thread unless the decoding dominates, the pages being copied to the processes.
+    """
+    __slots__ = ['dev', 'cache', 'window', 'pages', 'decoded', 'cancelled', 'reader', 'decoder', 'pool']
+
+    def __init__(self, dev: pygotu.GT200Dev, cache=None, queue_size: int=DEFAULT_QUEUE_SIZE,
+                 decode_processes: int=0, window: pygotu.TimeWindow=None):
+        self.dev = dev
+        self.cache = cache
+        self.window = window
+        self.pages = queue.Queue(queue_size)
+        self.decoded = queue.Queue(queue_size)
+        self.cancelled = threading.Event()
+        self.pool = ProcessPoolExecutor(decode_processes) if decode_processes > 0 else None
+        self.reader = threading.Thread(target=self._read_pages, name="pygotu-reader", daemon=True)
+        self.decoder = threading.Thread(target=self._decode_pages, name="pygotu-decoder", daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        self.reader.start()
+        self.decoder.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def close(self):
+        self.cancel()
+        for thread in (self.reader, self.decoder):
+            if thread.is_alive():
+                thread.join()
+        if self.pool:
+            self.pool.shutdown(wait=True)
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        while not self.cancelled.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self.cancelled.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _read_pages(self):
+        try:
+            for first_idx, buf in self.dev.all_pages(self.cache, self.window):
+                if not self._put(self.pages, (first_idx, buf)):
+                    log.debug("Download cancelled at record %s", first_idx)
+                    return
+        except BaseException as e:
+            self._put(self.pages, e)
+        self._put(self.pages, _END)
+
+    def _decode_pages(self):
+        while True:
+            item = self._get(self.pages)
+            if item is _END or isinstance(item, BaseException):
+                self._put(self.decoded, item)
+                return
+
+            first_idx, buf = item
+            if self.pool:
+                future = self.pool.submit(gtbatch.page_fields, bytes(buf))
+            elif self.dev.stats is None:
+                future = _completed(gtbatch.page_fields(buf))
+            else:
+                with self.dev.stats.timer("decode"):
+                    future = _completed(gtbatch.page_fields(buf))
+            if not self._put(self.decoded, (first_idx, buf, future)):
+                return
+
+    def records(self, valid_only: bool=True):
+        """
+        Records in flash order, like GT200Dev.all_records()
+        """
+        if valid_only:
+            return (record for record in self.records(False) if record.valid)
+        return self._records()
+
+    def _records(self):
+        try:
+            while True:
+                item = self._get(self.decoded)
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                first_idx, buf, fields = item
+                records = pygotu.page_records(first_idx, buf, valid_only=False, fields=fields.result())
+                yield from records if self.window is None else self.window.filter(records)
+        finally:
+            self.cancel()
+
+    def tracks(self, **split_rules):
+        return pygotu.split_tracks(self.records(valid_only=False), **split_rules)
+
+    def stream_tracks(self, **split_rules):
+        import segment
+        return segment.stream_tracks(self.records(valid_only=False), **split_rules)
+
+    def _write(self, write, items):
+        stage = WriterStage(write, self.pages.maxsize)
+        try:
+            for item in items:
+                if not stage.put(item):
+                    break
+        except BaseException:
+            stage.join(raise_error=False)
+            raise
+        try:
+            stage.join()
+        except BaseException:
+            self.cancel()
+            raise
+
+    def write_tracks(self, writer: export.TrackWriter, tracks):
+        """
+        Same as writer.write_tracks(tracks), for tracks of this download like stream_tracks():
+        the caller segments the records, the writer stage formats and writes them
+        """
+        self._write(lambda items: writer.write_tracks(_queued_tracks(items)), _track_items(tracks))
+
+    def write_batch_tracks(self, writer: export.TrackWriter, batches):
+        """
+        Same as writer.write_batch_tracks(batches), the batches being computed by the caller
+        and written by the writer stage
+        """
+        self._write(writer.write_batch_tracks, batches)
+
+
+class WriterStage:
+    """
+    Writer thread running write(items), the items being produced by the caller and handed
+    over through a bounded queue: they are written while the next ones are produced.
+    An error of the writer stops put(), and is raised by join().
+    """
+    __slots__ = ['items', 'thread', 'error', 'ended']
+
+    def __init__(self, write, queue_size: int=DEFAULT_QUEUE_SIZE):
+        self.items = queue.Queue(queue_size)
+        self.error = None
+        self.ended = False
+        self.thread = threading.Thread(target=self._run, args=(write,), name="pygotu-writer", daemon=True)
+        self.thread.start()
+
+    def _queued(self):
+        while True:
+            item = self.items.get()
+            if item is _END:
+                self.ended = True
+                return
+            yield item
+
+    def _run(self, write):
+        try:
+            write(self._queued())
+        except BaseException as e:
+            self.error = e
+        # The caller may still be blocked on a full queue
+        while not self.ended:
+            for _ in self._queued():
+                pass
+
+    def put(self, item) -> bool:
+        if self.error is not None:
+            return False
+        self.items.put(item)
+        return True
+
+    def join(self, raise_error: bool=True):
+        self.items.put(_END)
+        self.thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
+
+
+class QueuedTrack:
+    """
+    Track rebuilt by the writer stage: its records are received by chunks
+    """
+    __slots__ = ['first_time', 'items', 'description', 'complete']
+
+    def __init__(self, first_time, items):
+        self.first_time = first_time
+        self.items = items
+        self.description = ""
+        self.complete = False
+
+    def __iter__(self):
+        for kind, value in self.items:
+            if kind == _TRACK_END:
+                self.description = value
+                self.complete = True
+                return
+            yield from value
+
+    def __str__(self):
+        return self.description
+
+
+# Items of the tracks handed to the writer stage: (_TRACK_START, first_time), then
+# (_TRACK_POINTS, records) for each chunk and (_TRACK_END, description)
+_TRACK_START = "start"
+_TRACK_POINTS = "points"
+_TRACK_END = "end"
+
+
+def _track_items(tracks):
+    for track in tracks:
+        yield _TRACK_START, track.first_time
+        records = iter(track)
+        while True:
+            chunk = list(islice(records, export.CHUNK_POINTS))
+            if not chunk:
+                break
+            yield _TRACK_POINTS, chunk
+        yield _TRACK_END, str(track)
+
+
+def _queued_tracks(items):
+    for _, first_time in items:
+        track = QueuedTrack(first_time, items)
+        yield track
+        if not track.complete:
+            # Skipped by the writer, like a track without waypoints
+            for _ in track:
+                pass
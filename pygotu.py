@@ -2,7 +2,8 @@ import datetime
 import logging
 import time
 from functools import lru_cache
-from struct import pack, unpack
+from operator import attrgetter
+from struct import Struct, pack, unpack
 
 log = logging.getLogger(__name__)
 
@@ -21,21 +22,43 @@ MODELS = {
     0x17: ("GT-200e/GT-600", 0x700, True),
 }
 
+# Page reads are retried on timeouts and broken responses, waiting RETRY_BACKOFF
+# seconds before the first retry, doubled up to MAX_RETRY_BACKOFF
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.05
+MAX_RETRY_BACKOFF = 1.0
+
+# Records read from a page to find its first timestamp, in ranged downloads
+PROBE_RECORDS = 4
+
+# Flash layout: records are 32 bytes, stored in 4 KiB pages starting at page 1
+PAGE_SIZE = 0x1000
+RECORD_SIZE = 0x20
+RECORDS_PER_PAGE = PAGE_SIZE // RECORD_SIZE
+
 def hexdumps(s: bytes) -> str:
     return s.hex()
 
 
-def bitcount(n: int) -> int:
-    count = 0
-    while n > 0:
-        if (n & 1 == 1):
-            count += 1
-        n >>= 1
+class HexDump:
+    """
+    Debug log argument, only hex encoded when the message is formatted
+    """
+    __slots__ = ['s']
+
+    def __init__(self, s: bytes):
+        self.s = s
+
+    def __str__(self):
+        return hexdumps(self.s)
 
-    return count
+
+def bitcount(n: int) -> int:
+    # The satellite map is a signed 32 bits field
+    return bin(n & 0xFFFFFFFF).count("1")
 
 
-@lru_cache(maxsize=4)
+@lru_cache(maxsize=16)
 def get_year(year_offset: int) -> int:
     current_year = datetime.date.today().year
     quotient = (current_year - 2000) // 16
@@ -47,13 +70,176 @@ def get_year(year_offset: int) -> int:
     return year
 
 
+# Device times are UTC
+LOCAL_OFFSET = datetime.timedelta(seconds=time.timezone)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_DAYS_IN_MONTH = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+# Days from January 1st to the first day of each month, in a non leap year
+_MONTH_OFFSETS = [0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
+
+
+def _is_leap(year: int) -> bool:
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+@lru_cache(maxsize=16)
+def _year_start(year_offset: int) -> tuple:
+    """
+    Days from the epoch to January 1st of the year, and whether it is a leap year
+    """
+    year = get_year(year_offset)
+    y = year - 1
+    days = 365 * (year - 1970) + (y // 4 - y // 100 + y // 400) - (1969 // 4 - 1969 // 100 + 1969 // 400)
+    return days, _is_leap(year)
+
+
+def _is_valid_date(ym: int, dhm: int) -> bool:
+    """
+    Same check as the datetime constructor in GTRecord, without building it
+    """
+    month = (ym & 0x0F) % 13
+    if month == 0:
+        return False
+    day = dhm >> 11
+    if day <= _DAYS_IN_MONTH[month]:
+        return True
+    return month == 2 and day == 29 and _year_start(ym >> 4)[1]
+
+
+def decode_epoch_ms(ym: int, dhm: int, ms: int) -> int:
+    """
+    UTC epoch milliseconds of the packed record date fields, None when the date is invalid.
+    Out of range fields are normalised like GTRecord does.
+    """
+    if not _is_valid_date(ym, dhm):
+        return None
+    month = (ym & 0x0F) % 13
+    day = dhm >> 11
+    year_days, leap = _year_start(ym >> 4)
+    days = year_days + _MONTH_OFFSETS[month] + (1 if leap and month > 2 else 0) + (day if day > 0 else 1) - 1
+    hour = ((dhm >> 6) & 0b00011111) % 24
+    minutes = (dhm & 0b00111111) % 60
+    return (((days * 24 + hour) * 60 + minutes) * 60 + (ms // 1000) % 60) * 1000 + ms % 1000
+
+
+def epoch_ms_to_datetime(epoch_ms: int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(milliseconds=epoch_ms)
+
+
+def datetime_to_epoch_ms(utc_time: datetime.datetime) -> int:
+    return (utc_time - _EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+@lru_cache(maxsize=256)
+def _iso_minute(epoch_minute: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:", time.gmtime(epoch_minute * 60))
+
+
+def format_isotime(epoch_ms: int) -> str:
+    """
+    ISO-8601 UTC time with microseconds, as written to GPX. The date part is cached,
+    consecutive records only differ by their seconds.
+    """
+    seconds, millis = divmod(epoch_ms, 1000)
+    minute, sec = divmod(seconds, 60)
+    return "{}{:02d}.{:03d}000Z".format(_iso_minute(minute), sec, millis)
+
+
+class FramingError(Exception):
+    pass
+
+
+# Commands, as the two 8 bytes halves sent by GT200Dev.write_cmd
+CMD_IDENTIFY = (b"\x93\x0a\x00\x00\x00\x00\x00\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00")
+CMD_MODEL = (b"\x93\x05\x04\x00\x03\x01\x9f\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00")
+CMD_COUNT = (b"\x93\x0b\x03\x00\x1d\x00\x00\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def encode_command(cmd1: bytes, cmd2: bytes) -> bytes:
+    """
+    The 16 bytes of a command, the last one being replaced by the checksum
+    """
+    assert len(cmd1) == 8
+    assert len(cmd2) == 8
+    cs = 0
+    for ch in cmd1 + cmd2[:7]:
+        cs += ch
+    cs = ((cs ^ 0xff) + 0x01) & 0xff
+    return cmd1 + cmd2[:7] + bytes([cs])
+
+
+def nmea_switch_command(mode: int) -> tuple:
+    mch = [b"\x00", b"\x01", b"\x02", b"\x03"][mode]
+    return b"\x93\x01\x01" + mch + b"\x00\x00\x00\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def flash_read_command(pos: int, size: int) -> tuple:
+    chpos = pack(">I", pos)
+    chsz = pack(">H", size)
+    return b"\x93\x05\x07" + chsz + b"\x04\x03" + chpos[1:2], chpos[2:4] + b"\x00\x00\x00\x00\x00\x00"
+
+
+def flash_write_purge_command(pos: int) -> tuple:
+    chpos = pack(">I", pos)
+    w = 0x20
+    return b"\x93\x06\x07\x00\x00\x04" + bytes([w, chpos[1]]), chpos[2:4] + b"\x00\x00\x00\x00\x00\x00"
+
+
+def unk_write1_command(p1: int) -> tuple:
+    return b"\x93\x06\x04\x00" + bytes([p1]) + b"\x01\x06\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def unk_write2_command(p1: int) -> tuple:
+    p1ch = pack('>H', p1)
+    return b"\x93\x05\x04" + p1ch + b"\x01\x05\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def unk_purge1_command(p1: int) -> tuple:
+    return b"\x93\x0C\x00" + bytes([p1]) + b"\x00\x00\x00\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def unk_purge2_command(p1: int) -> tuple:
+    return b"\x93\x08\x02" + bytes([p1]) + b"\x00\x00\x00\x00", b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def model_from_response(checkcode: int, model_code: int) -> tuple:
+    """
+    MODELS entry of a model query response, None if the response is unexpected
+    """
+    if checkcode != 0xC220:
+        log.error("Unexpected result from model query: %s", checkcode)
+        return None
+    current_model = MODELS.get(model_code)
+    if not current_model:
+        raise Exception("Unknown model: {}".format(model_code))
+    log.info("Found device: %s", current_model[0])
+    return current_model
+
+
 class GT200Dev:
-    __slots__ = ['dev', 'model_info']
+    __slots__ = ['dev', 'dev_read', 'model_code', 'model_info', 'serial', 'in_sync', 'resyncs', 'retries',
+                 'progress', 'stats', 'validator']
 
     def __init__(self, device):
         self.dev = device
+        # Connections providing read_view() hand out their receive buffer without copying it
+        self.dev_read = getattr(device, 'read_view', device.read)
         self.dev.flush()
+        self.model_code = 0x13
         self.model_info = MODELS[0x13]
+        self.serial = None
+        # Responses are read whole, so the connection only needs a flush once framing is lost
+        self.in_sync = True
+        self.resyncs = 0
+        self.retries = 0
+        # Called with (records read, records to read) after each page read by all_pages()
+        self.progress = None
+        # stats.Stats collecting the protocol statistics, see attach_stats()
+        self.stats = None
+        # integrity.PageValidator checking the pages read by all_pages(), reading suspect ones again
+        self.validator = None
 
     def __enter__(self):
         return self
@@ -64,27 +250,44 @@ class GT200Dev:
     def close(self):
         self.dev.close()
 
-    def write_cmd(self, cmd1, cmd2):
+    def attach_stats(self, stats: 'stats.Stats'):
+        """
+        Collects the protocol statistics in stats, including the transfers of the
+        connection when it supports it
+        """
+        self.stats = stats
+        if hasattr(self.dev, "stats"):
+            self.dev.stats = stats
+
+    def resync(self):
+        log.debug("Resynchronizing")
         self.dev.flush()
-        assert len(cmd1) == 8
-        assert len(cmd2) == 8
-        cs = 0
-        for ch in cmd1 + cmd2[:7]:
-            cs += ch
-        cs = ((cs ^ 0xff) + 0x01) & 0xff
-        cmd2 = cmd2[:7] + bytes([cs])
-        log.debug("Send1&2: %s", hexdumps(cmd1 + cmd2))
-        self.dev.write(cmd1 + cmd2)
+        self.in_sync = True
+        self.resyncs += 1
+        if self.stats is not None:
+            self.stats.resyncs += 1
+
+    def write_cmd(self, cmd1, cmd2):
+        if not self.in_sync:
+            self.resync()
+        cmd = encode_command(cmd1, cmd2)
+        log.debug("Send1&2: %s", HexDump(cmd))
+        self.dev.write(cmd)
+        if self.stats is not None:
+            self.stats.bytes_out += len(cmd)
 
     def read(self, sz) -> bytes:
-        result = self.dev.read(sz)
-        log.debug("Read: %s", hexdumps(result))
+        result = self.dev_read(sz)
+        log.debug("Read: %s", HexDump(result))
+        if self.stats is not None:
+            self.stats.bytes_in += len(result)
         return result
 
     def read_resp(self, fmt=None):
         recv = self.read(3)
-        if recv[0] != 0x93:
-            raise Exception("Unable to identify device")
+        if len(recv) < 3 or recv[0] != 0x93:
+            self.in_sync = False
+            raise FramingError("Unable to identify device")
         _, sz = unpack(">ch", recv)
         if sz < 0:
             log.debug("Read Error: %s", sz)
@@ -92,195 +295,497 @@ class GT200Dev:
         log.debug("Reading %s bytes...", sz)
 
         resp = self.read(sz)
+        if len(resp) < sz:
+            self.in_sync = False
+            raise FramingError("Truncated response: {} bytes out of {}".format(len(resp), sz))
         if fmt:
             return unpack(">" + fmt, resp)
         else:
             return resp
 
+    def transaction(self, cmd1, cmd2, fmt=None):
+        """
+        Sends a command and reads its response. When the response framing is broken,
+        the connection is resynchronized and the command sent again, once.
+        """
+        stats = self.stats
+        if stats is None:
+            return self._transaction(cmd1, cmd2, fmt)
+
+        start = time.perf_counter()
+        bytes_in = stats.bytes_in
+        try:
+            resp = self._transaction(cmd1, cmd2, fmt)
+        except BaseException as e:
+            stats.command(cmd1, (time.perf_counter() - start) * 1000, stats.bytes_in - bytes_in,
+                          error=True, timed_out=isinstance(e, TimeoutError))
+            raise
+        stats.command(cmd1, (time.perf_counter() - start) * 1000, stats.bytes_in - bytes_in, error=resp is None)
+        return resp
+
+    def _transaction(self, cmd1, cmd2, fmt=None):
+        for attempt in range(2):
+            try:
+                self.write_cmd(cmd1, cmd2)
+                return self.read_resp(fmt)
+            except FramingError:
+                if self.stats is not None:
+                    self.stats.framing_errors += 1
+                if attempt:
+                    raise
+                log.warning("Response framing lost, sending the command again")
+            except:
+                # The connection state is unknown after a transport error
+                self.in_sync = False
+                raise
+
     def nmea_switch(self, mode: int) -> None:
-        mch = [b"\x00", b"\x01", b"\x02", b"\x03"][mode]
-        self.write_cmd(
-            b"\x93\x01\x01" + mch + b"\x00\x00\x00\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        self.read(1)
+        cmd1, cmd2 = nmea_switch_command(mode)
+        start = time.perf_counter()
+        try:
+            self.write_cmd(cmd1, cmd2)
+            resp = self.read(1)
+        except BaseException as e:
+            if self.stats is not None:
+                self.stats.command(cmd1, (time.perf_counter() - start) * 1000, 0,
+                                   error=True, timed_out=isinstance(e, TimeoutError))
+            raise
+        finally:
+            # Only the first byte of the response is read
+            self.in_sync = False
+        if self.stats is not None:
+            self.stats.command(cmd1, (time.perf_counter() - start) * 1000, len(resp))
 
     def identify(self):
-        self.write_cmd(
-            b"\x93\x0a\x00\x00\x00\x00\x00\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        serial, v_maj, v_min, model, v_lib = self.read_resp(fmt="IbbHH")
+        serial, v_maj, v_min, model, v_lib = self.retry("identify", self.transaction, *CMD_IDENTIFY, "IbbHH")
         log.debug("Serial: %s", serial)
         log.debug("Ver: %s.%s", v_maj, v_min)
         log.debug("Model %s:", model)
         log.debug("USBlib: %s", v_lib)
+        self.serial = serial
+        return serial
 
     def model(self):
-        self.write_cmd(
-            b"\x93\x05\x04\x00\x03\x01\x9f\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        checkcode, model_code = self.read_resp(fmt="Hb")
-        if checkcode != 0xC220:
-            log.error("Unexpected result from model query: %s", checkcode)
-            return
-
-        current_model = MODELS.get(model_code)
-        if not current_model:
-            raise Exception("Unknown model: {}".format(model_code))
-        self.model_info = current_model
-        log.info("Found device: %s", current_model[0])
+        checkcode, model_code = self.retry("model query", self.transaction, *CMD_MODEL, "Hb")
+        current_model = model_from_response(checkcode, model_code)
+        if current_model:
+            self.model_code = model_code
+            self.model_info = current_model
 
     def count(self) -> int:
-        self.write_cmd(
-            b"\x93\x0b\x03\x00\x1d\x00\x00\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        n1, n2 = self.read_resp(fmt="Hb")
+        n1, n2 = self.retry("count", self.transaction, *CMD_COUNT, "HB")
         num = n1*256 + n2
         log.debug("Num DP: %s (%s %s)", num, n1, n2)
         return num
 
     def flash_read(self, pos: int=0, size: int=0x1000) -> bytes:
-        chpos = pack(">I", pos)
-        chsz = pack(">H", size)
-        self.write_cmd(
-            b"\x93\x05\x07" + chsz + b"\x04\x03" + chpos[1:2],
-            chpos[2:4] + b"\x00\x00\x00\x00\x00\x00"
-        )
-        buf = self.read_resp()
-        return buf
-
-    def purge_all_120(self):
-        purge_flag = False
-        n_blocks = self.model_info[1]
+        return self.transaction(*flash_read_command(pos, size))
+
+    def retry(self, description: str, command, *args):
+        """
+        Runs an idempotent command, retrying it with a bounded backoff when the transfer
+        times out, the response is broken or the device reports an error. The connection
+        is resynchronized before the retries following a transport error.
+        """
+        delay = RETRY_BACKOFF
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                self.retries += 1
+                if self.stats is not None:
+                    self.stats.retries += 1
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_BACKOFF)
+            try:
+                result = command(*args)
+            except (TimeoutError, FramingError) as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                log.warning("%s failed, retrying: %s", description, e)
+                self.resync()
+                continue
+            if result is not None:
+                return result
+            log.warning("Device error on %s", description)
+        raise Exception("Unable to run {} after {} retries".format(description, MAX_RETRIES))
+
+    def read_page(self, page: int) -> bytes:
+        """
+        Reads a whole flash page, see retry()
+        """
+        return self.retry("reading page {}".format(page), self.flash_read, page * PAGE_SIZE)
+
+    def is_block_empty(self, block: int) -> bool:
+        probe = self.retry("probing block {}".format(block), self.flash_read, block * PAGE_SIZE, 0x10)
+        return probe == (b"\xff" * 0x10)
+
+    def plan_purge(self, max_block: int) -> 'PurgePlan':
+        """
+        Finds the used blocks, between 1 and max_block, from the record count.
+        When the count does not match the flash content, the last used block is
+        found by a binary search over block emptiness.
+        """
+        plan = PurgePlan(max_block)
+        search = plan.search_blocks(self.count())
+        try:
+            block = next(search)
+            while True:
+                block = search.send(self.is_block_empty(block))
+        except StopIteration:
+            pass
+        log.debug("Purge plan: %s", plan)
+        return plan
+
+    def wait_ready(self, plan: 'PurgePlan'=None):
+        while True:
+            status = self.unk_write2(0x01)
+            # Every poll counts, the one finding the device ready included
+            if plan:
+                plan.polls += 1
+            if status == b"\x00":
+                return
+            log.debug("Waiting...")
+
+    def erase_block(self, block: int, plan: 'PurgePlan'=None):
+        self.unk_write1(0)
+        self.flash_write_purge(block * PAGE_SIZE)
+        if plan:
+            plan.erases += 1
+
+    def purge_all_120(self) -> 'PurgePlan':
         should_send_unk_1d_command = self.model_info[2]
+        plan = self.plan_purge(self.model_info[1])
 
-        for i in range(n_blocks, 0, -1):
+        for i in plan.blocks():
             log.debug("I=%s", i)
-            if purge_flag:
-                while self.unk_write2(0x01) != b"\x00":
-                    log.debug("Waiting...")
-                    pass
-            else:
-                if self.flash_read(pos=(i * 0x1000), size=0x10) != (b"\xff" * 0x10):
-                    purge_flag = True
-                else:
-                    continue
-            self.unk_write1(0)
-            self.flash_write_purge(i * 0x1000)
-        if purge_flag:
+            if plan.erases:
+                self.wait_ready(plan)
+            self.erase_block(i, plan)
+        if plan.erases:
             if should_send_unk_1d_command:
                 self.unk_purge1(0x1d)
             self.unk_purge1(0x1e)
             self.unk_purge1(0x1f)
-            while self.unk_write2(0x01) != b"\x00":
-                log.debug("Waiting...")
+            self.wait_ready(plan)
 
         if should_send_unk_1d_command:
             self.unk_purge1(0x1d)
         self.unk_purge1(0x1e)
         self.unk_purge1(0x1f)
+        log.info("Purged: %s", plan)
+        return plan
 
-    def purge_all_gt900(self):
-        purge_flag = False
-        n_blocks = 0x700
+    def purge_all_gt900(self) -> 'PurgePlan':
+        plan = self.plan_purge(0x700 - 1)
 
-        for i in range(n_blocks-1, 0, -1):
+        for i in plan.blocks():
             log.debug("I=%s", i)
-            if not purge_flag:
-                log.debug("NP")
-                if self.flash_read(pos=(i * 0x1000), size=0x10) != (b"\xff" * 0x10):
-                    log.debug("pf = true")
-                    purge_flag = True
-                else:
-                    log.debug("cont.")
-                    continue
-            log.debug("Writing")
-            self.unk_write1(0x00)
-            self.flash_write_purge(i * 0x1000)
-            log.debug("UNKW2")
-            while self.unk_write2(0x01) != b"\x00":
-                log.debug("Waiting...")
-            log.info("Purged.")
+            self.erase_block(i, plan)
+            self.wait_ready(plan)
+        log.info("Purged: %s", plan)
+        return plan
 
     def flash_write_purge(self, pos) -> bytes:
-        chpos = pack(">I", pos)
-        w = 0x20
-        self.write_cmd(
-            b"\x93\x06\x07\x00\x00\x04" + bytes([w, chpos[1]]),
-            chpos[2:4] + b"\x00\x00\x00\x00\x00\x00"
-        )
-        buf = self.read_resp()
-        return buf
+        return self.transaction(*flash_write_purge_command(pos))
 
     def unk_write1(self, p1: int) -> bytes:
-        self.write_cmd(
-            b"\x93\x06\x04\x00" + bytes([p1]) + b"\x01\x06\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        buf = self.read_resp()
-        return buf
+        return self.transaction(*unk_write1_command(p1))
 
     def unk_write2(self, p1: int) -> bytes:
-        p1ch = pack('>H', p1)
-        self.write_cmd(
-            b"\x93\x05\x04" + p1ch + b"\x01\x05\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        buf = self.read_resp()
-        return buf
+        # SPI status read, polled while the device is busy
+        return self.retry("status poll", self.transaction, *unk_write2_command(p1))
 
     def unk_purge1(self, p1: int) -> bytes:
-        self.write_cmd(
-            b"\x93\x0C\x00" + bytes([p1]) + b"\x00\x00\x00\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        buf = self.read_resp()
-        return buf
+        return self.transaction(*unk_purge1_command(p1))
 
     def unk_purge2(self, p1: int) -> bytes:
-        self.write_cmd(
-            b"\x93\x08\x02" + bytes([p1]) + b"\x00\x00\x00\x00",
-            b"\x00\x00\x00\x00\x00\x00\x00\x00"
-        )
-        buf = self.read_resp()
-        return buf
-
-    def all_records(self):
-        rpos = 0
-        buf = ""
-        num_rec_read = 0
+        return self.transaction(*unk_purge2_command(p1))
+
+    def all_pages(self, cache=None, window: 'TimeWindow'=None):
+        """
+        Yields (first record index, page buffer) for every flash page holding records,
+        the last page being truncated to the record count.
+        With a pagecache.PageCache, only the pages past the cached ones are read from the device.
+        With a TimeWindow, only the pages which may hold records in the window are read,
+        bypassing the cache.
+        """
         num_rec_all = self.count()
+        num_rec_read = 0
+        rpos = 0
 
-        RECSIZE = 0x20
-        while True:
+        if window is not None:
+            yield from self._window_pages(window, num_rec_all)
+            return
+
+        if cache is not None:
+            for rpos in range(1, self._check_cache(cache, num_rec_all) + 1):
+                yield num_rec_read, cache.read_page(rpos)
+                num_rec_read += RECORDS_PER_PAGE
+                if self.progress:
+                    self.progress(num_rec_read, num_rec_all)
+            log.debug("Read %s records from cache", num_rec_read)
+
+        while num_rec_read < num_rec_all:
             rpos += 1
-            buf = self.flash_read(rpos * 0x1000)
-            for i in range(len(buf) // RECSIZE):
-                record = GTRecord(num_rec_read, buf[i*RECSIZE:(i+1)*RECSIZE])
-                if record.valid:
-                    yield record
-                num_rec_read += 1
-                if num_rec_read >= num_rec_all:
-                    log.debug("End by count: %s", num_rec_all)
-                    return
-            log.debug("End RECLOOP")
-
-    def all_tracks(self):
-        idx = 0
-        curlist = []
-        for rec in self.all_records():
-            if rec.kind == 'WP':
-                curlist.append(rec)
-            if rec.kind == 'LOG' and rec.msg == 'RESET COUNTER':
-                if curlist:
-                    yield GTTrack(idx, curlist)
-                    idx += 1
-                    curlist = []
-        if curlist:
-            yield GTTrack(idx, curlist)
+            buf = self.read_page(rpos)
+            n = min(len(buf) // RECORD_SIZE, num_rec_all - num_rec_read)
+            buf = buf[:n * RECORD_SIZE]
+            if self.validator is not None:
+                buf = self.validator.validate(self, rpos, buf)
+            if cache is not None:
+                cache.store_page(rpos, buf, num_rec_read + n)
+            yield num_rec_read, buf
+            num_rec_read += n
+            if self.progress:
+                self.progress(num_rec_read, num_rec_all)
+        log.debug("End by count: %s", num_rec_all)
+
+    def page_first_time(self, page: int) -> int:
+        """
+        Epoch ms of the first dated record of a page, read with a small probe.
+        None when none of the PROBE_RECORDS first records is dated.
+        """
+        buf = self.retry("probing page {}".format(page), self.flash_read,
+                         page * PAGE_SIZE, PROBE_RECORDS * RECORD_SIZE)
+        for i in range(len(buf) // RECORD_SIZE):
+            epoch_ms = LazyGTRecord(0, buf, i * RECORD_SIZE).epoch_ms
+            if epoch_ms is not None:
+                return epoch_ms
+        return None
+
+    def find_page(self, epoch_ms: int, last_page: int) -> int:
+        """
+        Binary search of the last page starting at or before epoch_ms, records being
+        logged in chronological order. Pages whose probe has no date are considered later.
+        """
+        lo, hi = 1, last_page
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            first_time = self.page_first_time(mid)
+            if first_time is None or first_time > epoch_ms:
+                hi = mid - 1
+            else:
+                lo = mid
+        return lo
+
+    def _window_pages(self, window: 'TimeWindow', num_rec_all: int):
+        last_page = (num_rec_all + RECORDS_PER_PAGE - 1) // RECORDS_PER_PAGE
+        if last_page == 0:
+            return
+        first_page = 1 if window.since is None else self.find_page(window.since, last_page)
+        if window.until is not None:
+            last_page = self.find_page(window.until, last_page)
+        log.info("Reading pages %s to %s for %s", first_page, last_page, window)
+
+        for rpos in range(first_page, last_page + 1):
+            first_idx = (rpos - 1) * RECORDS_PER_PAGE
+            buf = self.read_page(rpos)
+            n = min(len(buf) // RECORD_SIZE, num_rec_all - first_idx)
+            buf = buf[:n * RECORD_SIZE]
+            if self.validator is not None:
+                buf = self.validator.validate(self, rpos, buf)
+            yield first_idx, buf
+            if self.progress:
+                self.progress((rpos - first_page + 1) * RECORDS_PER_PAGE,
+                              (last_page - first_page + 1) * RECORDS_PER_PAGE)
+
+    def _check_cache(self, cache, num_rec_all: int) -> int:
+        """
+        Returns the number of full pages that can be read from the cache, after checking
+        that the device still holds the last cached record
+        """
+        if cache.num_records == 0:
+            return 0
+        last_idx = cache.num_records - 1
+        if last_idx >= num_rec_all:
+            log.info("Device holds less records than the cache, it has been purged")
+            cache.clear()
+            return 0
+
+        page, i = divmod(last_idx, RECORDS_PER_PAGE)
+        probe = self.retry("probing the last cached record", self.flash_read,
+                           (page + 1) * PAGE_SIZE + i * RECORD_SIZE, RECORD_SIZE)
+        if probe != cache.read_record(last_idx):
+            log.info("Last cached record changed on the device, it has been purged")
+            cache.clear()
+            return 0
+        return cache.full_pages(num_rec_all)
+
+    def all_records(self, cache=None, valid_only: bool=True, window: 'TimeWindow'=None):
+        for first_idx, buf in self.all_pages(cache, window):
+            if self.stats is None:
+                records = page_records(first_idx, buf, valid_only=valid_only)
+            else:
+                with self.stats.timer("decode"):
+                    records = page_records(first_idx, buf, valid_only=valid_only)
+            yield from records if window is None else window.filter(records)
+
+    def all_batches(self, cache=None):
+        """
+        Same as all_records, but yields one columnar gtbatch.RecordBatch per flash page.
+        Invalid records are kept, see RecordBatch.valid.
+        """
+        import gtbatch
+        for first_idx, buf in self.all_pages(cache):
+            if self.stats is None:
+                yield gtbatch.decode_page(buf, first_idx)
+            else:
+                with self.stats.timer("decode"):
+                    batch = gtbatch.decode_page(buf, first_idx)
+                yield batch
+
+    def all_tracks(self, cache=None, window: 'TimeWindow'=None, **split_rules):
+        return split_tracks(self.all_records(cache, False, window), **split_rules)
+
+    def stream_tracks(self, cache=None, window: 'TimeWindow'=None, **split_rules):
+        """
+        Same as all_tracks, in constant memory: tracks are segment.StreamingTrack
+        objects whose points are streamed from the device
+        """
+        import segment
+        return segment.stream_tracks(self.all_records(cache, False, window), **split_rules)
+
+    def pipeline(self, cache=None, **kwargs) -> 'pipeline.DownloadPipeline':
+        """
+        Download running the device reads, the decoding and the consumer concurrently,
+        see pipeline.DownloadPipeline for the options
+        """
+        import pipeline
+        return pipeline.DownloadPipeline(self, cache, **kwargs)
+
+
+def open_device(connection, stats: 'stats.Stats'=None) -> GT200Dev:
+    """
+    GT200Dev on a connection, switched to the configuration mode and identified.
+    With a stats.Stats, the statistics of the whole session are collected, the
+    commands opening it included.
+    """
+    dev = GT200Dev(connection)
+    if stats is not None:
+        dev.attach_stats(stats)
+    dev.nmea_switch(MODE_CONFIGURE)
+    dev.identify()
+    dev.model()
+    return dev
+
+
+def page_records(first_idx: int, buf, record_type=None, valid_only: bool=True, fields: tuple=None) -> list:
+    """
+    Decodes the records of a flash page, as LazyGTRecord by default. fields are the
+    (valid, epoch_ms) lists of gtbatch.page_fields(), set on the LazyGTRecord instead
+    of decoding them record by record.
+    """
+    if record_type is None or record_type is LazyGTRecord:
+        records = [LazyGTRecord(first_idx + i, buf, i * RECORD_SIZE) for i in range(len(buf) // RECORD_SIZE)]
+        if fields is not None:
+            for record, valid, epoch_ms in zip(records, *fields):
+                record._valid = valid
+                record._epoch_ms = epoch_ms
+    else:
+        records = [record_type(first_idx + i, buf[i*RECORD_SIZE:(i+1)*RECORD_SIZE])
+                   for i in range(len(buf) // RECORD_SIZE)
+                   if buf[i*RECORD_SIZE] != 0xF5]
+    if valid_only:
+        return [record for record in records if record.valid]
+    return records
+
+
+def split_tracks(records, **split_rules):
+    """
+    Tracks of a log, holding their records. The log must include invalid records,
+    see segment.TrackSegmenter for the split rules.
+    """
+    import segment
+    for track in segment.stream_tracks(records, **split_rules):
+        yield GTTrack(track.idx, track)
+
+
+class TimeWindow:
+    """
+    Time range of a partial download, bounds in UTC epoch ms, None for no bound
+    """
+    __slots__ = ['since', 'until']
+
+    def __init__(self, since: int=None, until: int=None):
+        self.since = since
+        self.until = until
+
+    def contains(self, epoch_ms: int) -> bool:
+        if epoch_ms is None:
+            return False
+        return ((self.since is None or epoch_ms >= self.since) and
+                (self.until is None or epoch_ms <= self.until))
+
+    def filter(self, records) -> list:
+        return [record for record in records if self.contains(record.epoch_ms)]
+
+    def mask(self, epoch_ms):
+        """
+        Boolean mask of the times of a NumPy array within the window
+        """
+        since = -(1 << 63) if self.since is None else self.since
+        until = (1 << 63) - 1 if self.until is None else self.until
+        return (epoch_ms >= since) & (epoch_ms <= until)
+
+    def __str__(self):
+        since = "..." if self.since is None else format_isotime(self.since)
+        until = "..." if self.until is None else format_isotime(self.until)
+        return "[{} - {}]".format(since, until)
+
+
+class PurgePlan:
+    """
+    Blocks to erase during a purge, and the number of commands it took
+    """
+    __slots__ = ['max_block', 'last_block', 'searched', 'probes', 'erases', 'polls']
+
+    def __init__(self, max_block: int):
+        self.max_block = max_block
+        self.last_block = 0
+        self.searched = False
+        self.probes = 0
+        self.erases = 0
+        self.polls = 0
+
+    def search_blocks(self, num: int):
+        """
+        Generator finding last_block from the record count num: it yields the blocks
+        whose emptiness is needed, and must be sent whether each one is empty
+        """
+        max_block = self.max_block
+        last_block = min((num + RECORDS_PER_PAGE - 1) // RECORDS_PER_PAGE, max_block)
+        self.probes += 1
+        if last_block == 0:
+            reliable = yield 1
+        elif (yield last_block):
+            reliable = False
+        elif last_block < max_block:
+            self.probes += 1
+            reliable = yield last_block + 1
+        else:
+            reliable = True
+
+        if not reliable:
+            log.info("Record count %s does not match the flash content, searching used blocks", num)
+            self.searched = True
+            # Used blocks are contiguous from block 1: block lo is used and block hi empty
+            lo, hi = 0, max_block + 1
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                self.probes += 1
+                if (yield mid):
+                    hi = mid
+                else:
+                    lo = mid
+            last_block = lo
+
+        self.last_block = last_block
+
+    def blocks(self):
+        # Erased from the end of the log, as the device firmware does
+        return range(self.last_block, 0, -1)
+
+    def __str__(self):
+        return "blocks:[1-{0.last_block}]/{0.max_block} searched:{0.searched} probes:{0.probes} erases:{0.erases} polls:{0.polls}".format(self)
 
 
 class GTTrack:
@@ -290,6 +795,9 @@ class GTTrack:
         self.idx = idx
         self.records = list(reclist)
 
+    def __iter__(self):
+        return iter(self.records)
+
     @property
     def first_point(self):
         return self.records[0]
@@ -302,6 +810,14 @@ class GTTrack:
     def first_time(self):
         return self.first_point.localtime
 
+    @property
+    def first_epoch_ms(self):
+        return self.first_point.epoch_ms
+
+    @property
+    def last_epoch_ms(self):
+        return self.last_point.epoch_ms
+
     @property
     def last_time(self):
         return self.last_point.localtime
@@ -310,6 +826,13 @@ class GTTrack:
     def num_points(self):
         return len(self.records)
 
+    def statistics(self) -> 'trackstats.TrackStats':
+        """
+        Distance, moving time, speeds, elevation gain and loss and satellites of the track
+        """
+        import trackstats
+        return trackstats.TrackStats.of_records(self.records)
+
     def __str__(self):
         return "{0.idx}: {0.first_time:%Y/%m/%d %H:%M:%S} - {0.last_time:%Y/%m/%d %H:%M:%S} points:[{0.num_points}]".format(self)
 
@@ -338,7 +861,7 @@ class GTRecord:
 
         try:
             self.datetime = datetime.datetime(
-                year, month, day, hour, minutes, sec, ms)
+                year, month, day, hour, minutes, sec, ms * 1000)
         except ValueError:
             self.datetime = None
             self.valid = False
@@ -365,7 +888,17 @@ class GTRecord:
 
     @property
     def localtime(self):
-        return self.datetime - datetime.timedelta(seconds=time.timezone)
+        return self.datetime - LOCAL_OFFSET
+
+    @property
+    def epoch_ms(self):
+        if self.datetime is None:
+            return None
+        return datetime_to_epoch_ms(self.datetime)
+
+    @property
+    def isotime(self):
+        return format_isotime(self.epoch_ms)
 
     def parse_waypoint(self):
         self.kind = "WP"
@@ -402,7 +935,7 @@ class GTRecord:
 
     def parse_device_log(self):
         self.kind = "LOG"
-        self.msg = self.s[0x06:0x1e].replace('\x00', '').strip()
+        self.msg = bytes(self.s[0x06:0x1e]).replace(b'\x00', b'').strip().decode('ascii', 'replace')
         self.desc = "LOG {0.msg}".format(self)
 
     def parse_unknown(self):
@@ -413,6 +946,163 @@ class GTRecord:
         return "{0.datetime:%Y/%m/%d %H:%M:%S} {0.desc}".format(self)
 
 
+_HEADER = Struct(">BBHH")
+_WAYPOINT = Struct(">HiiiiHHH")
+_POSITION = Struct(">ii")
+
+FLAGNAMES = ["U0", "U1", "WP", "U3", "NDI", "TSTOP", "TSTART", "U7"]
+
+def _cached(slot: str, decode):
+    """
+    Property decoding a field on first access, cached in the given slot
+    """
+    get = attrgetter(slot)
+
+    def fget(self):
+        try:
+            return get(self)
+        except AttributeError:
+            value = decode(self)
+            setattr(self, slot, value)
+            return value
+    return property(fget)
+
+
+class LazyGTRecord:
+    """
+    Same fields as GTRecord, decoded on first access from the page buffer holding the
+    record: the header and the waypoint block are unpacked once, the costlier fields
+    (datetime, sat, flagopts, msg, desc) are cached. Invalid records are not logged.
+    """
+    __slots__ = ['idx', 'buf', 'offset', 'header', '_waypoint', '_valid', '_epoch_ms', '_sat',
+                 '_flagopts', '_msg', '_desc']
+
+    def __init__(self, idx, buf, offset: int=0):
+        self.idx = idx
+        self.buf = buf
+        self.offset = offset
+        # flag, ym, dhm, ms
+        self.header = _HEADER.unpack_from(buf, offset)
+
+    @property
+    def s(self) -> memoryview:
+        return memoryview(self.buf)[self.offset:self.offset + RECORD_SIZE]
+
+    @property
+    def flag(self) -> int:
+        return self.header[0]
+
+    @property
+    def kind(self) -> str:
+        flag = self.header[0]
+        if flag == 0xF1:
+            return "LOG"
+        if flag == 0xF5:
+            return "HB"
+        return "WP"
+
+    @property
+    def is_waypoint(self):
+        return self.kind == "WP"
+
+    def _decode_valid(self):
+        flag, ym, dhm, _ = self.header
+        if flag & 0x20 != 0 or not _is_valid_date(ym, dhm):
+            return False
+        if flag == 0xF1 or flag == 0xF5:
+            return True
+        return _POSITION.unpack_from(self.buf, self.offset + 0x0c) != (0, 0)
+
+    valid = _cached('_valid', _decode_valid)
+
+    epoch_ms = _cached('_epoch_ms', lambda self: decode_epoch_ms(*self.header[1:]))
+
+    @property
+    def datetime(self):
+        epoch_ms = self.epoch_ms
+        return None if epoch_ms is None else epoch_ms_to_datetime(epoch_ms)
+
+    @property
+    def localtime(self):
+        return self.datetime - LOCAL_OFFSET
+
+    @property
+    def isotime(self):
+        return format_isotime(self.epoch_ms)
+
+    def _decode_waypoint(self):
+        if self.kind != "WP":
+            raise AttributeError("{} record has no waypoint fields".format(self.kind))
+        # ae, sat map, lat, lon, elevation, speed, course, f2
+        return _WAYPOINT.unpack_from(self.buf, self.offset + 0x06)
+
+    waypoint = _cached('_waypoint', _decode_waypoint)
+
+    @property
+    def lat(self):
+        return self.waypoint[2] / 10000000.0
+
+    @property
+    def lon(self):
+        return self.waypoint[3] / 10000000.0
+
+    @property
+    def elevation(self):
+        return self.waypoint[4] / 100.0  # in m
+
+    @property
+    def speed(self):
+        return (self.waypoint[5] / 100.0) / 1000.0 * 3600.0  # km/h
+
+    @property
+    def course(self):
+        return self.waypoint[6] / 100.0  # degree
+
+    @property
+    def ehpe(self):
+        return (self.waypoint[0] & 0b0000111111111111) * 1e-2 * 0x10  # in m
+
+    @property
+    def unk1(self):
+        return self.waypoint[0] >> 12
+
+    sat = _cached('_sat', lambda self: bitcount(self.waypoint[1]))
+
+    @property
+    def plr(self):
+        return unpack(">H", self.buf[self.offset + 0x1e:self.offset + 0x20])
+
+    def _decode_flagopts(self):
+        if self.kind != "WP":
+            raise AttributeError("{} record has no flagopts field".format(self.kind))
+        flag = self.header[0]
+        return set(FLAGNAMES[bit] for bit in range(8) if flag & (1 << bit))
+
+    flagopts = _cached('_flagopts', _decode_flagopts)
+
+    def _decode_msg(self):
+        if self.kind != "LOG":
+            return None
+        start = self.offset + 0x06
+        return bytes(self.buf[start:start + 0x18]).replace(b'\x00', b'').strip().decode('ascii', 'replace')
+
+    msg = _cached('_msg', _decode_msg)
+
+    def _format_desc(self):
+        kind = self.kind
+        if kind == "WP":
+            return "WP LATLON:({0.lat}, {0.lon}) ele:{0.elevation} speed:{0.speed} uf={0.unk1:b} ehpe={0.ehpe} {0.flagopts}".format(
+                self)
+        if kind == "LOG":
+            return "LOG {0.msg}".format(self)
+        return "UNK {0.flag}".format(self)
+
+    desc = _cached('_desc', _format_desc)
+
+    def __str__(self):
+        return "{0.datetime:%Y/%m/%d %H:%M:%S} {0.desc}".format(self)
+
+
 def test():
     import connections
     dev = GT200Dev(connections.get_connection())
@@ -0,0 +1,339 @@
+import logging
+import time
+from struct import calcsize, pack, unpack_from
+
+log = logging.getLogger(__name__)
+
+TRACE_MAGIC = b"GTTR"
+TRACE_VERSION = 1
+
+# magic, version, label length, creation time (epoch ms), followed by the label (UTF-8)
+HEADER_FORMAT = ">4sBHQ"
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+
+# Each event is its kind byte (operation | outcome), then as varints: the time since the
+# end of the previous event and the duration of the call, in µs, the requested size and
+# the data size, followed by the data: the command of a write, the bytes returned by a
+# read, the message of an error
+OP_WRITE = 0x01
+OP_READ = 0x02
+OP_FLUSH = 0x03
+OP_MASK = 0x0f
+
+OUTCOME_OK = 0x00
+OUTCOME_TIMEOUT = 0x10
+OUTCOME_ERROR = 0x20
+OUTCOME_MASK = 0xf0
+
+OP_NAMES = {OP_WRITE: "write", OP_READ: "read", OP_FLUSH: "flush"}
+
+# Replay delays shorter than this, in s, are accumulated instead of slept one by one
+MIN_SLEEP = 0.001
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(buf, pos: int) -> tuple:
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+class ReplayMismatch(Exception):
+    """
+    Raised when the commands sent during a replay differ from the recorded ones
+    """
+    pass
+
+
+class ReplayedError(Exception):
+    """
+    Transport error, other than a timeout, found in a replayed trace
+    """
+    pass
+
+
+class TraceEvent:
+    __slots__ = ['op', 'outcome', 'gap_us', 'duration_us', 'size', 'data']
+
+    def __init__(self, op: int, outcome: int, gap_us: int, duration_us: int, size: int, data: bytes):
+        self.op = op
+        self.outcome = outcome
+        self.gap_us = gap_us
+        self.duration_us = duration_us
+        self.size = size
+        self.data = data
+
+    def __str__(self):
+        outcome = {OUTCOME_OK: "", OUTCOME_TIMEOUT: " timeout", OUTCOME_ERROR: " error"}[self.outcome]
+        return "+{}us {}({}){} {}us {}".format(self.gap_us, OP_NAMES[self.op], self.size, outcome,
+                                                self.duration_us, self.data.hex())
+
+
+class TraceWriter:
+    """
+    Writes the events of a connection to a compact binary trace
+    """
+    __slots__ = ['path', 'f', 'last', 'events']
+
+    def __init__(self, path: str, label: str=""):
+        self.path = path
+        encoded_label = label.encode("utf-8")
+        self.f = open(path, "wb")
+        self.f.write(pack(HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION, len(encoded_label), int(time.time() * 1000)))
+        self.f.write(encoded_label)
+        self.last = time.perf_counter()
+        self.events = 0
+
+    def event(self, kind: int, start: float, end: float, size: int, data=b""):
+        gap_us = max(0, int((start - self.last) * 1000000))
+        duration_us = max(0, int((end - start) * 1000000))
+        self.last = end
+        self.f.write(bytes([kind]) + _varint(gap_us) + _varint(duration_us) + _varint(size) + _varint(len(data)))
+        self.f.write(data)
+        self.events += 1
+
+    def close(self):
+        self.f.close()
+        log.info("Wrote %s events to %s", self.events, self.path)
+
+
+class Trace:
+    """
+    Events of a trace written by a RecordingConnection
+    """
+    __slots__ = ['path', 'label', 'created', 'events']
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            buf = f.read()
+
+        magic, version, label_size, self.created = unpack_from(HEADER_FORMAT, buf)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise Exception("Not a connection trace: {}".format(path))
+        pos = HEADER_SIZE + label_size
+        self.label = buf[HEADER_SIZE:pos].decode("utf-8")
+
+        self.events = []
+        while pos < len(buf):
+            kind = buf[pos]
+            gap_us, pos = _read_varint(buf, pos + 1)
+            duration_us, pos = _read_varint(buf, pos)
+            size, pos = _read_varint(buf, pos)
+            data_size, pos = _read_varint(buf, pos)
+            self.events.append(TraceEvent(kind & OP_MASK, kind & OUTCOME_MASK, gap_us, duration_us, size,
+                                          buf[pos:pos + data_size]))
+            pos += data_size
+
+    @property
+    def duration(self) -> float:
+        """
+        Duration of the recorded session, in s
+        """
+        return sum(event.gap_us + event.duration_us for event in self.events) / 1000000.0
+
+    @property
+    def device_time(self) -> float:
+        """
+        Time spent in the connection calls, in s: the part reproduced by a replay
+        """
+        return sum(event.duration_us for event in self.events) / 1000000.0
+
+    def __str__(self):
+        return "{} ({}): {} events, {:.3f} s, {:.3f} s in transfers".format(
+            self.path, self.label, len(self.events), self.duration, self.device_time)
+
+
+class RecordingConnection:
+    """
+    Wraps a connection, like the ones returned by connections.get_connection(),
+    logging every write, read and flush with its timing to a trace file
+    """
+    __slots__ = ['connection', 'connection_read', 'trace']
+
+    def __init__(self, connection, path: str, label: str=""):
+        self.connection = connection
+        self.connection_read = getattr(connection, 'read_view', connection.read)
+        self.trace = TraceWriter(path, label)
+
+    @property
+    def stats(self):
+        return getattr(self.connection, "stats", None)
+
+    @stats.setter
+    def stats(self, stats):
+        if hasattr(self.connection, "stats"):
+            self.connection.stats = stats
+
+    def _record(self, op: int, size: int, call, *args, data=b""):
+        start = time.perf_counter()
+        try:
+            result = call(*args)
+        except TimeoutError:
+            self.trace.event(op | OUTCOME_TIMEOUT, start, time.perf_counter(), size, data)
+            raise
+        except Exception as e:
+            self.trace.event(op | OUTCOME_ERROR, start, time.perf_counter(), size, data or str(e).encode("utf-8"))
+            raise
+        end = time.perf_counter()
+        self.trace.event(op, start, end, size, result if op == OP_READ else data)
+        return result
+
+    def write(self, data):
+        return self._record(OP_WRITE, len(data), self.connection.write, data, data=bytes(data))
+
+    def read(self, size=1):
+        return bytes(self.read_view(size))
+
+    def read_view(self, size=1):
+        return self._record(OP_READ, size, self.connection_read, size)
+
+    def read_some(self, size=1):
+        import connections
+        return self._record(OP_READ, size, connections.read_some, self.connection, size)
+
+    def flush(self):
+        self._record(OP_FLUSH, 0, self.connection.flush)
+
+    def close(self):
+        try:
+            self.connection.close()
+        finally:
+            self.trace.close()
+
+
+class ReplayConnection:
+    """
+    Plays a trace back behind the read/write/flush/close surface of the connections.
+    The calls take their recorded duration divided by speed, without waiting when
+    speed is 0. Written commands must match the recorded ones; the recorded responses
+    are served as a byte stream, so they can be read in different chunks.
+    """
+    __slots__ = ['trace', 'events', 'pos', 'speed', 'pending', 'pending_pos', 'owed',
+                 'bytes_in', 'bytes_out', 'transfers', 'flushes', 'skipped']
+
+    def __init__(self, trace, speed: float=1.0):
+        self.trace = trace if isinstance(trace, Trace) else Trace(trace)
+        self.events = self.trace.events
+        self.pos = 0
+        self.speed = speed
+        self.pending = b""
+        self.pending_pos = 0
+        # Delay not slept yet, negative when sleeping overshot
+        self.owed = 0.0
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.transfers = 0
+        self.flushes = 0
+        # Recorded events the replayed client did not ask for
+        self.skipped = 0
+
+    def _wait(self, event: TraceEvent):
+        if not self.speed:
+            return
+        self.owed += event.duration_us / 1000000.0 / self.speed
+        if self.owed >= MIN_SLEEP:
+            start = time.perf_counter()
+            time.sleep(self.owed)
+            self.owed -= time.perf_counter() - start
+
+    def _consume(self) -> TraceEvent:
+        event = self.events[self.pos]
+        self.pos += 1
+        self._wait(event)
+        if event.outcome == OUTCOME_TIMEOUT:
+            raise TimeoutError("Replayed {} timeout".format(OP_NAMES[event.op]))
+        if event.outcome == OUTCOME_ERROR:
+            raise ReplayedError("Replayed {} error: {}".format(
+                OP_NAMES[event.op], event.data.decode("utf-8", "replace")))
+        return event
+
+    def _skip(self, ops: tuple) -> TraceEvent:
+        """
+        Drops the response data left unread and the recorded ops events, returning the next event
+        """
+        self.pending = b""
+        self.pending_pos = 0
+        while self.pos < len(self.events) and self.events[self.pos].op in ops:
+            self.pos += 1
+            self.skipped += 1
+        return self.events[self.pos] if self.pos < len(self.events) else None
+
+    def write(self, data):
+        data = bytes(data)
+        recorded = self._skip((OP_READ, OP_FLUSH))
+        if recorded is None:
+            raise ReplayMismatch("Command {} sent after the end of the trace".format(data.hex()))
+        if recorded.data != data:
+            raise ReplayMismatch("Command {} sent instead of {} (event {})".format(
+                data.hex(), recorded.data.hex(), self.pos))
+        self.transfers += 1
+        self.bytes_out += len(data)
+        self._consume()
+        return len(data)
+
+    def read(self, size=1):
+        if self.pending_pos >= len(self.pending) and self.pos < len(self.events):
+            event = self.events[self.pos]
+            if event.op == OP_READ and event.size == size:
+                # Same read as recorded, short reads included
+                data = self._consume().data
+                self.bytes_in += len(data)
+                return data
+
+        out = bytearray()
+        while len(out) < size:
+            if self.pending_pos >= len(self.pending):
+                if self.pos >= len(self.events) or self.events[self.pos].op != OP_READ:
+                    raise TimeoutError("No more recorded response")
+                self.pending = self._consume().data
+                self.pending_pos = 0
+            taken = self.pending[self.pending_pos:self.pending_pos + size - len(out)]
+            self.pending_pos += len(taken)
+            out.extend(taken)
+        self.bytes_in += len(out)
+        return bytes(out)
+
+    def read_some(self, size=1):
+        """
+        Replays a read of the NMEA stream: the data of the next recorded read, up to size
+        bytes. Raises EOFError at the end of the recorded stream.
+        """
+        if self.pending_pos >= len(self.pending):
+            if self.pos >= len(self.events) or self.events[self.pos].op != OP_READ:
+                raise EOFError("End of the recorded stream")
+            try:
+                self.pending = self._consume().data
+            except TimeoutError:
+                return b""
+            self.pending_pos = 0
+        data = self.pending[self.pending_pos:self.pending_pos + size]
+        self.pending_pos += len(data)
+        self.bytes_in += len(data)
+        return data
+
+    def flush(self):
+        self.flushes += 1
+        # A flush not recorded only drops the pending data
+        recorded = self._skip((OP_READ,))
+        if recorded is not None and recorded.op == OP_FLUSH:
+            self._consume()
+
+    def close(self):
+        if self.pos < len(self.events):
+            log.debug("Replay closed with %s events left", len(self.events) - self.pos)
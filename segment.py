@@ -0,0 +1,190 @@
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+FLAG_TSTOP = 0x20
+FLAG_TSTART = 0x40
+RESET_MESSAGE = 'RESET COUNTER'
+
+EARTH_RADIUS = 6371008.8  # mean radius, in m
+
+# Returned when reading a record which ends the current track
+SPLIT = object()
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Great circle distance between two points, in m
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class StreamingTrack:
+    """
+    Track whose points are streamed from the log: iterating it yields the valid waypoints,
+    which are not kept. Only running aggregates are: first/last point, point count and
+    bounding box, complete once the track has been iterated.
+    """
+    __slots__ = ['idx', 'segmenter', 'first_point', 'last_point', 'num_points',
+                 'min_lat', 'min_lon', 'max_lat', 'max_lon', 'complete', 'points']
+
+    def __init__(self, idx: int, segmenter: 'TrackSegmenter', first_point):
+        self.idx = idx
+        self.segmenter = segmenter
+        self.first_point = first_point
+        self.last_point = None
+        self.num_points = 0
+        self.min_lat = self.max_lat = first_point.lat
+        self.min_lon = self.max_lon = first_point.lon
+        self.complete = False
+        self.points = self._points()
+
+    def _add(self, rec):
+        self.last_point = rec
+        self.num_points += 1
+        lat = rec.lat
+        lon = rec.lon
+        if lat < self.min_lat:
+            self.min_lat = lat
+        elif lat > self.max_lat:
+            self.max_lat = lat
+        if lon < self.min_lon:
+            self.min_lon = lon
+        elif lon > self.max_lon:
+            self.max_lon = lon
+
+    def __iter__(self):
+        return self.points
+
+    def _points(self):
+        rec = self.first_point
+        while rec is not None:
+            self._add(rec)
+            yield rec
+            rec = self.segmenter._next_point(rec)
+        self.complete = True
+
+    def drain(self):
+        for _ in self.points:
+            pass
+
+    @property
+    def bbox(self) -> tuple:
+        return self.min_lat, self.min_lon, self.max_lat, self.max_lon
+
+    @property
+    def first_time(self):
+        return self.first_point.localtime
+
+    @property
+    def last_time(self):
+        return self.last_point.localtime
+
+    @property
+    def first_epoch_ms(self):
+        return self.first_point.epoch_ms
+
+    @property
+    def last_epoch_ms(self):
+        return self.last_point.epoch_ms
+
+    def __str__(self):
+        return "{0.idx}: {0.first_time:%Y/%m/%d %H:%M:%S} - {0.last_time:%Y/%m/%d %H:%M:%S} points:[{0.num_points}]".format(self)
+
+
+class TrackSegmenter:
+    """
+    Splits a log in tracks while streaming it, in constant memory. It must be fed every
+    record, invalid ones included: the 'RESET COUNTER' device logs and TSTOP waypoints
+    are flagged invalid by the device. A track ends:
+    - on a 'RESET COUNTER' device log,
+    - with split_on_flags, on a TSTOP waypoint or before a TSTART one,
+    - before a point more than max_gap seconds after the previous one,
+    - before a point more than max_jump m away from the previous one.
+    """
+    __slots__ = ['records', 'max_gap_ms', 'max_jump', 'split_on_flags', 'pending']
+
+    def __init__(self, records, max_gap: float=None, max_jump: float=None, split_on_flags: bool=False):
+        self.records = iter(records)
+        self.max_gap_ms = None if max_gap is None else max_gap * 1000
+        self.max_jump = max_jump
+        self.split_on_flags = split_on_flags
+        # Point which ended the previous track, starting the next one
+        self.pending = None
+
+    def _read(self):
+        """
+        Next valid waypoint, SPLIT on a split record, None at the end of the log
+        """
+        if self.pending is not None:
+            rec = self.pending
+            self.pending = None
+            return rec
+
+        for rec in self.records:
+            rec = self.classify(rec)
+            if rec is not None:
+                return rec
+        return None
+
+    def classify(self, rec):
+        """
+        rec if it is a valid waypoint, SPLIT if it ends the current track, None otherwise
+        """
+        kind = rec.kind
+        if kind == 'LOG':
+            if rec.msg == RESET_MESSAGE:
+                return SPLIT
+        elif kind == 'WP':
+            if self.split_on_flags and rec.flag & FLAG_TSTOP:
+                return SPLIT
+            if rec.valid:
+                return rec
+        return None
+
+    def splits(self, last, rec) -> bool:
+        if self.split_on_flags and rec.flag & FLAG_TSTART:
+            return True
+        if self.max_gap_ms is not None and rec.epoch_ms - last.epoch_ms > self.max_gap_ms:
+            return True
+        if self.max_jump is not None and haversine(last.lat, last.lon, rec.lat, rec.lon) > self.max_jump:
+            return True
+        return False
+
+    def _next_point(self, last):
+        rec = self._read()
+        if rec is None or rec is SPLIT:
+            return None
+        if self.splits(last, rec):
+            self.pending = rec
+            return None
+        return rec
+
+    def tracks(self):
+        """
+        Yields StreamingTrack objects, each one to be iterated before the next one is
+        read: the remaining points of a track are skipped otherwise
+        """
+        idx = 0
+        while True:
+            rec = self._read()
+            while rec is SPLIT:
+                rec = self._read()
+            if rec is None:
+                return
+            track = StreamingTrack(idx, self, rec)
+            yield track
+            track.drain()
+            idx += 1
+
+
+def stream_tracks(records, **split_rules):
+    """
+    Streaming tracks of a log, see TrackSegmenter for the split rules
+    """
+    return TrackSegmenter(records, **split_rules).tracks()
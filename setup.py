@@ -24,12 +24,14 @@ setup(name="pygotu",
       url="https://github.com/bezineb5/pygotu",
       install_requires=[
         "pyserial==3.4",
-        "pyusb==1.0.2"
+        "pyusb==1.0.2",
+        "numpy>=1.15"
       ],
       classifiers=[
           "Development Status :: 3 - Alpha",
           "Intended Audience :: Developers",
           "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
-          "Programming Language :: Python :: 3.5",
+          "Programming Language :: Python :: 3 :: Only",
+          "Programming Language :: Python :: 3.7",
           "Topic :: Multimedia"],
-      py_modules=["pygotu", "gt2gpx", "connections"])
+      py_modules=["pygotu", "gt2gpx", "connections", "gtbatch", "simulator", "pagecache", "pipeline", "segment", "flashimage", "export", "multidevice", "aiogotu", "stats", "recording", "journal", "integrity", "archive", "trackfile", "nmea", "simplify", "trackstats"])
@@ -0,0 +1,219 @@
+import logging
+
+import numpy as np
+
+import archive
+import export
+import segment
+import trackstats
+
+log = logging.getLogger(__name__)
+
+METHOD_DOUGLAS_PEUCKER = "dp"
+METHOD_VISVALINGAM = "vw"
+METHODS = (METHOD_DOUGLAS_PEUCKER, METHOD_VISVALINGAM)
+
+# Waypoints slower than this, in km/h, are stationary: their moves within the
+# horizontal error (ehpe) of the receiver, or MIN_JITTER, are noise
+STATIONARY_SPEED = 2.0
+MIN_JITTER = 5.0  # in m
+
+
+def project(lat: np.ndarray, lon: np.ndarray) -> tuple:
+    """
+    x, y in m of an equirectangular projection centered on the points: the distances
+    are within 1% of the great circle ones over the extent of a track (a few 100 km)
+    """
+    lat0 = np.radians((lat.min() + lat.max()) / 2.0) if len(lat) else 0.0
+    x = np.radians(lon) * segment.EARTH_RADIUS * np.cos(lat0)
+    y = np.radians(lat) * segment.EARTH_RADIUS
+    return x, y
+
+
+def _segment_distance(x: np.ndarray, y: np.ndarray, idx: np.ndarray, first: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """
+    Distance of the points idx to the segments from the points first to the points last
+    """
+    dx = x[last] - x[first]
+    dy = y[last] - y[first]
+    px = x[idx] - x[first]
+    py = y[idx] - y[first]
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.clip(np.where(length2 > 0, (px * dx + py * dy) / length2, 0.0), 0.0, 1.0)
+    return np.hypot(px - t * dx, py - t * dy)
+
+
+def douglas_peucker(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Mask of the points kept by the Douglas-Peucker simplification: the points farther
+    than tolerance from the simplified line. The segments of a level of the recursion
+    are split all at once.
+    """
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    first = np.array([0])
+    last = np.array([n - 1])
+    while len(first):
+        inner = last - first - 1
+        first = first[inner > 0]
+        last = last[inner > 0]
+        inner = inner[inner > 0]
+        if not len(first):
+            break
+        # Points inside each segment, segment after segment
+        offsets = np.cumsum(inner) - inner
+        seg = np.repeat(np.arange(len(first)), inner)
+        idx = np.arange(len(seg)) - offsets[seg] + first[seg] + 1
+        distance = _segment_distance(x, y, idx, first[seg], last[seg])
+
+        farthest = np.maximum.reduceat(distance, offsets)
+        split = farthest > tolerance
+        # Index of the farthest point of the split segments: the first one reaching the maximum
+        candidates = np.flatnonzero(split[seg] & (distance == farthest[seg]))
+        _, firsts = np.unique(seg[candidates], return_index=True)
+        pivot = idx[candidates[firsts]]
+        keep[pivot] = True
+        first, last = np.concatenate((first[split], pivot)), np.concatenate((pivot, last[split]))
+    return keep
+
+
+def visvalingam(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Mask of the points kept by the Visvalingam-Whyatt simplification: points are removed
+    while the triangle they form with their neighbours is smaller than tolerance² m².
+    Each round removes all the points whose area is a local minimum below it, instead of
+    one point at a time, the areas of their neighbours being updated for the next round.
+    """
+    n = len(x)
+    keep = np.ones(n, dtype=bool)
+    if n < 3:
+        return keep
+    min_area = tolerance * tolerance
+    kept = np.arange(n)
+    while len(kept) > 2:
+        prev, cur, nxt = kept[:-2], kept[1:-1], kept[2:]
+        area = np.abs((x[cur] - x[prev]) * (y[nxt] - y[prev]) - (x[nxt] - x[prev]) * (y[cur] - y[prev])) / 2.0
+        # Smaller than both neighbours, ties going to the first one, so no two neighbours are removed together
+        padded = np.concatenate(([np.inf], area, [np.inf]))
+        remove = (area < min_area) & (area < padded[:-2]) & (area <= padded[2:])
+        if not remove.any():
+            break
+        keep[cur[remove]] = False
+        kept = np.flatnonzero(keep)
+    return keep
+
+
+def resample(epoch_ms: np.ndarray, interval: float) -> np.ndarray:
+    """
+    Mask keeping the first point of each interval (s) of the track, and its last point.
+    Intervals are rounded to the ms of the point times.
+    """
+    if not interval > 0:
+        raise ValueError("The resampling interval must be greater than 0: {}".format(interval))
+    keep = np.zeros(len(epoch_ms), dtype=bool)
+    if not len(epoch_ms):
+        return keep
+    bucket = (epoch_ms - epoch_ms[0]) // max(1, round(interval * 1000))
+    keep[0] = True
+    keep[1:] = bucket[1:] != bucket[:-1]
+    keep[-1] = True
+    return keep
+
+
+def drop_jitter(x: np.ndarray, y: np.ndarray, speed: np.ndarray, ehpe: np.ndarray,
+                stationary_speed: float=STATIONARY_SPEED, min_jitter: float=MIN_JITTER) -> np.ndarray:
+    """
+    Mask dropping the stationary jitter: in each run of consecutive points slower than
+    stationary_speed, the points within their ehpe (and at least min_jitter) of the first
+    one of the run. The first and last points of a run are kept, as the times of the stop.
+    """
+    n = len(x)
+    keep = np.ones(n, dtype=bool)
+    stationary = speed < stationary_speed
+    if not stationary.any():
+        return keep
+    starts = stationary.copy()
+    starts[1:] &= ~stationary[:-1]
+    ends = stationary.copy()
+    ends[:-1] &= ~stationary[1:]
+    # First point of the run of each stationary point
+    anchor = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+    distance = np.hypot(x - x[anchor], y - y[anchor])
+    keep[stationary & ~starts & ~ends & (distance <= np.maximum(ehpe, min_jitter))] = False
+    return keep
+
+
+class TrackSimplifier:
+    """
+    Optional stage between the tracks and the export writers, run on the columns of each
+    track: drops the stationary jitter, keeps one point per resampling interval, then
+    simplifies the line within tolerance m. Each step is skipped when not set.
+    With collect_stats(), the trackstats.TrackStats of each track are accumulated before
+    its simplification, describing the recorded track rather than the simplified line,
+    in track_stats as (name, TrackStats) pairs like export.TrackWriter.track_stats.
+    """
+    __slots__ = ['tolerance', 'method', 'interval', 'jitter', 'stationary_speed', 'points_in', 'points_out',
+                 'track_stats']
+
+    def __init__(self, tolerance: float=None, method: str=METHOD_DOUGLAS_PEUCKER, interval: float=None,
+                 jitter: bool=False, stationary_speed: float=STATIONARY_SPEED):
+        if method not in METHODS:
+            raise ValueError("Unknown simplification method: {}".format(method))
+        if interval is not None and not interval > 0:
+            raise ValueError("The resampling interval must be greater than 0: {}".format(interval))
+        self.tolerance = tolerance
+        self.method = method
+        self.interval = interval
+        self.jitter = jitter
+        self.stationary_speed = stationary_speed
+        self.points_in = 0
+        self.points_out = 0
+        self.track_stats = None
+
+    def collect_stats(self):
+        self.track_stats = []
+
+    def process(self, points):
+        """
+        Simplified points of a track, as columns with select(), like archive.PointSet
+        or the waypoints of a gtbatch.RecordBatch
+        """
+        self.points_in += len(points)
+        if self.track_stats is not None and len(points):
+            # Named like the track written, whose first point is kept
+            self.track_stats.append((export.batch_track_name(points), trackstats.TrackStats.of_points(points)))
+        if len(points) > 2:
+            if self.jitter:
+                x, y = project(points.lat, points.lon)
+                points = points.select(drop_jitter(x, y, points.speed, points.ehpe, self.stationary_speed))
+            if self.interval:
+                points = points.select(resample(points.epoch_ms, self.interval))
+            if self.tolerance is not None:
+                x, y = project(points.lat, points.lon)
+                simplify = douglas_peucker if self.method == METHOD_DOUGLAS_PEUCKER else visvalingam
+                points = points.select(simplify(x, y, self.tolerance))
+        self.points_out += len(points)
+        return points
+
+    def process_tracks(self, tracks):
+        """
+        Yields the simplified points of tracks of records, like GTTrack or
+        segment.StreamingTrack, for TrackWriter.write_batch_tracks()
+        """
+        for idx, track in enumerate(tracks):
+            yield self.process(archive.PointSet.from_records(track, track_id=idx))
+
+    def process_batches(self, batches):
+        """
+        Yields the simplified points of the tracks of columns, like archive.PointSet.tracks()
+        """
+        for points in batches:
+            yield self.process(points.waypoints())
+
+    def __str__(self):
+        return "{} points simplified to {} ({:.1%})".format(
+            self.points_in, self.points_out, self.points_out / self.points_in if self.points_in else 0.0)
@@ -0,0 +1,392 @@
+import array
+import errno
+import logging
+import random
+import time
+from struct import pack, unpack
+
+import numpy as np
+import usb.core
+
+import gtbatch
+import pygotu
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SERIAL = 0x12345678
+DEFAULT_VERSION = (1, 2)
+DEFAULT_USB_LIB = 0x0100
+
+JEDEC_MANUFACTURER = 0xC220
+
+# SPI flash opcodes relayed by the 0x93 0x05 (read) and 0x93 0x06 (write) commands
+SPI_READ = 0x03
+SPI_READ_STATUS = 0x05
+SPI_WRITE_ENABLE = 0x06
+SPI_SECTOR_ERASE = 0x20
+SPI_READ_ID = 0x9F
+
+STATUS_BUSY = 0x01
+STATUS_WRITE_ENABLED = 0x02
+
+ERROR_RESPONSE = b"\x93\xff\xff"
+# Packet answering the first half of a command, of which USBSerial.write() reads 3 bytes
+COMMAND_ACK = b"\x93\x00\x00"
+
+# USB packet size of the devices, the unit of the corrupted responses
+PACKET_SIZE = 0x10
+# Longest wait of read_some() for the NMEA stream, in s, like connections.STREAM_TIMEOUT
+STREAM_TIMEOUT = 0.2
+# Bytes of the NMEA stream returned by a read, like the interrupt packets of the devices
+NMEA_PACKET_SIZE = 0x40
+
+
+def _model_code(model_name: str) -> int:
+    for code, info in pygotu.MODELS.items():
+        if info[0] == model_name:
+            return code
+    raise Exception("Unknown model: {}".format(model_name))
+
+
+def encode_timestamps(epoch_ms: np.ndarray) -> tuple:
+    """
+    Encodes UTC epoch milliseconds to the packed (ym, dhm, ms) record fields
+    """
+    epoch_ms = np.asarray(epoch_ms, dtype=np.int64)
+    seconds = epoch_ms // 1000
+    days = (seconds // 86400).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+
+    year = years.astype(np.int64) + 1970
+    month = (months - years).astype(np.int64) + 1
+    day = (days - months).astype(np.int64) + 1
+    day_seconds = seconds % 86400
+
+    ym = ((year - 2000) % 16) << 4 | month
+    dhm = day << 11 | (day_seconds // 3600) << 6 | (day_seconds // 60) % 60
+    ms = (day_seconds % 60) * 1000 + epoch_ms % 1000
+    return ym, dhm, ms
+
+
+def synthesize_records(num_records: int, start_time: float=None, interval: float=1.0,
+                       track_length: int=0, seed: int=0) -> np.ndarray:
+    """
+    Builds a synthetic log as an array of gtbatch.RECORD_DTYPE: a random walk of
+    waypoints, split in tracks by 'RESET COUNTER' device log records every track_length points
+    """
+    rng = np.random.RandomState(seed)
+    if start_time is None:
+        start_time = time.time() - num_records * interval - 86400
+    records = np.zeros(num_records, dtype=gtbatch.RECORD_DTYPE)
+
+    epoch_ms = (start_time * 1000 + np.arange(num_records) * interval * 1000).astype(np.int64)
+    records['ym'], records['dhm'], records['ms'] = encode_timestamps(epoch_ms)
+
+    records['lat'] = 48.8566 * 10000000 + np.cumsum(rng.randint(-200, 201, num_records))
+    records['lon'] = 2.3522 * 10000000 + np.cumsum(rng.randint(-200, 201, num_records))
+    records['ele'] = 3500 + np.cumsum(rng.randint(-10, 11, num_records))
+    records['speed'] = rng.randint(0, 3000, num_records)
+    records['course'] = rng.randint(0, 36000, num_records)
+    records['ae'] = rng.randint(0, 0x100, num_records)
+    records['sat_map'] = rng.randint(0, 1 << 16, num_records) << 8
+    records['plr'] = rng.randint(0, 1 << 16, num_records)
+
+    if track_length > 0:
+        resets = slice(track_length, None, track_length + 1)
+        records['flag'][resets] = gtbatch.FLAG_DEVICE_LOG
+        records.view(np.uint8).reshape(-1, pygotu.RECORD_SIZE)[resets, 0x06:0x1e] = \
+            np.frombuffer(b"RESET COUNTER".ljust(0x18, b"\x00"), dtype=np.uint8)
+
+    return records
+
+
+class SimulatedDevice:
+    """
+    Emulates a GT-xxx logger at the 0x93 command level, behind the same
+    read/write/flush/close surface as connections.USBSerial
+    """
+    __slots__ = ['flash', 'model_code', 'serial', 'num_records', 'latency', 'flush_delay',
+                 'error_rate', 'timeout_rate', 'corrupt_rate', 'erase_polls', 'nmea_mode', 'status', 'busy_polls', 'receive_buffer',
+                 'random', 'bytes_in', 'bytes_out', 'transfers', 'flushes', 'commands', 'corruptions',
+                 'nmea_interval', 'nmea_buffer', 'nmea_waypoints', 'next_fix', 'fixes']
+
+    def __init__(self, model: str="GT-200e/GT-600", num_records: int=0, records: np.ndarray=None,
+                 serial: int=DEFAULT_SERIAL, latency: float=0.0, flush_delay: float=0.0,
+                 error_rate: float=0.0, timeout_rate: float=0.0, corrupt_rate: float=0.0,
+                 erase_polls: int=2, nmea_interval: float=1.0, seed: int=0,
+                 **synthesize_args):
+        self.model_code = _model_code(model)
+        self.serial = serial
+        self.latency = latency
+        # USBSerial.flush() waits for an endpoint read to time out
+        self.flush_delay = flush_delay
+        self.error_rate = error_rate
+        # Commands whose response never comes, read() then times out like USBSerial
+        self.timeout_rate = timeout_rate
+        # Flash reads whose response is garbled, like a USB transfer losing or mangling a packet
+        self.corrupt_rate = corrupt_rate
+        self.erase_polls = erase_polls
+        # In the GPS dongle mode, the logged waypoints are streamed as NMEA fixes, one per interval (s)
+        self.nmea_interval = nmea_interval
+        self.nmea_buffer = bytearray()
+        self.nmea_waypoints = None
+        self.next_fix = None
+        self.fixes = 0
+        self.random = random.Random(seed)
+
+        if records is None:
+            records = synthesize_records(num_records, seed=seed, **synthesize_args)
+        self.num_records = len(records)
+
+        # Page 0 is reserved for the configuration, the flash grows to fit the records
+        n_blocks = pygotu.MODELS[self.model_code][1] + 1
+        data_pages = -(-self.num_records // pygotu.RECORDS_PER_PAGE)
+        self.flash = bytearray(b"\xff" * (max(n_blocks, data_pages + 1) * pygotu.PAGE_SIZE))
+        self.flash[pygotu.PAGE_SIZE:pygotu.PAGE_SIZE + records.nbytes] = records.tobytes()
+
+        self.nmea_mode = pygotu.MODE_GPS_TRACKER
+        self.status = 0
+        self.busy_polls = 0
+        self.receive_buffer = bytearray()
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.transfers = 0
+        self.flushes = 0
+        self.commands = {}
+        self.corruptions = 0
+
+    def write(self, data):
+        if len(data) != 16 or data[0] != 0x93:
+            raise Exception("Unexpected command: {}".format(pygotu.hexdumps(bytes(data))))
+        cs = sum(data) & 0xff
+        if cs != 0:
+            raise Exception("Invalid checksum: {}".format(pygotu.hexdumps(bytes(data))))
+
+        self.transfers += 1
+        self.bytes_out += len(data)
+        if self.latency:
+            time.sleep(self.latency)
+
+        cmd = data[1]
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.receive_buffer.extend(ERROR_RESPONSE)
+            return len(data)
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            return len(data)
+
+        handler = self._HANDLERS.get(cmd)
+        if not handler:
+            raise Exception("Unknown command: {:#x}".format(cmd))
+        self._respond(handler(self, bytes(data)))
+        return len(data)
+
+    def read(self, size=1):
+        if len(self.receive_buffer) < size:
+            self.receive_buffer.clear()
+            raise TimeoutError("No response from the simulated device")
+        data = bytes(self.receive_buffer[:size])
+        del self.receive_buffer[:size]
+        self.bytes_in += len(data)
+        return data
+
+    def read_some(self, size=1):
+        """
+        Up to size bytes, as soon as some are available: in the GPS dongle mode, the
+        sentences of the next fix once it is due, waiting at most STREAM_TIMEOUT for it
+        """
+        if not self.receive_buffer and self.nmea_mode == pygotu.MODE_GPS_DONGLE:
+            if not self.nmea_buffer:
+                now = time.perf_counter()
+                if self.next_fix is None:
+                    self.next_fix = now
+                if self.next_fix - now > STREAM_TIMEOUT:
+                    time.sleep(STREAM_TIMEOUT)
+                    return b""
+                if self.next_fix > now:
+                    time.sleep(self.next_fix - now)
+                self.nmea_buffer.extend(self._nmea_fix())
+                self.next_fix += self.nmea_interval
+            data = bytes(self.nmea_buffer[:min(size, NMEA_PACKET_SIZE)])
+            del self.nmea_buffer[:len(data)]
+            self.bytes_in += len(data)
+            return data
+        if not self.receive_buffer:
+            time.sleep(STREAM_TIMEOUT)
+            return b""
+        return self.read(min(size, len(self.receive_buffer)))
+
+    def _nmea_fix(self) -> bytes:
+        """
+        GGA, GSA and RMC sentences of the next logged waypoint, the log being streamed in a loop
+        """
+        import nmea
+
+        if self.nmea_waypoints is None:
+            dump = bytes(self.flash[pygotu.PAGE_SIZE:pygotu.PAGE_SIZE + self.num_records * pygotu.RECORD_SIZE])
+            self.nmea_waypoints = gtbatch.decode_dump(dump).waypoints()
+        waypoints = self.nmea_waypoints
+        if not len(waypoints):
+            fix_time = pygotu.epoch_ms_to_datetime(int(time.time() * 1000))
+            return (nmea.format_sentence("GPGGA,{:%H%M%S}.000,,,,,0,00,,,M,,M,,".format(fix_time)) +
+                    nmea.format_sentence("GPRMC,{:%H%M%S}.000,V,,,,,,,{:%d%m%y},,,N".format(fix_time, fix_time)))
+
+        i = self.fixes % len(waypoints)
+        self.fixes += 1
+        fix_time = pygotu.epoch_ms_to_datetime(int(waypoints.epoch_ms[i]))
+        lat = float(waypoints.lat[i])
+        lon = float(waypoints.lon[i])
+        lat_field = "{:02d}{:07.4f},{}".format(int(abs(lat)), abs(lat) % 1 * 60, "N" if lat >= 0 else "S")
+        lon_field = "{:03d}{:07.4f},{}".format(int(abs(lon)), abs(lon) % 1 * 60, "E" if lon >= 0 else "W")
+        hms = "{:%H%M%S}.{:03d}".format(fix_time, fix_time.microsecond // 1000)
+        return (nmea.format_sentence("GPGGA,{},{},{},1,{:02d},{:.1f},{:.1f},M,47.0,M,,".format(
+                    hms, lat_field, lon_field, int(waypoints.sat[i]), float(waypoints.ehpe[i]) / 5.0,
+                    float(waypoints.elevation[i]))) +
+                nmea.format_sentence("GPGSA,A,3,,,,,,,,,,,,,2.1,1.2,1.7") +
+                nmea.format_sentence("GPRMC,{},A,{},{},{:.2f},{:.2f},{:%d%m%y},,,A".format(
+                    hms, lat_field, lon_field, float(waypoints.speed[i]) / nmea.KNOTS_TO_KMH,
+                    float(waypoints.course[i]), fix_time)))
+
+    def flush(self):
+        self.receive_buffer.clear()
+        self.flushes += 1
+        if self.flush_delay:
+            time.sleep(self.flush_delay)
+
+    def close(self):
+        pass
+
+    def _respond(self, payload: bytes):
+        if payload is None:
+            return
+        self.receive_buffer.extend(pack(">Bh", 0x93, len(payload)))
+        self.receive_buffer.extend(payload)
+
+    def _nmea_switch(self, data: bytes):
+        self.nmea_mode = data[3]
+        return b""
+
+    def _identify(self, data: bytes):
+        return pack(">IbbHH", self.serial, DEFAULT_VERSION[0], DEFAULT_VERSION[1],
+                    self.model_code, DEFAULT_USB_LIB)
+
+    def _count(self, data: bytes):
+        return pack(">I", self.num_records)[1:]
+
+    def _spi_read(self, data: bytes):
+        size, cmd_len, opcode = unpack(">HBB", data[3:7])
+        if opcode == SPI_READ:
+            pos = (data[7] << 16) | unpack(">H", data[8:10])[0]
+            if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+                return self._corrupt(bytes(self.flash[pos:pos + size]))
+            return bytes(self.flash[pos:pos + size])
+        if opcode == SPI_READ_STATUS:
+            if self.busy_polls > 0:
+                self.busy_polls -= 1
+                if self.busy_polls == 0:
+                    self.status &= ~STATUS_BUSY
+            return bytes([self.status]) * size
+        if opcode == SPI_READ_ID:
+            return pack(">HB", JEDEC_MANUFACTURER, self.model_code)[:size]
+        raise Exception("Unknown SPI read opcode: {:#x}".format(opcode))
+
+    def _corrupt(self, response: bytes) -> bytes:
+        self.corruptions += 1
+        packet = PACKET_SIZE * self.random.randrange(max(1, len(response) // PACKET_SIZE))
+        if self.random.random() < 0.5:
+            # Lost packet: the following data is shifted, the response ends with erased bytes
+            return (response[:packet] + response[packet + PACKET_SIZE:]).ljust(len(response), b"\xff")
+        garbled = bytes(self.random.randrange(0x100) for _ in range(PACKET_SIZE))
+        return (response[:packet] + garbled + response[packet + PACKET_SIZE:])[:len(response)]
+
+    def _spi_write(self, data: bytes):
+        opcode = data[6]
+        if opcode == SPI_WRITE_ENABLE:
+            self.status |= STATUS_WRITE_ENABLED
+        elif opcode == SPI_SECTOR_ERASE:
+            if not self.status & STATUS_WRITE_ENABLED:
+                log.warning("Sector erase without write enable")
+                return b""
+            pos = (data[7] << 16) | unpack(">H", data[8:10])[0]
+            pos -= pos % pygotu.PAGE_SIZE
+            self.flash[pos:pos + pygotu.PAGE_SIZE] = b"\xff" * pygotu.PAGE_SIZE
+            self.status = STATUS_BUSY if self.erase_polls else 0
+            self.busy_polls = self.erase_polls
+        else:
+            raise Exception("Unknown SPI write opcode: {:#x}".format(opcode))
+        return b""
+
+    def _purge(self, data: bytes):
+        # Assumed to commit the purge: the record counter restarts from the first erased record
+        if data[3] == 0x1e:
+            self.num_records = 0
+        return b""
+
+    def _unknown(self, data: bytes):
+        return b""
+
+    _HANDLERS = {
+        0x01: _nmea_switch,
+        0x05: _spi_read,
+        0x06: _spi_write,
+        0x08: _unknown,
+        0x0a: _identify,
+        0x0b: _count,
+        0x0c: _purge,
+    }
+
+
+class SimulatedUSB:
+    """
+    USB side of a SimulatedDevice, to run connections.USBSerial(usb, usb) over it: the
+    control transfers of the commands and the IN endpoint. Like the loggers, it answers
+    the first half of a command with a packet, and sends the responses in whole packets,
+    the last one padded: the bytes after a response are not the start of the next one.
+    """
+    __slots__ = ['device', 'wMaxPacketSize', 'pad', 'outgoing', 'command']
+
+    def __init__(self, device: SimulatedDevice, packet_size: int=PACKET_SIZE, pad: bool=True):
+        self.device = device
+        self.wMaxPacketSize = packet_size
+        self.pad = pad
+        self.outgoing = bytearray()
+        # First half of the command being sent
+        self.command = None
+
+    def _send(self, data: bytes):
+        self.outgoing.extend(data)
+        if self.pad and len(self.outgoing) % self.wMaxPacketSize:
+            self.outgoing.extend(bytes(self.wMaxPacketSize - len(self.outgoing) % self.wMaxPacketSize))
+
+    def ctrl_transfer(self, request_type, request, value, index, data, timeout=None):
+        if self.command is None:
+            self.command = bytes(data)
+            self._send(COMMAND_ACK)
+        else:
+            command = self.command + bytes(data)
+            self.command = None
+            self.device.write(command)
+            response = self.device.receive_buffer
+            if response:
+                self._send(self.device.read(len(response)))
+        return len(data)
+
+    def read(self, size_or_buffer, timeout=None):
+        if isinstance(size_or_buffer, int):
+            # USBSerial.flush(): a read waiting for its timeout
+            self.device.flush()
+            data = bytes(self.outgoing[:size_or_buffer])
+            del self.outgoing[:len(data)]
+            return array.array('B', data)
+        if not self.outgoing:
+            # Raised like pyusb does, so that USBSerial times the transfer out
+            raise usb.core.USBError("Operation timed out", -7, errno.ETIMEDOUT)
+        data = self.outgoing[:len(size_or_buffer)]
+        del self.outgoing[:len(data)]
+        size_or_buffer[:len(data)] = array.array('B', data)
+        return len(data)
+
+    def close(self):
+        pass
@@ -0,0 +1,208 @@
+import json
+import time
+from bisect import bisect_left
+
+# Upper bounds of the latency histogram buckets, in ms: powers of 2 from 1/16 ms to 4 s,
+# the last bucket holding the slower ones
+HISTOGRAM_BOUNDS = [2 ** i / 16.0 for i in range(17)]
+
+# Command names, by command byte, then SPI opcode for the SPI relay commands
+COMMAND_NAMES = {
+    0x01: "nmea_switch",
+    0x08: "unk_purge2",
+    0x0a: "identify",
+    0x0b: "count",
+    0x0c: "unk_purge1",
+    (0x05, 0x03): "flash_read",
+    (0x05, 0x05): "read_status",
+    (0x05, 0x9f): "model",
+    (0x06, 0x06): "write_enable",
+    (0x06, 0x20): "sector_erase",
+}
+
+
+def command_name(cmd1: bytes) -> str:
+    name = COMMAND_NAMES.get(cmd1[1]) or COMMAND_NAMES.get((cmd1[1], cmd1[6]))
+    return name or "{:#04x}".format(cmd1[1])
+
+
+class Histogram:
+    __slots__ = ['counts', 'count', 'total', 'max']
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> float:
+        """
+        Upper bound of the bucket holding the p percentile, at most the maximum
+        """
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(HISTOGRAM_BOUNDS[i], self.max) if i < len(HISTOGRAM_BOUNDS) else self.max
+        return 0.0
+
+    def to_dict(self) -> dict:
+        bounds = ["<={:g}".format(bound) for bound in HISTOGRAM_BOUNDS] + [">{:g}".format(HISTOGRAM_BOUNDS[-1])]
+        return {
+            "mean_ms": self.total / self.count if self.count else None,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": self.max,
+            "buckets_ms": {bound: n for bound, n in zip(bounds, self.counts) if n},
+        }
+
+
+class OperationStats:
+    """
+    Counters and latency histogram of one kind of command or transfer
+    """
+    __slots__ = ['count', 'errors', 'timeouts', 'bytes_out', 'bytes_in', 'latency']
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency = Histogram()
+
+    def to_dict(self) -> dict:
+        result = {
+            "count": self.count,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+        }
+        result.update(self.latency.to_dict())
+        return result
+
+
+class Timer:
+    __slots__ = ['stats', 'name', 'start']
+
+    def __init__(self, stats: 'Stats', name: str):
+        self.stats = stats
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+
+
+class Stats:
+    """
+    Statistics of a sync, collected by the objects it is attached to (GT200Dev.attach_stats,
+    export writers): without a Stats object, they only test it against None.
+    - commands: per command type (see COMMAND_NAMES), from GT200Dev.transaction
+    - transfers: per transfer kind, from the connections.USBSerial endpoint transfers
+    - times: time spent in decoding, export... in s
+    """
+    __slots__ = ['commands', 'transfers', 'times', 'bytes_out', 'bytes_in', 'retries', 'resyncs',
+                 'framing_errors', 'started']
+
+    def __init__(self):
+        self.commands = {}
+        self.transfers = {}
+        self.times = {}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retries = 0
+        self.resyncs = 0
+        self.framing_errors = 0
+        self.started = time.perf_counter()
+
+    def _operation(self, operations: dict, name: str) -> OperationStats:
+        operation = operations.get(name)
+        if operation is None:
+            operation = operations[name] = OperationStats()
+        return operation
+
+    def command(self, cmd1: bytes, latency_ms: float, response_size: int, error: bool=False,
+                timed_out: bool=False):
+        operation = self._operation(self.commands, command_name(cmd1))
+        operation.count += 1
+        operation.bytes_out += 16
+        operation.bytes_in += response_size
+        if error:
+            operation.errors += 1
+        if timed_out:
+            operation.timeouts += 1
+        operation.latency.record(latency_ms)
+
+    def transfer(self, kind: str, latency_ms: float, size: int, timed_out: bool=False):
+        operation = self._operation(self.transfers, kind)
+        operation.count += 1
+        if kind == "write":
+            operation.bytes_out += size
+        else:
+            operation.bytes_in += size
+        if timed_out:
+            operation.timeouts += 1
+        operation.latency.record(latency_ms)
+
+    def timer(self, name: str) -> Timer:
+        """
+        Context manager adding its duration to times[name]
+        """
+        return Timer(self, name)
+
+    def add_time(self, name: str, seconds: float):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    @property
+    def timeouts(self) -> int:
+        return sum(operation.timeouts for operation in self.commands.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "elapsed_s": time.perf_counter() - self.started,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "resyncs": self.resyncs,
+            "framing_errors": self.framing_errors,
+            "times_s": dict(self.times),
+            "commands": {name: operation.to_dict() for name, operation in sorted(self.commands.items())},
+            "transfers": {name: operation.to_dict() for name, operation in sorted(self.transfers.items())},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def summary(self) -> str:
+        lines = ["elapsed {:.3f} s, {} bytes out, {} bytes in, {} timeouts, {} retries, {} resyncs, {} framing errors".format(
+            time.perf_counter() - self.started, self.bytes_out, self.bytes_in, self.timeouts, self.retries,
+            self.resyncs, self.framing_errors)]
+        for name, seconds in sorted(self.times.items()):
+            lines.append("{:<14} {:>10.3f} s".format(name, seconds))
+        for title, operations in (("command", self.commands), ("transfer", self.transfers)):
+            if not operations:
+                continue
+            lines.append("{:<14} {:>8} {:>7} {:>8} {:>10} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+                title, "count", "errors", "timeouts", "bytes out", "bytes in", "mean ms", "p50 ms", "p95 ms", "max ms"))
+            for name, operation in sorted(operations.items()):
+                latency = operation.latency
+                lines.append("{:<14} {:>8} {:>7} {:>8} {:>10} {:>10} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                    name, operation.count, operation.errors, operation.timeouts, operation.bytes_out, operation.bytes_in,
+                    latency.total / latency.count if latency.count else 0.0,
+                    latency.percentile(0.5), latency.percentile(0.95), latency.max))
+        return "\n".join(lines)
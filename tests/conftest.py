@@ -0,0 +1,40 @@
+import os.path
+import sys
+
+import numpy as np
+import pytest
+
+# The modules are installed at the top level (setup.py py_modules), run them from the tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gtbatch  # noqa: E402
+import pygotu  # noqa: E402
+import simulator  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def dump() -> bytes:
+    """
+    Synthetic records with device logs, dates of any field value, invalid flags and
+    waypoints without a position
+    """
+    records = simulator.synthesize_records(4096, track_length=50, seed=1)
+    rng = np.random.RandomState(2)
+    waypoints = records['flag'] == 0
+    odd = rng.rand(len(records)) < 0.3
+    records['ym'][odd] = rng.randint(0, 0x100, odd.sum())
+    records['dhm'][odd] = rng.randint(0, 0x10000, odd.sum())
+    records['flag'][waypoints & (rng.rand(len(records)) < 0.05)] |= gtbatch.FLAG_INVALID
+    no_position = waypoints & (rng.rand(len(records)) < 0.05)
+    records['lat'][no_position] = 0
+    records['lon'][no_position] = 0
+    return records.tobytes()
+
+
+@pytest.fixture(scope="module")
+def gt_records(dump) -> list:
+    """
+    GTRecord of every record of dump
+    """
+    return [pygotu.GTRecord(i, dump[i * pygotu.RECORD_SIZE:(i + 1) * pygotu.RECORD_SIZE])
+            for i in range(len(dump) // pygotu.RECORD_SIZE)]
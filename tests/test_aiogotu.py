@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+
+import aiogotu
+import pygotu
+import simulator
+
+NUM_RECORDS = 3000
+START_TIME = 1500000000
+
+
+def _device(**kwargs) -> simulator.SimulatedDevice:
+    return simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME, **kwargs)
+
+
+def test_async_records_match_the_device():
+    async def download():
+        dev = await aiogotu.open_device(_device())
+        return [(rec.idx, rec.epoch_ms) async for rec in dev.all_records()]
+
+    expected = pygotu.open_device(_device()).all_records()
+    assert asyncio.run(download()) == [(rec.idx, rec.epoch_ms) for rec in expected]
+
+
+def test_async_tracks_match_the_device():
+    async def download():
+        dev = await aiogotu.open_device(_device(track_length=500))
+        return [(track.first_epoch_ms, track.num_points) async for track in dev.all_tracks()]
+
+    dev = pygotu.open_device(_device(track_length=500))
+    expected = [(track.first_epoch_ms, track.num_points) for track in dev.all_tracks()]
+    assert len(expected) > 1
+    assert asyncio.run(download()) == expected
+
+
+def test_async_purge():
+    sim = _device()
+
+    async def purge():
+        dev = await aiogotu.open_device(sim)
+        return await dev.purge_all_120()
+
+    plan = asyncio.run(purge())
+    assert plan.erases == plan.last_block
+    assert sim.num_records == 0
+
+
+def test_idempotent_commands_are_retried(monkeypatch):
+    monkeypatch.setattr(pygotu, "RETRY_BACKOFF", 0.0)
+
+    async def download(sim):
+        dev = await aiogotu.open_device(sim)
+        records = [(rec.idx, rec.epoch_ms) async for rec in dev.all_records()]
+        return dev, records
+
+    expected = [(rec.idx, rec.epoch_ms) for rec in pygotu.open_device(_device()).all_records()]
+    for seed in range(4):
+        dev, records = asyncio.run(download(_device(timeout_rate=0.15, error_rate=0.1, seed=seed)))
+        assert records == expected
+        assert dev.retries > 0
+
+
+def test_purge_plan_probes_are_retried(monkeypatch):
+    monkeypatch.setattr(pygotu, "RETRY_BACKOFF", 0.0)
+
+    async def plan_purge(sim):
+        dev = await aiogotu.open_device(sim)
+        # Wrong count: the used blocks are found by probing them
+        sim.num_records = 0
+        sim.timeout_rate = 0.15
+        sim.error_rate = 0.1
+        return dev, await dev.plan_purge(dev.model_info[1])
+
+    expected = pygotu.open_device(_device()).plan_purge(pygotu.MODELS[0x13][1])
+    for seed in range(4):
+        dev, plan = asyncio.run(plan_purge(_device(seed=seed)))
+        assert plan.searched
+        assert plan.last_block == expected.last_block
+        assert dev.retries > 0
+
+
+def test_simulator_latency_is_awaited_concurrently():
+    latency = 0.02
+    devices = [_device(serial=0x1000 + i, latency=latency) for i in range(4)]
+
+    async def count(sim):
+        dev = await aiogotu.open_device(aiogotu.SimulatorTransport(sim))
+        return dev.serial, await dev.count()
+
+    async def count_all():
+        return await asyncio.gather(*(count(sim) for sim in devices))
+
+    start = time.perf_counter()
+    assert asyncio.run(count_all()) == [(0x1000 + i, NUM_RECORDS) for i in range(4)]
+    # Each device answers 4 commands: run one after the other, they would take 16 latencies
+    assert time.perf_counter() - start < 12 * latency
+    assert sum(sim.transfers for sim in devices) >= 16
+
+
+class SlowConnection:
+    """
+    Connection whose first read answers after the async read timeout, checking that
+    its calls never overlap
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.busy = threading.Lock()
+        self.overlaps = 0
+        self.calls = []
+
+    def _call(self, name: str, delay: float=0.0):
+        if not self.busy.acquire(blocking=False):
+            self.overlaps += 1
+            return
+        try:
+            time.sleep(delay)
+            self.calls.append(name)
+        finally:
+            self.busy.release()
+
+    def write(self, data):
+        self._call("write")
+
+    def read(self, size=1):
+        self._call("read", self.delay if not self.calls.count("read") else 0.0)
+        return b"\x93\x00\x00"[:size]
+
+    def flush(self):
+        self._call("flush")
+
+    def close(self):
+        pass
+
+
+def test_executor_transport_waits_for_the_timed_out_read():
+    connection = SlowConnection(0.2)
+
+    async def commands():
+        dev = aiogotu.AsyncGT200Dev(aiogotu.ExecutorTransport(connection), timeout=0.05)
+        try:
+            await dev.transaction(*pygotu.CMD_COUNT)
+        except TimeoutError:
+            pass
+        assert not dev.in_sync
+        await dev.write_cmd(*pygotu.CMD_COUNT)
+
+    asyncio.run(commands())
+    assert connection.overlaps == 0
+    # The timed out read ends before the flush resynchronizing the connection
+    assert connection.calls == ["flush", "write", "read", "flush", "write"]
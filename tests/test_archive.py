@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import archive
+import gtbatch
+import pygotu
+import simulator
+
+NUM_RECORDS = 3000
+START_TIME = 1500000000
+
+
+def _device() -> pygotu.GT200Dev:
+    dev = pygotu.GT200Dev(simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME,
+                                                    track_length=500))
+    dev.identify()
+    return dev
+
+
+def _count(track_archive: archive.TrackArchive, sql: str) -> int:
+    return track_archive.db.execute(sql).fetchone()[0]
+
+
+def _empty_tracks(track_archive: archive.TrackArchive) -> int:
+    return _count(track_archive, "SELECT count(*) FROM tracks t "
+                                 "WHERE NOT EXISTS (SELECT 1 FROM points p WHERE p.track_id = t.id)")
+
+
+@pytest.fixture
+def track_archive(tmp_path):
+    with archive.TrackArchive(str(tmp_path / "tracks.db")) as track_archive:
+        yield track_archive
+
+
+def test_device_is_archived_once(track_archive):
+    dev = _device()
+    waypoints = gtbatch.decode_dump(bytes(dev.dev.flash[pygotu.PAGE_SIZE:]), NUM_RECORDS).waypoints()
+    num_tracks, num_points = track_archive.add_device(dev)
+    assert num_points == len(waypoints)
+    assert num_tracks == _count(track_archive, "SELECT count(*) FROM tracks") > 1
+    points = track_archive.query_points()
+    assert np.array_equal(np.sort(points.epoch_ms), np.sort(waypoints.epoch_ms))
+
+    assert track_archive.add_device(_device()) == (0, 0)
+    assert _count(track_archive, "SELECT count(*) FROM points") == len(waypoints)
+    assert _count(track_archive, "SELECT count(*) FROM tracks") == num_tracks
+    assert _empty_tracks(track_archive) == 0
+
+
+def test_duplicate_track_is_not_kept(track_archive):
+    records = pygotu.page_records(0, simulator.synthesize_records(200, start_time=START_TIME).tobytes())
+    assert track_archive.add_track(1, records[:100]) == 100
+    # Starts at another time, so it would be a new track, but all its points are archived
+    assert track_archive.add_track(1, records[50:100]) == 0
+    assert _count(track_archive, "SELECT count(*) FROM tracks") == 1
+    # The same points of another device are not duplicates
+    assert track_archive.add_track(2, records[50:100]) == 50
+    assert _empty_tracks(track_archive) == 0
+
+
+def test_rtree_covers_every_point(track_archive):
+    track_archive.add_device(_device())
+    covered = _count(track_archive, "SELECT sum(last_id - id + 1) FROM points_rtree")
+    assert covered == _count(track_archive, "SELECT count(*) FROM points")
+
+    points = track_archive.query_points()
+    bbox = (float(np.percentile(points.lat, 25)), float(np.percentile(points.lon, 25)),
+            float(np.percentile(points.lat, 75)), float(np.percentile(points.lon, 75)))
+    inside = ((points.lat >= bbox[0]) & (points.lat <= bbox[2]) &
+              (points.lon >= bbox[1]) & (points.lon <= bbox[3]))
+    assert len(track_archive.query_points(bbox)) == np.count_nonzero(inside) > 0
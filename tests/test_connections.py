@@ -0,0 +1,141 @@
+import pytest
+
+import connections
+import pygotu
+import simulator
+import stats
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(pygotu, "RETRY_BACKOFF", 0.0)
+
+
+def _usb_serial(sim: simulator.SimulatedDevice) -> connections.USBSerial:
+    usb = simulator.SimulatedUSB(sim)
+    return connections.USBSerial(usb, usb)
+
+
+def test_adaptive_timeout_follows_the_transfer_durations():
+    timeout = connections.AdaptiveTimeout("read")
+    for _ in range(connections.RTT_MIN_SAMPLES - 1):
+        timeout.record(10.0)
+    assert timeout.timeout == connections.SLOW_TIMEOUT
+    timeout.record(10.0)
+    assert timeout.timeout == int(10.0 * connections.RTT_FACTOR + connections.RTT_MARGIN)
+
+    timeout.timed_out()
+    timeout.timed_out()
+    assert timeout.timeout == int(10.0 * connections.RTT_FACTOR + connections.RTT_MARGIN) * 4
+    timeout.record(10.0)
+    assert timeout.timeout == int(10.0 * connections.RTT_FACTOR + connections.RTT_MARGIN)
+
+
+def test_adaptive_timeout_floor():
+    timeout = connections.AdaptiveTimeout("read", connections.COMMAND_MIN_TIMEOUT)
+    for _ in range(connections.RTT_WINDOW):
+        timeout.record(0.1)
+    assert timeout.timeout == connections.COMMAND_MIN_TIMEOUT
+    for _ in range(20):
+        timeout.timed_out()
+    assert timeout.timeout == connections.SLOW_TIMEOUT
+
+
+def test_command_responses_keep_the_command_floor():
+    connection = _usb_serial(simulator.SimulatedDevice(num_records=3000))
+    dev = pygotu.open_device(connection)
+    for _ in range(connections.RTT_WINDOW):
+        dev.count()
+    assert connection.read_timeout.timeout == connections.COMMAND_MIN_TIMEOUT
+    assert connection.write_timeout.timeout == connections.COMMAND_MIN_TIMEOUT
+    dev.read_page(1)
+    assert connection.bulk_read_timeout.min_timeout == connections.MIN_TIMEOUT
+
+
+def test_simulated_timeouts_reach_the_adaptive_timeouts(no_backoff):
+    sim = simulator.SimulatedDevice(num_records=3000, timeout_rate=0.1, seed=4)
+    connection = _usb_serial(sim)
+    sync_stats = stats.Stats()
+    dev = pygotu.open_device(connection, sync_stats)
+    assert len(list(dev.all_records())) == 3000
+    timeouts = connection.read_timeout.timeouts + connection.bulk_read_timeout.timeouts
+    assert dev.retries > 0
+    assert timeouts >= dev.retries
+    assert sum(operation.timeouts for operation in sync_stats.transfers.values()) == timeouts
+
+
+def test_receive_buffer_views_survive_a_reallocation():
+    buf = connections.ReceiveBuffer(64)
+    buf.append(bytes(range(48)))
+    view = buf.read_view(40)
+    buf.append(bytes(range(100, 140)))
+    assert buf.allocations == 2
+    assert view.tobytes() == bytes(range(40))
+    assert buf.read_view(48).tobytes() == bytes(range(40, 48)) + bytes(range(100, 140))
+    assert len(buf) == 0
+
+
+def test_receive_buffer_wraps_around_once_the_views_are_released():
+    buf = connections.ReceiveBuffer(64)
+    for i in range(20):
+        buf.append(bytes(range(i, i + 24)))
+        assert buf.read_view(20).tobytes() == bytes(range(i, i + 20))
+        assert buf.read_view(4).tobytes() == bytes(range(i + 20, i + 24))
+    assert buf.allocations == 1
+    assert buf.wraps > 0
+    # Unread data moves to the start of the arena
+    buf.append(bytes(range(40)))
+    buf.read_view(30).tobytes()
+    buf.append(bytes(range(100, 140)))
+    assert buf.read_view(50).tobytes() == bytes(range(30, 40)) + bytes(range(100, 140))
+    assert buf.allocations == 1
+
+
+def test_receive_buffer_clear_drops_the_unread_data():
+    buf = connections.ReceiveBuffer()
+    buf.append(b"\x93\x00\x01\xff" + bytes(12))
+    assert buf.read_view(4).tobytes() == b"\x93\x00\x01\xff"
+    buf.clear()
+    assert len(buf) == 0
+    assert buf.read_view(4).tobytes() == b""
+
+
+def test_flush_drains_a_late_response():
+    connection = _usb_serial(simulator.SimulatedDevice(num_records=3000))
+    dev = pygotu.open_device(connection)
+    # A page read whose response is left unread, like one read after its timeout
+    dev.write_cmd(*pygotu.flash_read_command(pygotu.PAGE_SIZE, pygotu.PAGE_SIZE))
+    dev.resync()
+    assert dev.count() == 3000
+
+
+def test_idempotent_commands_are_retried(no_backoff):
+    sim = simulator.SimulatedDevice(num_records=3000, seed=3)
+    dev = pygotu.open_device(sim)
+    sim.timeout_rate = 0.3
+    for _ in range(20):
+        assert dev.count() == 3000
+        assert dev.identify() == simulator.DEFAULT_SERIAL
+        assert not dev.is_block_empty(1)
+    assert dev.retries > 0
+    assert dev.resyncs >= dev.retries
+
+
+def test_status_polls_are_retried(no_backoff, monkeypatch):
+    sim = simulator.SimulatedDevice(num_records=3000)
+    dev = pygotu.open_device(sim)
+    transaction = pygotu.GT200Dev.transaction
+    polls = []
+
+    def late_polls(self, cmd1, cmd2, fmt=None):
+        if cmd1 == pygotu.unk_write2_command(0x01)[0]:
+            polls.append(cmd1)
+            if len(polls) % 2:
+                raise TimeoutError("Late status")
+        return transaction(self, cmd1, cmd2, fmt)
+
+    monkeypatch.setattr(pygotu.GT200Dev, "transaction", late_polls)
+    plan = dev.purge_all_120()
+    assert plan.erases == plan.last_block
+    assert sim.num_records == 0
+    assert dev.retries == len(polls) // 2
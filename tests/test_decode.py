@@ -0,0 +1,15 @@
+import gtbatch
+
+WAYPOINT_FIELDS = ('lat', 'lon', 'elevation', 'speed', 'course', 'ehpe', 'sat')
+
+
+def test_record_batch_matches_gtrecord(dump, gt_records):
+    batch = gtbatch.decode_dump(dump)
+    assert batch.valid.tolist() == [rec.valid for rec in gt_records]
+    assert batch.is_waypoint.tolist() == [rec.is_waypoint for rec in gt_records]
+    dated = [rec.epoch_ms is not None for rec in gt_records]
+    assert batch.epoch_ms[dated].tolist() == [rec.epoch_ms for rec in gt_records if rec.epoch_ms is not None]
+    waypoints = [rec for rec in gt_records if rec.is_waypoint]
+    for name in WAYPOINT_FIELDS:
+        assert getattr(batch, name)[batch.is_waypoint].tolist() == [getattr(rec, name) for rec in waypoints], name
+
@@ -0,0 +1,69 @@
+import io
+
+import pytest
+
+import benchmark
+import export
+import gtbatch
+import pygotu
+import simulator
+
+NUM_RECORDS = 3000
+
+
+@pytest.fixture(scope="module")
+def waypoint_dump() -> bytes:
+    records = simulator.synthesize_records(NUM_RECORDS, start_time=1500000000)
+    records['flag'][5::17] |= gtbatch.FLAG_INVALID
+    return records.tobytes()
+
+
+def _gt_records(dump: bytes) -> list:
+    return [pygotu.GTRecord(i, dump[i * pygotu.RECORD_SIZE:(i + 1) * pygotu.RECORD_SIZE])
+            for i in range(NUM_RECORDS)]
+
+
+def _write(writer, write) -> str:
+    f = io.StringIO()
+    write(writer(f))
+    return f.getvalue()
+
+
+@pytest.mark.parametrize("name", sorted(export.WRITERS))
+def test_records_and_batches_give_the_same_file(waypoint_dump, name):
+    writer = export.WRITERS[name]
+    # Records without page buffer are written one by one, the other ones as columns
+    scalar = _write(writer, lambda w: w.write_tracks([pygotu.GTTrack(0, _gt_records(waypoint_dump))]))
+    lazy = pygotu.page_records(0, waypoint_dump, valid_only=False)
+    columnar = _write(writer, lambda w: w.write_tracks([pygotu.GTTrack(0, lazy)]))
+    batches = _write(writer, lambda w: w.write_batches([gtbatch.decode_dump(waypoint_dump)]))
+    assert columnar == scalar
+    assert batches == scalar
+
+
+def test_gpx_matches_the_legacy_writer(waypoint_dump):
+    records = _gt_records(waypoint_dump)
+    legacy = io.StringIO()
+    benchmark._legacy_write_gpx(legacy, records)
+    gpx = _write(export.GPXWriter, lambda w: w.write_tracks([pygotu.GTTrack(0, records)]))
+    name = export._track_name(pygotu.GTTrack(0, records).first_time)
+    assert gpx == legacy.getvalue().replace("<name>Track</name>", "<name>{}</name>".format(name))
+
+
+def test_chunks_do_not_change_the_file(waypoint_dump, monkeypatch):
+    lazy = pygotu.page_records(0, waypoint_dump, valid_only=False)
+    expected = _write(export.GeoJSONWriter, lambda w: w.write_tracks([pygotu.GTTrack(0, lazy)]))
+    monkeypatch.setattr(export, "CHUNK_POINTS", 100)
+    assert _write(export.GeoJSONWriter, lambda w: w.write_tracks([pygotu.GTTrack(0, lazy)])) == expected
+
+
+@pytest.mark.parametrize("path, expected", [
+    ("out.gpx", "gpx"),
+    ("out.KML", "kml"),
+    ("out.geojson", "geojson"),
+    ("out.csv", "csv"),
+    ("out.gtt", "gtt"),
+    ("out", "gpx"),
+])
+def test_format_for(path, expected):
+    assert export.format_for(path) == expected
@@ -0,0 +1,125 @@
+import os
+from struct import pack, unpack_from
+
+import pytest
+
+import flashimage
+import gt2gpx
+import pygotu
+import simulator
+
+NUM_RECORDS = 5000
+START_TIME = 1500000000
+START_MS = START_TIME * 1000
+LAST_PAGE = -(-NUM_RECORDS // pygotu.RECORDS_PER_PAGE)
+
+
+def _device() -> pygotu.GT200Dev:
+    return pygotu.open_device(simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME))
+
+
+def _records(dev: pygotu.GT200Dev, window: pygotu.TimeWindow=None) -> list:
+    return [(rec.idx, rec.epoch_ms, rec.lat, rec.lon) for rec in dev.all_records(window=window)]
+
+
+def _window(since: int, until: int) -> pygotu.TimeWindow:
+    return pygotu.TimeWindow(START_MS + since * 1000, START_MS + until * 1000)
+
+
+@pytest.fixture(scope="module")
+def image(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp("image") / "flash.img")
+    gt2gpx.dump_device(_device(), path)
+    return path
+
+
+def test_image_holds_the_flash(image):
+    with flashimage.FlashImage(image) as flash:
+        assert (flash.serial, flash.num_records) == (simulator.DEFAULT_SERIAL, NUM_RECORDS)
+        assert flash.page_numbers == list(range(1, LAST_PAGE + 1))
+        dev = flashimage.ImageDev(flash)
+        assert _records(dev) == _records(_device())
+
+
+@pytest.mark.parametrize("since, until", [(1000, 2000), (0, 100), (4900, 6000)])
+def test_window_of_a_full_image(image, since, until):
+    window = _window(since, until)
+    with flashimage.FlashImage(image) as flash:
+        assert _records(flashimage.ImageDev(flash), window) == _records(_device(), window)
+
+
+def test_windowed_dump(tmp_path):
+    path = str(tmp_path / "window.img")
+    window = _window(1000, 2000)
+    gt2gpx.dump_device(_device(), path, window)
+    with flashimage.FlashImage(path) as flash:
+        first, last = 1000 // pygotu.RECORDS_PER_PAGE + 1, 2000 // pygotu.RECORDS_PER_PAGE + 1
+        assert flash.page_numbers == list(range(first, last + 1))
+        dev = flashimage.ImageDev(flash)
+        assert _records(dev, window) == _records(_device(), window)
+        # Narrower window, among the stored pages
+        narrower = _window(1500, 1600)
+        assert _records(dev, narrower) == _records(_device(), narrower)
+        with pytest.raises(Exception, match="not in the image"):
+            dev.read_page(1)
+
+
+def test_find_stored_page(tmp_path):
+    path = str(tmp_path / "window.img")
+    gt2gpx.dump_device(_device(), path, _window(1000, 3000))
+    with flashimage.FlashImage(path) as flash:
+        dev = flashimage.ImageDev(flash)
+        pages = flash.page_numbers
+        for i, page in enumerate(pages):
+            page_start_ms = START_MS + (page - 1) * pygotu.RECORDS_PER_PAGE * 1000
+            assert dev._find_stored_page(page_start_ms) == i
+            assert dev._find_stored_page(page_start_ms + 1000) == i
+        assert dev._find_stored_page(START_MS) == 0
+        assert dev._find_stored_page(START_MS + NUM_RECORDS * 1000) == len(pages) - 1
+
+
+def test_images_are_read_only(image):
+    with flashimage.FlashImage(image) as flash:
+        with pytest.raises(Exception, match="read only"):
+            flashimage.ImageDev(flash).transaction(*pygotu.CMD_COUNT)
+
+
+def _damaged(image: str, tmp_path, data: bytes) -> str:
+    path = str(tmp_path / "damaged.img")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+@pytest.mark.parametrize("damage, message", [
+    (lambda data: b"", "Not a flash image"),
+    (lambda data: data[:flashimage.HEADER_SIZE - 1], "Not a flash image"),
+    (lambda data: b"XXXX" + data[4:], "Not a flash image"),
+    (lambda data: data[:len(data) - pygotu.PAGE_SIZE], "Truncated flash image"),
+    (lambda data: data[:flashimage.HEADER_SIZE], "Truncated flash image"),
+])
+def test_damaged_images_are_rejected(image, tmp_path, damage, message):
+    with open(image, "rb") as f:
+        data = f.read()
+    with pytest.raises(Exception, match=message):
+        flashimage.FlashImage(_damaged(image, tmp_path, damage(data)))
+
+
+def test_corrupted_page_count_is_rejected(image, tmp_path):
+    with open(image, "rb") as f:
+        data = f.read()
+    header = list(unpack_from(flashimage.HEADER_FORMAT, data))
+    # Number of stored pages, beyond the capacity of the page map
+    header[7] = header[8] + 1
+    data = pack(flashimage.HEADER_FORMAT, *header) + data[flashimage.HEADER_SIZE:]
+    with pytest.raises(Exception, match="Corrupted flash image"):
+        flashimage.FlashImage(_damaged(image, tmp_path, data))
+
+
+def test_aborted_dump_leaves_no_file(tmp_path):
+    path = str(tmp_path / "flash.img")
+    with pytest.raises(IOError):
+        with flashimage.FlashImageWriter(path, 1, 0x13, 10) as writer:
+            writer.write_page(1, b"\x00" * 32)
+            raise IOError("Device unplugged")
+    assert os.listdir(str(tmp_path)) == []
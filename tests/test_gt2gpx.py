@@ -0,0 +1,49 @@
+import hashlib
+
+import pytest
+
+import flashimage
+import gt2gpx
+import simulator
+
+
+def _device() -> simulator.SimulatedDevice:
+    return simulator.SimulatedDevice(num_records=3000, start_time=1500000000, track_length=400)
+
+
+def _md5(path) -> str:
+    with open(str(path), "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+@pytest.fixture(scope="module")
+def expected(tmp_path_factory) -> str:
+    path = tmp_path_factory.mktemp("sequential") / "tracks.gpx"
+    gt2gpx.download_track(_device(), str(path))
+    return _md5(path)
+
+
+def test_pipelined_download(tmp_path, expected):
+    gt2gpx.download_track(_device(), str(tmp_path / "tracks.gpx"), pipelined=True)
+    assert _md5(tmp_path / "tracks.gpx") == expected
+
+
+def test_cached_download(tmp_path, expected):
+    cache = str(tmp_path / "cache")
+    gt2gpx.download_track(_device(), str(tmp_path / "first.gpx"), cache_directory=cache)
+    gt2gpx.download_track(_device(), str(tmp_path / "tracks.gpx"), cache_directory=cache)
+    assert _md5(tmp_path / "first.gpx") == expected
+    assert _md5(tmp_path / "tracks.gpx") == expected
+
+
+def test_flash_image_conversion(tmp_path, expected):
+    gt2gpx.dump_flash(_device(), str(tmp_path / "flash.img"))
+    with flashimage.FlashImage(str(tmp_path / "flash.img")) as image:
+        gt2gpx.download_track(image, str(tmp_path / "tracks.gpx"))
+    assert _md5(tmp_path / "tracks.gpx") == expected
+
+
+def test_archive_query(tmp_path, expected):
+    gt2gpx.archive_tracks(_device(), str(tmp_path / "tracks.db"))
+    gt2gpx.query_archive(str(tmp_path / "tracks.db"), str(tmp_path / "tracks.gpx"))
+    assert _md5(tmp_path / "tracks.gpx") == expected
@@ -0,0 +1,72 @@
+import integrity
+import pygotu
+import simulator
+
+NUM_RECORDS = 3000
+
+
+def _download(sim: simulator.SimulatedDevice, validator: integrity.PageValidator=None) -> bytes:
+    dev = pygotu.GT200Dev(sim)
+    dev.validator = validator
+    return b"".join(bytes(buf) for _, buf in dev.all_pages())
+
+
+def _flash_records(sim: simulator.SimulatedDevice) -> bytes:
+    return bytes(sim.flash[pygotu.PAGE_SIZE:pygotu.PAGE_SIZE + NUM_RECORDS * pygotu.RECORD_SIZE])
+
+
+def test_clean_pages_pass_the_checks():
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS)
+    issues, _ = integrity.check_records(_flash_records(sim))
+    assert not issues.any()
+
+
+def test_lost_packet_is_detected():
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS)
+    page = _flash_records(sim)[:pygotu.PAGE_SIZE]
+    # A lost packet shifts the following data, the page ending with erased bytes
+    lost = (page[:0x100] + page[0x100 + simulator.PACKET_SIZE:]).ljust(pygotu.PAGE_SIZE, b"\xff")
+    issues, _ = integrity.check_records(lost)
+    assert issues.any()
+
+
+def _corrupted_pages(dump: bytes, sim: simulator.SimulatedDevice) -> int:
+    flash = _flash_records(sim)
+    return sum(dump[pos:pos + pygotu.PAGE_SIZE] != flash[pos:pos + pygotu.PAGE_SIZE]
+               for pos in range(0, len(flash), pygotu.PAGE_SIZE))
+
+
+def test_corrupted_pages_are_repaired():
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS, corrupt_rate=0.3, seed=3)
+    corrupted = _corrupted_pages(_download(sim), sim)
+
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS, corrupt_rate=0.3, seed=3)
+    validator = integrity.PageValidator()
+    dump = _download(sim, validator)
+    issues, _ = integrity.check_records(dump)
+    assert not issues.any()
+    # Garbled bytes within the plausible values of a field, like the satellites, go unnoticed
+    assert _corrupted_pages(dump, sim) < corrupted
+    assert validator.repaired_pages > 0
+    assert validator.repaired_pages == validator.suspect_pages
+    assert validator.unresolved_pages == 0
+
+
+def test_stable_pages_are_kept():
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS)
+    # A record really stored with an invalid date, read identically each time
+    record = NUM_RECORDS // 2
+    sim.flash[pygotu.PAGE_SIZE + record * pygotu.RECORD_SIZE + 1] = 0x00
+    validator = integrity.PageValidator()
+    assert _download(sim, validator) == _flash_records(sim)
+    assert validator.stable_pages == 1
+    assert validator.rereads == 1
+    assert validator.issue_counts["date"] == 1
+
+
+def test_reread_budget_is_respected():
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS, corrupt_rate=1.0)
+    validator = integrity.PageValidator(budget=5)
+    _download(sim, validator)
+    assert validator.rereads == 5
+    assert validator.unresolved_pages > 0
@@ -0,0 +1,84 @@
+import datetime
+from struct import pack, unpack
+
+import pytest
+
+import gtbatch
+import pygotu
+
+WAYPOINT_FIELDS = ('lat', 'lon', 'elevation', 'speed', 'course', 'ehpe', 'sat')
+
+
+def test_lazy_records_match_gtrecord(dump, gt_records):
+    lazy = pygotu.page_records(0, dump, valid_only=False)
+    for expected, rec in zip(gt_records, lazy):
+        assert (rec.valid, rec.epoch_ms, rec.kind) == (expected.valid, expected.epoch_ms, expected.kind), rec.idx
+        assert rec.datetime == expected.datetime
+        if expected.is_waypoint:
+            assert [getattr(rec, name) for name in WAYPOINT_FIELDS] == \
+                   [getattr(expected, name) for name in WAYPOINT_FIELDS]
+            assert rec.flagopts == expected.flagopts
+        else:
+            assert rec.msg == expected.msg
+
+
+def test_valid_only_keeps_the_valid_records(dump, gt_records):
+    lazy = pygotu.page_records(0, dump)
+    assert [rec.idx for rec in lazy] == [rec.idx for rec in gt_records if rec.valid]
+
+
+def _header(year_offset: int, month: int, day: int, hour: int, minutes: int, ms: int) -> bytes:
+    return pack(">BBHH", 0, year_offset << 4 | month, day << 11 | hour << 6 | minutes, ms).ljust(pygotu.RECORD_SIZE, b"\x00")
+
+
+@pytest.mark.parametrize("year_offset, month, day, hour, minutes, ms", [
+    (8, 6, 15, 12, 30, 45123),
+    # Month 0, and month 13 wrapping to 0
+    (8, 0, 15, 12, 30, 0),
+    (8, 13, 15, 12, 30, 0),
+    # Months 14 and 15 wrap to January and February
+    (8, 14, 15, 12, 30, 0),
+    (8, 15, 29, 12, 30, 0),
+    # Day 0 is the first of the month, days beyond the end of the month are invalid
+    (8, 3, 0, 0, 0, 0),
+    (8, 4, 31, 0, 0, 0),
+    (8, 12, 31, 23, 59, 59999),
+    # February 29th, in a leap year and in a common year
+    (8, 2, 29, 0, 0, 0),
+    (9, 2, 29, 0, 0, 0),
+    (9, 2, 30, 0, 0, 0),
+    # Out of range hours and minutes wrap around
+    (8, 6, 15, 31, 63, 0),
+    # ms/1000 beyond a minute wraps around the seconds
+    (8, 6, 15, 12, 30, 59999),
+    (8, 6, 15, 12, 30, 60000),
+    (8, 6, 15, 12, 30, 65535),
+])
+def test_decode_epoch_ms_matches_gtrecord(year_offset, month, day, hour, minutes, ms):
+    buf = _header(year_offset, month, day, hour, minutes, ms)
+    _, ym, dhm, ms = unpack(">BBHH", buf[:6])
+    record = pygotu.GTRecord(0, buf)
+    expected = None if record.datetime is None else pygotu.datetime_to_epoch_ms(record.datetime)
+    assert pygotu.decode_epoch_ms(ym, dhm, ms) == expected
+    assert pygotu.LazyGTRecord(0, buf, 0).epoch_ms == expected
+
+
+@pytest.mark.parametrize("sat_map, sats", [(0x0000000f, 4), (-0x80000000, 1), (-0x7ffffff1, 5), (-1, 32)])
+def test_sat_map_sign_bit_is_counted(sat_map, sats):
+    # Satellite maps with the top bit set unpack as negative: they used to count 0 satellites
+    buf = _header(8, 6, 15, 12, 30, 0)[:6] + pack(">Hiii", 0, sat_map, 485000000, 23000000)
+    buf = buf.ljust(pygotu.RECORD_SIZE, b"\x00")
+    assert pygotu.bitcount(sat_map) == sats
+    assert pygotu.GTRecord(0, buf).sat == sats
+    assert pygotu.LazyGTRecord(0, buf, 0).sat == sats
+    assert gtbatch.decode_dump(buf).sat.tolist() == [sats]
+
+
+@pytest.mark.parametrize("ms, second, microsecond", [(0, 0, 0), (45001, 45, 1000), (45123, 45, 123000), (59999, 59, 999000)])
+def test_record_milliseconds_are_microseconds(ms, second, microsecond):
+    # The milliseconds field used to be passed as microseconds to the datetime
+    buf = _header(8, 6, 15, 12, 30, ms)
+    expected = datetime.datetime(2024, 6, 15, 12, 30, second, microsecond)
+    for record in (pygotu.GTRecord(0, buf), pygotu.LazyGTRecord(0, buf, 0)):
+        assert record.datetime == expected
+        assert record.isotime == expected.isoformat(timespec="microseconds") + "Z"
@@ -0,0 +1,58 @@
+from functools import partial
+
+import multidevice
+import simulator
+
+NUM_RECORDS = 1000
+
+
+def _connections(count: int=3) -> dict:
+    return {"usb:{}".format(i): partial(simulator.SimulatedDevice, num_records=NUM_RECORDS + i, serial=0x1000 + i)
+            for i in range(count)}
+
+
+def _read_records(dev, job) -> int:
+    return sum(1 for _ in dev.all_records())
+
+
+def test_every_device_is_synchronized():
+    jobs = multidevice.SyncOrchestrator(_connections(), _read_records).run()
+    assert [job.state for job in jobs] == [multidevice.STATE_DONE] * 3
+    assert [job.serial for job in jobs] == [0x1000, 0x1001, 0x1002]
+    assert [job.result for job in jobs] == [NUM_RECORDS, NUM_RECORDS + 1, NUM_RECORDS + 2]
+    assert [job.records_read for job in jobs] == [job.records_total for job in jobs]
+
+
+def test_failing_devices_do_not_stop_the_others():
+    def unplugged():
+        raise IOError("Device unplugged")
+
+    def failing_task(dev, job):
+        if dev.serial == 0x1001:
+            raise IOError("Disk full")
+        return _read_records(dev, job)
+
+    device_connections = _connections()
+    device_connections["usb:3"] = unplugged
+    orchestrator = multidevice.SyncOrchestrator(device_connections, failing_task)
+    jobs = orchestrator.run()
+    assert [job.state for job in jobs] == [multidevice.STATE_DONE, multidevice.STATE_FAILED,
+                                           multidevice.STATE_DONE, multidevice.STATE_FAILED]
+    assert [str(job.error) for job in orchestrator.failed] == ["Disk full", "Device unplugged"]
+    assert jobs[2].result == NUM_RECORDS + 2
+
+
+def test_devices_selected_by_serial():
+    jobs = multidevice.SyncOrchestrator(_connections(), _read_records, devices=[0x1002]).run()
+    assert [job.state for job in jobs] == [multidevice.STATE_SKIPPED, multidevice.STATE_SKIPPED,
+                                           multidevice.STATE_DONE]
+
+
+def test_devices_selected_by_address():
+    jobs = multidevice.SyncOrchestrator(_connections(), _read_records, devices=["usb:1"]).run()
+    assert [(job.address, job.state) for job in jobs] == [("usb:1", multidevice.STATE_DONE)]
+
+
+def test_enumerate_devices():
+    jobs = multidevice.enumerate_devices(_connections(2))
+    assert [(job.serial, job.records_total) for job in jobs] == [(0x1000, NUM_RECORDS), (0x1001, NUM_RECORDS + 1)]
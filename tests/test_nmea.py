@@ -0,0 +1,67 @@
+import datetime
+
+import nmea
+import pygotu
+
+DATE_MS = pygotu.datetime_to_epoch_ms(datetime.datetime(2020, 6, 1))
+
+
+def _rmc(hhmmss: str, date: str="010620") -> bytes:
+    return nmea.format_sentence("GPRMC,{}.00,A,4807.038,N,01131.000,E,10.0,84.4,{},,".format(hhmmss, date))
+
+
+def _gga(hhmmss: str) -> bytes:
+    return nmea.format_sentence("GPGGA,{}.00,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,".format(hhmmss))
+
+
+def test_lines_spanning_chunks_are_joined():
+    splitter = nmea.LineSplitter()
+    assert splitter.feed(b"$ab") == []
+    lines = splitter.feed(b"c\r\n$def\r\n$g")
+    assert [bytes(line) for line in lines] == [b"$abc", b"$def"]
+    assert [bytes(line) for line in splitter.feed(b"h\n")] == [b"$gh"]
+
+
+def test_long_lines_are_dropped():
+    splitter = nmea.LineSplitter()
+    lines = splitter.feed(b"x" * (nmea.MAX_LINE + 1) + b"\r\n$ok\r\n")
+    assert [bytes(line) for line in lines] == [b"$ok"]
+    assert splitter.feed(b"y" * (nmea.MAX_LINE + 1)) == []
+    assert splitter.overflows == 2
+
+
+def test_fix_is_assembled_from_both_sentences():
+    parser = nmea.NMEAParser()
+    data = _rmc("123519") + _gga("123519")
+    # Fed byte by byte, the fix only comes with the end of the second sentence
+    fixes = [fix for i in range(len(data)) for fix in parser.feed(data[i:i + 1])]
+    assert len(fixes) == 1
+    fix = fixes[0]
+    assert fix.valid
+    assert fix.epoch_ms == DATE_MS + (12 * 3600 + 35 * 60 + 19) * 1000
+    assert round(fix.lat, 4) == 48.1173
+    assert round(fix.lon, 4) == 11.5167
+    assert fix.elevation == 545.4
+    assert fix.sat == 8
+    assert round(fix.speed, 2) == 18.52
+
+
+def test_wrong_checksums_are_skipped():
+    parser = nmea.NMEAParser()
+    corrupted = bytearray(_rmc("123519"))
+    corrupted[10] ^= 1
+    assert parser.feed(bytes(corrupted) + _gga("123520")) == []
+    assert parser.checksum_errors == 1
+    assert parser.sentences == 2
+    assert parser.pending.status is None
+
+
+def test_gga_past_midnight_is_on_the_next_day():
+    parser = nmea.NMEAParser()
+    fixes = parser.feed(_rmc("235959") + _gga("235959") + _gga("000000") + _gga("000001"))
+    fixes += parser.flush()
+    epoch_ms = [fix.epoch_ms for fix in fixes]
+    assert epoch_ms == [DATE_MS + 86399000, DATE_MS + 86400000, DATE_MS + 86401000]
+    # The next RMC date is the one carried over
+    fixes = parser.feed(_rmc("000002", "020620") + _gga("000002"))
+    assert [fix.epoch_ms for fix in fixes] == [DATE_MS + 86402000]
@@ -0,0 +1,48 @@
+import os
+
+import pagecache
+import pygotu
+
+SERIAL = 0x12345678
+
+
+def _page(i: int) -> bytes:
+    return bytes([i]) * pygotu.PAGE_SIZE
+
+
+def test_header_counts_the_synced_pages(tmp_path):
+    directory = str(tmp_path)
+    cache = pagecache.PageCache(SERIAL, directory)
+    for i in range(1, 4):
+        cache.store_page(i, _page(i), i * pygotu.RECORDS_PER_PAGE)
+    assert cache.read_page(2) == _page(2)
+    # Crash before the next commit: the pages stored since the last one are not counted
+    with pagecache.PageCache(SERIAL, directory) as reopened:
+        assert reopened.num_records == 0
+    cache.close()
+
+    with pagecache.PageCache(SERIAL, directory) as cache:
+        assert cache.num_records == 3 * pygotu.RECORDS_PER_PAGE
+        assert cache.read_page(3) == _page(3)
+
+
+def test_pages_are_synced_in_batches(tmp_path, monkeypatch):
+    syncs = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: syncs.append(fd) or fsync(fd))
+    with pagecache.PageCache(SERIAL, str(tmp_path)) as cache:
+        syncs.clear()
+        for i in range(1, 2 * pagecache.SYNC_PAGES + 2):
+            cache.store_page(i, _page(i % 256), i * pygotu.RECORDS_PER_PAGE)
+        # The data, then the header, of each batch
+        assert len(syncs) == 4
+    assert len(syncs) == 6
+
+
+def test_clear_drops_the_pages(tmp_path):
+    with pagecache.PageCache(SERIAL, str(tmp_path)) as cache:
+        cache.store_page(1, _page(1), pygotu.RECORDS_PER_PAGE)
+        cache.clear()
+    with pagecache.PageCache(SERIAL, str(tmp_path)) as cache:
+        assert cache.num_records == 0
+        assert cache.full_pages(1000) == 0
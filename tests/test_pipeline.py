@@ -0,0 +1,100 @@
+import io
+
+import pytest
+
+import export
+import gtbatch
+import pipeline
+import pygotu
+import simulator
+
+NUM_RECORDS = 5000
+START_TIME = 1500000000
+
+
+def _device(**kwargs) -> pygotu.GT200Dev:
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME, track_length=800, **kwargs)
+    return pygotu.open_device(sim)
+
+
+def _threads_stopped(download: pipeline.DownloadPipeline) -> bool:
+    return not download.reader.is_alive() and not download.decoder.is_alive()
+
+
+def test_records_in_flash_order():
+    expected = [(rec.idx, rec.epoch_ms, rec.valid) for rec in _device().all_records(valid_only=False)]
+    with _device().pipeline(queue_size=2) as download:
+        records = [(rec.idx, rec.epoch_ms, rec.valid) for rec in download.records(valid_only=False)]
+    assert records == expected
+    assert _threads_stopped(download)
+
+
+def test_writer_stage_output_matches_sequential_writes():
+    expected = io.StringIO()
+    export.GPXWriter(expected).write_tracks(_device().stream_tracks())
+
+    written = io.StringIO()
+    with _device().pipeline(queue_size=2) as download:
+        download.write_tracks(export.GPXWriter(written), download.stream_tracks())
+    assert written.getvalue() == expected.getvalue()
+    assert _threads_stopped(download)
+
+
+def test_leaving_early_cancels_the_download():
+    dev = _device()
+    with dev.pipeline(queue_size=1) as download:
+        for rec in download.records():
+            break
+    assert download.cancelled.is_set()
+    assert _threads_stopped(download)
+    # Bounded queues: the reader stopped well before the end of the flash
+    assert dev.dev.commands[0x05] < NUM_RECORDS // pygotu.RECORDS_PER_PAGE
+
+
+class FailingWriter(export.GPXWriter):
+    __slots__ = []
+
+    def end_track(self):
+        raise IOError("Disk full")
+
+
+def test_writer_error_stops_the_download():
+    dev = _device()
+    with pytest.raises(IOError):
+        with dev.pipeline(queue_size=1) as download:
+            download.write_tracks(FailingWriter(io.StringIO()), download.stream_tracks())
+    assert _threads_stopped(download)
+    assert dev.dev.commands[0x05] < NUM_RECORDS // pygotu.RECORDS_PER_PAGE
+
+
+def test_reader_error_is_raised_by_the_consumer(monkeypatch):
+    def failing_read_page(self, page: int):
+        raise IOError("Device unplugged")
+
+    dev = _device()
+    monkeypatch.setattr(pygotu.GT200Dev, "read_page", failing_read_page)
+    with pytest.raises(IOError):
+        with dev.pipeline() as download:
+            download.write_tracks(export.GPXWriter(io.StringIO()), download.stream_tracks())
+    assert _threads_stopped(download)
+
+
+def test_page_fields_match_lazy_records(dump):
+    lazy = pygotu.page_records(0, dump, valid_only=False)
+    valid, epoch_ms = gtbatch.page_fields(dump)
+    assert valid == [rec.valid for rec in lazy]
+    assert epoch_ms == [rec.epoch_ms for rec in lazy]
+
+
+def test_prefilled_page_records(dump):
+    plain = pygotu.page_records(0, dump)
+    prefilled = pygotu.page_records(0, dump, fields=gtbatch.page_fields(dump))
+    assert [(rec.idx, rec.epoch_ms) for rec in prefilled] == [(rec.idx, rec.epoch_ms) for rec in plain]
+
+
+def test_decode_processes_keep_the_flash_order():
+    expected = [(rec.idx, rec.epoch_ms) for rec in _device().all_records()]
+    with _device().pipeline(queue_size=2, decode_processes=2) as download:
+        records = [(rec.idx, rec.epoch_ms) for rec in download.records()]
+    assert records == expected
+    assert _threads_stopped(download)
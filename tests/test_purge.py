@@ -0,0 +1,39 @@
+import pytest
+
+import pygotu
+import simulator
+
+
+def _expected_blocks(num_records: int) -> int:
+    return -(-num_records // pygotu.RECORDS_PER_PAGE)
+
+
+@pytest.mark.parametrize("num_records", [0, 1, 128, 129, 3000])
+def test_purge_erases_the_used_blocks(num_records):
+    sim = simulator.SimulatedDevice(num_records=num_records)
+    plan = pygotu.GT200Dev(sim).purge_all_120()
+    assert not plan.searched
+    assert plan.last_block == _expected_blocks(num_records)
+    assert plan.erases == plan.last_block
+    assert sim.num_records == 0
+    assert set(sim.flash[pygotu.PAGE_SIZE:]) == {0xff}
+
+
+def test_purge_counts_every_poll():
+    sim = simulator.SimulatedDevice(num_records=3000, erase_polls=2)
+    plan = pygotu.GT200Dev(sim).purge_all_120()
+    # The SPI status reads are the block probes and the polls
+    assert plan.polls == sim.commands[0x05] - plan.probes
+    # A wait after each erase, each one polling until the device is no longer busy
+    assert plan.polls == plan.erases * 2
+
+
+@pytest.mark.parametrize("reported", [0, 200, 10000])
+def test_purge_searches_the_blocks_when_the_count_is_wrong(reported):
+    num_records = 3000
+    sim = simulator.SimulatedDevice(num_records=num_records)
+    sim.num_records = reported
+    plan = pygotu.GT200Dev(sim).plan_purge(pygotu.MODELS[sim.model_code][1])
+    assert plan.searched
+    assert plan.last_block == _expected_blocks(num_records)
+    assert plan.erases == 0
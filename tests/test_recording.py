@@ -0,0 +1,56 @@
+import pytest
+
+import pygotu
+import recording
+import simulator
+
+START_TIME = 1500000000
+
+
+def _device(**kwargs) -> simulator.SimulatedDevice:
+    return simulator.SimulatedDevice(num_records=2000, start_time=START_TIME, track_length=300, **kwargs)
+
+
+def _records(connection) -> tuple:
+    with pygotu.open_device(connection) as dev:
+        return [(rec.idx, rec.epoch_ms, rec.lat, rec.lon) for rec in dev.all_records()], dev.retries
+
+
+@pytest.mark.parametrize("values", [[0], [1, 127, 128, 300, 1 << 35]])
+def test_varints_round_trip(values):
+    buf = b"".join(recording._varint(n) for n in values)
+    decoded = []
+    pos = 0
+    while pos < len(buf):
+        n, pos = recording._read_varint(buf, pos)
+        decoded.append(n)
+    assert decoded == values
+
+
+def test_replay_gives_the_recorded_records(tmp_path):
+    path = str(tmp_path / "session.trace")
+    expected = _records(recording.RecordingConnection(_device(), path, label="sim"))
+    trace = recording.Trace(path)
+    assert trace.label == "sim"
+    assert trace.events
+    replay = recording.ReplayConnection(trace, speed=0)
+    assert _records(replay) == expected
+    assert replay.pos == len(trace.events)
+    assert replay.skipped == 0
+
+
+def test_replay_reproduces_the_timeouts(tmp_path, monkeypatch):
+    monkeypatch.setattr(pygotu, "RETRY_BACKOFF", 0.0)
+    path = str(tmp_path / "session.trace")
+    expected = _records(recording.RecordingConnection(_device(timeout_rate=0.05, seed=3), path))
+    assert expected[1] > 0
+    assert any(event.outcome == recording.OUTCOME_TIMEOUT for event in recording.Trace(path).events)
+    assert _records(recording.ReplayConnection(path, speed=0)) == expected
+
+
+def test_other_commands_do_not_match_the_trace(tmp_path):
+    path = str(tmp_path / "session.trace")
+    _records(recording.RecordingConnection(_device(), path))
+    replay = recording.ReplayConnection(path, speed=0)
+    with pytest.raises(recording.ReplayMismatch):
+        replay.write(pygotu.CMD_COUNT[0] + pygotu.CMD_COUNT[1])
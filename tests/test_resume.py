@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+import gt2gpx
+import journal
+import pagecache
+import pygotu
+import simulator
+
+NUM_RECORDS = 3000
+# Same records in each simulated device
+START_TIME = 1500000000
+INTERRUPTED_PAGE = 10
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def interrupt(monkeypatch):
+    """
+    Makes the downloads fail when reading the page INTERRUPTED_PAGE
+    """
+    read_page = pygotu.GT200Dev.read_page
+
+    def failing_read_page(self, page: int):
+        if page == INTERRUPTED_PAGE:
+            raise Interrupted()
+        return read_page(self, page)
+
+    monkeypatch.setattr(pygotu.GT200Dev, "read_page", failing_read_page)
+    return monkeypatch.undo
+
+
+def _download(path, cache_directory=None) -> simulator.SimulatedDevice:
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME)
+    gt2gpx.download_track(sim, str(path), cache_directory)
+    return sim
+
+
+def _pages_read(sim: simulator.SimulatedDevice) -> int:
+    # Flash reads, including the one of the model identification
+    return sim.commands[0x05]
+
+
+def test_journal_drops_a_torn_tail(tmp_path):
+    path = str(tmp_path / "out.journal")
+    page = bytes(range(256)) * (pygotu.PAGE_SIZE // 256)
+    with journal.DownloadJournal(1, path) as download_journal:
+        for i in range(1, 4):
+            download_journal.store_page(i, page, i * pygotu.RECORDS_PER_PAGE)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 100)
+
+    with journal.DownloadJournal(1, path) as download_journal:
+        assert sorted(download_journal.pages) == [1, 2]
+        assert download_journal.num_records == 2 * pygotu.RECORDS_PER_PAGE
+        assert download_journal.read_page(2) == page
+
+
+def test_journal_drops_a_corrupted_page(tmp_path):
+    path = str(tmp_path / "out.journal")
+    with journal.DownloadJournal(1, path) as download_journal:
+        for i in range(1, 4):
+            download_journal.store_page(i, bytes([i]) * pygotu.PAGE_SIZE, i * pygotu.RECORDS_PER_PAGE)
+    with open(path, "r+b") as f:
+        f.seek(-pygotu.PAGE_SIZE // 2, os.SEEK_END)
+        f.write(b"\x00")
+
+    with journal.DownloadJournal(1, path) as download_journal:
+        assert sorted(download_journal.pages) == [1, 2]
+
+
+def test_journal_of_another_device_is_ignored(tmp_path):
+    path = str(tmp_path / "out.journal")
+    with journal.DownloadJournal(1, path) as download_journal:
+        download_journal.store_page(1, bytes(pygotu.PAGE_SIZE), pygotu.RECORDS_PER_PAGE)
+    with journal.DownloadJournal(2, path) as download_journal:
+        assert download_journal.num_records == 0
+        assert not download_journal.pages
+
+
+def test_download_resumes_from_the_journal(tmp_path, interrupt):
+    with pytest.raises(Interrupted):
+        _download(tmp_path / "out.csv")
+    assert os.path.exists(journal.journal_path(str(tmp_path / "out.csv")))
+    interrupt()
+
+    sim = _download(tmp_path / "out.csv")
+    full = _download(tmp_path / "full.csv")
+    assert (tmp_path / "out.csv").read_bytes() == (tmp_path / "full.csv").read_bytes()
+    # The pages read before the interruption are served from the journal, its last record being probed
+    assert _pages_read(sim) == _pages_read(full) - (INTERRUPTED_PAGE - 1) + 1
+    assert not os.path.exists(journal.journal_path(str(tmp_path / "out.csv")))
+
+
+def test_download_resumes_from_the_cache(tmp_path, interrupt):
+    cache_directory = str(tmp_path / "cache")
+    with pytest.raises(Interrupted):
+        _download(tmp_path / "out.csv", cache_directory)
+    with pagecache.PageCache(simulator.DEFAULT_SERIAL, cache_directory) as cache:
+        assert cache.num_records == (INTERRUPTED_PAGE - 1) * pygotu.RECORDS_PER_PAGE
+    interrupt()
+
+    sim = _download(tmp_path / "out.csv", cache_directory)
+    full = _download(tmp_path / "full.csv")
+    assert (tmp_path / "out.csv").read_bytes() == (tmp_path / "full.csv").read_bytes()
+    assert _pages_read(sim) == _pages_read(full) - (INTERRUPTED_PAGE - 1) + 1
+
+
+def test_cache_is_cleared_when_the_device_was_purged(tmp_path):
+    cache_directory = str(tmp_path / "cache")
+    _download(tmp_path / "out.csv", cache_directory)
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME, seed=1)
+    gt2gpx.download_track(sim, str(tmp_path / "other.csv"), cache_directory)
+    with pagecache.PageCache(simulator.DEFAULT_SERIAL, cache_directory) as cache:
+        assert cache.read_record(NUM_RECORDS - 1) == bytes(
+            sim.flash[pygotu.PAGE_SIZE + (NUM_RECORDS - 1) * pygotu.RECORD_SIZE:][:pygotu.RECORD_SIZE])
+
+
+def test_journal_is_synced_in_batches(tmp_path, monkeypatch):
+    syncs = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: syncs.append(fd) or fsync(fd))
+    path = str(tmp_path / "out.journal")
+    with journal.DownloadJournal(1, path) as download_journal:
+        syncs.clear()
+        for i in range(1, 2 * journal.SYNC_ENTRIES + 2):
+            download_journal.store_page(i, bytes(pygotu.PAGE_SIZE), i * pygotu.RECORDS_PER_PAGE)
+        assert len(syncs) == 2
+    assert len(syncs) == 3
+    with journal.DownloadJournal(1, path) as download_journal:
+        assert len(download_journal.pages) == 2 * journal.SYNC_ENTRIES + 1
@@ -0,0 +1,59 @@
+import numpy as np
+
+import pygotu
+import segment
+import simulator
+
+START_TIME = 1500000000
+
+
+def _records(num_records: int=100, track_length: int=0):
+    return simulator.synthesize_records(num_records, start_time=START_TIME, track_length=track_length)
+
+
+def _tracks(records: np.ndarray, **split_rules) -> list:
+    log = pygotu.page_records(0, records.tobytes(), valid_only=False)
+    return [[rec.idx for rec in track] for track in segment.stream_tracks(log, **split_rules)]
+
+
+def test_reset_counter_ends_the_track():
+    tracks = _tracks(_records(160, track_length=50))
+    assert [(track[0], len(track)) for track in tracks] == [(0, 50), (51, 50), (102, 50), (153, 7)]
+
+
+def test_gap_ends_the_track():
+    records = _records()
+    epoch_ms = START_TIME * 1000 + np.arange(100) * 1000
+    epoch_ms[40:] += 600000
+    records['ym'], records['dhm'], records['ms'] = simulator.encode_timestamps(epoch_ms)
+    assert [len(track) for track in _tracks(records, max_gap=60)] == [40, 60]
+    assert [len(track) for track in _tracks(records, max_gap=3600)] == [100]
+
+
+def test_jump_ends_the_track():
+    records = _records()
+    # About 11 km north
+    records['lat'][70:] += 1000000
+    assert [len(track) for track in _tracks(records, max_jump=1000)] == [70, 30]
+    assert [len(track) for track in _tracks(records, max_jump=20000)] == [100]
+
+
+def test_flags_end_the_track():
+    records = _records()
+    records['flag'][30] |= segment.FLAG_TSTOP
+    records['flag'][60] |= segment.FLAG_TSTART
+    # TSTOP waypoints are invalid, they are only dropped without split_on_flags
+    assert [len(track) for track in _tracks(records)] == [99]
+    assert [(track[0], len(track)) for track in _tracks(records, split_on_flags=True)] == [(0, 30), (31, 29), (60, 40)]
+
+
+def test_unread_points_are_skipped():
+    log = pygotu.page_records(0, _records(160, track_length=50).tobytes(), valid_only=False)
+    tracks = segment.stream_tracks(log)
+    first = next(tracks)
+    second = next(tracks)
+    assert first.first_point.idx == 0
+    assert second.first_point.idx == 51
+    assert first.complete
+    assert [rec.idx for rec in second][-1] == 100
+    assert second.num_points == 50
@@ -0,0 +1,76 @@
+import argparse
+
+import numpy as np
+import pytest
+
+import archive
+import gt2gpx
+import simplify
+
+
+def _zigzag(n: int, amplitude: float) -> tuple:
+    x = np.arange(n, dtype=float) * 10.0
+    y = np.where(np.arange(n) % 2, amplitude, 0.0)
+    return x, y
+
+
+@pytest.mark.parametrize("simplifier", [simplify.douglas_peucker, simplify.visvalingam])
+def test_straight_line_keeps_its_ends(simplifier):
+    x = np.arange(100, dtype=float)
+    keep = simplifier(x, 2 * x, 1.0)
+    assert np.flatnonzero(keep).tolist() == [0, 99]
+
+
+@pytest.mark.parametrize("simplifier", [simplify.douglas_peucker, simplify.visvalingam])
+def test_points_beyond_the_tolerance_are_kept(simplifier):
+    x, y = _zigzag(50, 100.0)
+    assert simplifier(x, y, 1.0).all()
+
+
+def test_douglas_peucker_keeps_the_corner():
+    x = np.array([0.0, 1.0, 2.0, 3.0, 3.0, 3.0, 3.0])
+    y = np.array([0.0, 0.0, 0.0, 0.0, 1.0, 2.0, 3.0])
+    assert np.flatnonzero(simplify.douglas_peucker(x, y, 0.1)).tolist() == [0, 3, 6]
+
+
+def test_resample_keeps_one_point_per_interval():
+    epoch_ms = np.arange(0, 10000, 250)
+    keep = simplify.resample(epoch_ms, 1.0)
+    assert epoch_ms[keep].tolist() == list(range(0, 10000, 1000)) + [9750]
+
+
+def test_resample_below_a_millisecond_keeps_every_point():
+    assert simplify.resample(np.array([0, 1, 2]), 0.0005).tolist() == [True, True, True]
+
+
+@pytest.mark.parametrize("interval", [0.0, -1.0])
+def test_non_positive_intervals_are_rejected(interval):
+    with pytest.raises(ValueError):
+        simplify.resample(np.array([0, 1, 2]), interval)
+    with pytest.raises(ValueError):
+        simplify.TrackSimplifier(interval=interval)
+    with pytest.raises(argparse.ArgumentTypeError):
+        gt2gpx.parse_positive(str(interval))
+
+
+def test_drop_jitter_keeps_the_ends_of_the_stop():
+    n = 10
+    x = np.random.RandomState(0).rand(n)
+    y = np.zeros(n)
+    speed = np.array([10.0] + [0.0] * (n - 2) + [10.0])
+    keep = simplify.drop_jitter(x, y, speed, np.full(n, 2.0))
+    assert np.flatnonzero(keep).tolist() == [0, 1, n - 2, n - 1]
+
+
+def test_simplifier_selects_the_points():
+    n = 200
+    epoch_ms = np.arange(n) * 1000
+    points = archive.PointSet.from_columns(
+        serial=np.zeros(n), track_id=np.zeros(n), epoch_ms=epoch_ms, lat=np.linspace(48.0, 48.1, n),
+        lon=np.full(n, 2.0), elevation=np.zeros(n), speed=np.full(n, 20.0), course=np.zeros(n),
+        ehpe=np.zeros(n), sat=np.full(n, 8))
+    simplifier = simplify.TrackSimplifier(interval=10.0)
+    simplified = simplifier.process(points)
+    assert simplified.epoch_ms.tolist() == list(range(0, n * 1000, 10000)) + [(n - 1) * 1000]
+    assert (simplifier.points_in, simplifier.points_out) == (n, len(simplified))
+    assert len(simplify.TrackSimplifier(tolerance=1.0).process(points)) == 2
@@ -0,0 +1,120 @@
+import json
+import sys
+from functools import partial
+
+import pytest
+
+import connections
+import gt2gpx
+import multidevice
+import pygotu
+import simulator
+import stats
+
+NUM_RECORDS = 3000
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(pygotu, "RETRY_BACKOFF", 0.0)
+
+
+def _device(**kwargs) -> simulator.SimulatedDevice:
+    return simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=1500000000, **kwargs)
+
+
+def _download(sim: simulator.SimulatedDevice) -> tuple:
+    sync_stats = stats.Stats()
+    with pygotu.open_device(sim, sync_stats) as dev:
+        assert len(list(dev.all_records())) == NUM_RECORDS
+    return dev, sync_stats
+
+
+def test_histogram_percentiles():
+    histogram = stats.Histogram()
+    for value in [0.05] * 90 + [3.0] * 9 + [5000.0]:
+        histogram.record(value)
+    assert histogram.percentile(0.5) == 0.0625
+    assert histogram.percentile(0.95) == 4.0
+    assert histogram.percentile(1.0) == 5000.0
+    assert histogram.to_dict()["buckets_ms"] == {"<=0.0625": 90, "<=4": 9, ">4096": 1}
+
+
+def test_session_commands_are_counted():
+    sim = _device()
+    dev, sync_stats = _download(sim)
+    commands = sync_stats.commands
+    # The commands opening the session included
+    assert commands["nmea_switch"].count == sim.commands[0x01] == 1
+    assert commands["identify"].count == sim.commands[0x0a] == 1
+    assert commands["model"].count == 1
+    assert commands["count"].count == sim.commands[0x0b]
+    assert commands["model"].count + commands["flash_read"].count == sim.commands[0x05]
+    assert commands["flash_read"].bytes_in == (-(-NUM_RECORDS // pygotu.RECORDS_PER_PAGE)) * (pygotu.PAGE_SIZE + 3)
+    assert sync_stats.bytes_out == sim.bytes_out == 16 * sum(sim.commands.values())
+    assert sync_stats.bytes_in == sim.bytes_in
+    assert sync_stats.timeouts == sync_stats.retries == 0
+
+
+def test_timeouts_and_retries_are_counted(no_backoff):
+    sim = _device(timeout_rate=0.1, error_rate=0.05, seed=4)
+    dev, sync_stats = _download(sim)
+    commands = sync_stats.commands.values()
+    assert sync_stats.timeouts > 0
+    assert sum(operation.errors for operation in commands) > sync_stats.timeouts
+    assert sync_stats.retries == dev.retries > 0
+    assert sync_stats.resyncs == dev.resyncs >= sync_stats.timeouts
+    assert sum(operation.count for operation in commands) == sum(sim.commands.values())
+    assert sync_stats.bytes_out == sim.bytes_out
+    assert sync_stats.bytes_in == sim.bytes_in
+
+
+def test_usb_transfers_are_counted():
+    sim = _device()
+    usb = simulator.SimulatedUSB(sim)
+    _, sync_stats = _download(connections.USBSerial(usb, usb))
+    transfers = sync_stats.transfers
+    assert sum(operation.bytes_out for operation in transfers.values()) == sim.bytes_out
+    # Commands are written in two halves
+    assert transfers["write"].count == 2 * sum(sim.commands.values())
+
+
+def test_json_shape():
+    _, sync_stats = _download(_device())
+    result = json.loads(sync_stats.to_json())
+    assert set(result) == {"elapsed_s", "bytes_out", "bytes_in", "timeouts", "retries", "resyncs",
+                           "framing_errors", "times_s", "commands", "transfers"}
+    assert set(result["commands"]) == {"nmea_switch", "identify", "model", "count", "flash_read"}
+    assert set(result["commands"]["flash_read"]) == {"count", "errors", "timeouts", "bytes_out", "bytes_in",
+                                                     "mean_ms", "p50_ms", "p95_ms", "max_ms", "buckets_ms"}
+
+
+def test_summary_shows_the_bytes_both_ways():
+    _, sync_stats = _download(_device())
+    lines = sync_stats.summary().splitlines()
+    header = next(line for line in lines if line.startswith("command"))
+    assert "bytes out" in header and "bytes in" in header
+    flash_read = sync_stats.commands["flash_read"]
+    row = next(line for line in lines if line.startswith("flash_read")).split()
+    assert row[4:6] == [str(flash_read.bytes_out), str(flash_read.bytes_in)]
+
+
+@pytest.mark.parametrize("stats_arguments", [["--stats"], ["--stats", "--stats-format", "json"]])
+def test_stats_option_before_the_action(tmp_path, monkeypatch, capsys, stats_arguments):
+    image = str(tmp_path / "flash.img")
+    gt2gpx.dump_flash(_device(), image)
+    monkeypatch.setattr(sys, "argv", ["gt2gpx", "--image", image] + stats_arguments + ["get", str(tmp_path / "out.gpx")])
+    gt2gpx.main()
+    out = capsys.readouterr().out
+    if "json" in stats_arguments:
+        assert set(json.loads(out)) == {"device"}
+    else:
+        assert out.startswith("device:\n")
+    assert (tmp_path / "out.gpx").exists()
+
+
+def test_device_sessions_are_counted():
+    device_connections = {"usb:{}".format(i): partial(_device, serial=0x1000 + i) for i in range(2)}
+    jobs = multidevice.SyncOrchestrator(device_connections, multidevice.count_records, collect_stats=True).run()
+    assert [job.stats.commands["identify"].count for job in jobs] == [1, 1]
+    assert [job.stats.commands["count"].count for job in jobs] == [1, 1]
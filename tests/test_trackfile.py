@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+import gt2gpx
+import gtbatch
+import pygotu
+import simulator
+import trackfile
+
+NUM_RECORDS = 3000
+START_TIME = 1500000000
+
+GPX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">\n'
+
+
+@pytest.fixture(scope="module")
+def waypoints() -> gtbatch.RecordBatch:
+    records = simulator.synthesize_records(NUM_RECORDS, start_time=START_TIME, track_length=500)
+    return gtbatch.decode_dump(records.tobytes()).waypoints()
+
+
+def _download(path) -> None:
+    sim = simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME, track_length=500)
+    gt2gpx.download_track(sim, str(path))
+
+
+def _assert_points_equal(points, waypoints, columns=trackfile.COLUMNS):
+    for name in columns:
+        assert np.allclose(getattr(points, name), getattr(waypoints, name), rtol=0, atol=1e-9), name
+
+
+@pytest.mark.parametrize("values", [[0], [1, 127, 128, 300, 16383, 16384], [2 ** 63 - 1, 0, 2 ** 40]])
+def test_varints_round_trip(values):
+    values = np.array(values, dtype=np.uint64)
+    assert trackfile.decode_varints(trackfile.encode_varints(values)).tolist() == values.tolist()
+
+
+def test_track_file_round_trip(tmp_path, waypoints):
+    path = tmp_path / "out.gtt"
+    _download(path)
+    with trackfile.TrackFile(str(path)) as track_file:
+        points = track_file.read()
+        assert track_file.num_points == len(waypoints)
+        assert track_file.num_tracks == len(np.unique(points.track_id)) > 1
+    _assert_points_equal(points, waypoints)
+
+
+def test_track_file_window(tmp_path, waypoints):
+    path = tmp_path / "out.gtt"
+    _download(path)
+    since = int(waypoints.epoch_ms[1000])
+    until = int(waypoints.epoch_ms[1999])
+    with trackfile.TrackFile(str(path)) as track_file:
+        points = track_file.read(pygotu.TimeWindow(since, until))
+    assert points.epoch_ms.tolist() == waypoints.epoch_ms[1000:2000].tolist()
+
+
+def test_gpx_round_trip(tmp_path, waypoints):
+    path = tmp_path / "out.gpx"
+    _download(path)
+    points = [track for track in trackfile.read_gpx(str(path))]
+    assert len(points) > 1
+    epoch_ms = np.concatenate([track.epoch_ms for track in points])
+    assert epoch_ms.tolist() == waypoints.epoch_ms.tolist()
+    lat = np.concatenate([track.lat for track in points])
+    assert np.allclose(lat, waypoints.lat, rtol=0, atol=1e-7)
+
+
+def test_gpx_conversion_to_track_file(tmp_path, waypoints):
+    _download(tmp_path / "out.gpx")
+    assert trackfile.convert(str(tmp_path / "out.gpx"), str(tmp_path / "out.gtt")) == len(waypoints)
+    with trackfile.TrackFile(str(tmp_path / "out.gtt")) as track_file:
+        assert track_file.read().epoch_ms.tolist() == waypoints.epoch_ms.tolist()
+
+
+def test_gpx_points_without_time_are_skipped(tmp_path, caplog):
+    path = tmp_path / "untimed.gpx"
+    path.write_text(GPX_HEADER + """
+<metadata><time>2020-01-01T00:00:00Z</time></metadata>
+<wpt lat="1.0" lon="1.0"><time>2020-01-01T00:00:00Z</time></wpt>
+<trk><trkseg>
+<trkpt lat="48.0" lon="2.0"><ele>35.5</ele><time>2020-01-01T10:00:00Z</time></trkpt>
+<trkpt lat="48.1" lon="2.1"><ele>36.0</ele></trkpt>
+<trkpt lat="48.2" lon="2.2"><time></time></trkpt>
+<trkpt lat="48.3" lon="2.3"><time>2020-01-01T12:00:00+02:00</time></trkpt>
+</trkseg></trk>
+</gpx>
+""")
+    tracks = list(trackfile.read_gpx(str(path)))
+    assert len(tracks) == 1
+    points = tracks[0]
+    assert points.lat.tolist() == [48.0, 48.3]
+    assert points.epoch_ms.tolist() == [1577872800000, 1577872800000]
+    # The missing numeric fields are 0
+    assert points.elevation.tolist() == [35.5, 0.0]
+    assert "Skipped 2 points without a time" in caplog.text
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import export
+import gt2gpx
+import gtbatch
+import pygotu
+import simplify
+import simulator
+import trackstats
+
+
+@pytest.fixture(scope="module")
+def records() -> list:
+    dev = pygotu.open_device(simulator.SimulatedDevice(num_records=3000))
+    return list(dev.all_records(valid_only=False))
+
+
+def _scalar(records) -> trackstats.TrackStats:
+    stats = trackstats.TrackStats()
+    return stats._add_waypoints(rec for rec in records if rec.valid and rec.is_waypoint)
+
+
+def test_records_are_added_as_columns(records):
+    columnar = pygotu.GTTrack(0, records).statistics()
+    expected = _scalar(records)
+    assert columnar.num_points == expected.num_points
+    assert columnar.distance == pytest.approx(expected.distance)
+    assert (columnar.first_ms, columnar.last_ms, columnar.moving_ms, columnar.sat_total) == \
+           (expected.first_ms, expected.last_ms, expected.moving_ms, expected.sat_total)
+    assert columnar.elevation_gain == pytest.approx(expected.elevation_gain)
+
+
+def test_records_without_page_buffer_are_added_one_by_one(records):
+    eager = [pygotu.GTRecord(rec.idx, bytes(rec.s)) for rec in records if rec.kind != "HB"]
+    assert gtbatch.decode_records(eager) is None
+    assert trackstats.TrackStats.of_records(eager).to_dict() == _scalar(records).to_dict()
+
+
+def test_writer_stats_match_the_track_stats(records, tmp_path):
+    with open(str(tmp_path / "out.gpx"), "w") as f:
+        writer = export.GPXWriter(f)
+        writer.collect_stats()
+        writer.write_tracks([pygotu.GTTrack(0, records)])
+    assert writer.track_stats[0][1].to_dict() == pygotu.GTTrack(0, records).statistics().to_dict()
+
+
+def test_stats_describe_the_track_before_its_simplification(tmp_path):
+    def download(name: str, simplifier=None) -> list:
+        sim = simulator.SimulatedDevice(num_records=3000, start_time=1500000000, track_length=700)
+        destination = str(tmp_path / name)
+        gt2gpx.download_track(sim, destination, simplifier=simplifier, track_stats=True)
+        with open(trackstats.stats_path(destination)) as f:
+            return json.load(f)["tracks"]
+
+    expected = download("full.gpx")
+    simplifier = simplify.TrackSimplifier(5.0, interval=10.0, jitter=True)
+    assert download("simplified.gpx", simplifier) == expected
+    assert simplifier.points_out < simplifier.points_in
@@ -0,0 +1,65 @@
+import pytest
+
+import pygotu
+import simulator
+
+NUM_RECORDS = 5000
+START_TIME = 1500000000
+START_MS = START_TIME * 1000
+LAST_PAGE = -(-NUM_RECORDS // pygotu.RECORDS_PER_PAGE)
+
+
+def _device() -> pygotu.GT200Dev:
+    return pygotu.open_device(simulator.SimulatedDevice(num_records=NUM_RECORDS, start_time=START_TIME))
+
+
+def _page_start_ms(page: int) -> int:
+    return START_MS + (page - 1) * pygotu.RECORDS_PER_PAGE * 1000
+
+
+@pytest.mark.parametrize("page", [1, 2, 17, LAST_PAGE - 1, LAST_PAGE])
+def test_find_page(page):
+    dev = _device()
+    assert dev.find_page(_page_start_ms(page), LAST_PAGE) == page
+    assert dev.find_page(_page_start_ms(page) - 1, LAST_PAGE) == max(1, page - 1)
+
+
+def test_find_page_out_of_the_log():
+    dev = _device()
+    assert dev.find_page(START_MS - 86400000, LAST_PAGE) == 1
+    assert dev.find_page(START_MS + NUM_RECORDS * 1000 + 86400000, LAST_PAGE) == LAST_PAGE
+
+
+def test_find_page_probes_log2_pages():
+    dev = _device()
+    dev.find_page(_page_start_ms(17), LAST_PAGE)
+    assert dev.dev.commands[0x05] <= LAST_PAGE.bit_length()
+
+
+@pytest.mark.parametrize("since, until", [
+    (1000, 2000),
+    (None, 300),
+    (4800, None),
+    (-100, NUM_RECORDS + 100),
+])
+def test_window_records_match_the_full_download(since, until):
+    window = pygotu.TimeWindow(None if since is None else START_MS + since * 1000,
+                               None if until is None else START_MS + until * 1000)
+    expected = [rec.idx for rec in window.filter(_device().all_records())]
+    dev = _device()
+    assert [rec.idx for rec in dev.all_records(window=window)] == expected
+    assert len(expected) > 0
+
+
+def test_window_reads_only_its_pages():
+    dev = _device()
+    window = pygotu.TimeWindow(START_MS + 1000000, START_MS + 1500000)
+    assert len(list(dev.all_records(window=window))) == 501
+    # The pages of the window, and the probes of the two binary searches
+    assert dev.dev.commands[0x05] <= 6 + 2 * LAST_PAGE.bit_length()
+
+
+def test_time_window_bounds():
+    window = pygotu.TimeWindow(1000, 2000)
+    assert [window.contains(ms) for ms in (None, 999, 1000, 2000, 2001)] == [False, False, True, True, False]
+    assert pygotu.TimeWindow().contains(0)
@@ -0,0 +1,500 @@
+import datetime
+import logging
+import time
+from itertools import islice
+from xml.etree import ElementTree
+from struct import calcsize, pack, unpack_from
+
+import numpy as np
+
+import archive
+import export
+import pygotu
+import trackstats
+
+log = logging.getLogger(__name__)
+
+TRACK_FILE_MAGIC = b"GTTF"
+TRACK_FILE_VERSION = 1
+
+# magic, version, creation time (epoch ms)
+HEADER_FORMAT = ">4sBQ"
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+# At the end of the file: offset of the chunk index, number of chunks, magic
+TRAILER_FORMAT = ">QI4s"
+TRAILER_SIZE = calcsize(TRAILER_FORMAT)
+
+# Each chunk holds up to CHUNK_POINTS points of a track, as varints: the column values
+# one column after the other, the DELTA_COLUMNS being the zigzag encoded differences
+# with the previous point of the chunk, the first one with 0. The columns are the
+# fixed-point device units, so the points read back are the ones downloaded.
+CHUNK_POINTS = 4096
+COLUMNS = archive.POINT_COLUMNS
+DELTA_COLUMNS = ('epoch_ms', 'lat', 'lon', 'elevation', 'speed', 'course')
+_DELTA = np.array([name in DELTA_COLUMNS for name in COLUMNS])
+
+# The chunk index locates the chunks by track, time and bounding box (fixed-point)
+INDEX_DTYPE = np.dtype([
+    ('offset', '>u8'), ('size', '>u4'), ('track', '>u4'), ('num_points', '>u4'),
+    ('first_ms', '>i8'), ('last_ms', '>i8'),
+    ('min_lat', '>i4'), ('max_lat', '>i4'), ('min_lon', '>i4'), ('max_lon', '>i4'),
+])
+
+def to_fixed(columns) -> np.ndarray:
+    """
+    Fixed-point device units of point columns, like a gtbatch.RecordBatch,
+    as an int64 array of a row per column of COLUMNS
+    """
+    fixed = np.empty((len(COLUMNS), len(columns.epoch_ms)), dtype=np.int64)
+    fixed[0] = columns.epoch_ms
+    fixed[1] = np.rint(columns.lat * 10000000.0)
+    fixed[2] = np.rint(columns.lon * 10000000.0)
+    fixed[3] = np.rint(columns.elevation * 100.0)
+    fixed[4] = np.rint(columns.speed / 3600.0 * 1000.0 * 100.0)
+    fixed[5] = np.rint(columns.course * 100.0)
+    fixed[6] = np.rint(columns.ehpe / 0x10 / 1e-2)
+    fixed[7] = columns.sat
+    return fixed
+
+
+def from_fixed(fixed: np.ndarray, track: np.ndarray) -> archive.PointSet:
+    """
+    Points of fixed-point columns, converted as gtbatch.RecordBatch does
+    """
+    return archive.PointSet.from_columns(
+        epoch_ms=fixed[0],
+        lat=fixed[1] / 10000000.0,
+        lon=fixed[2] / 10000000.0,
+        elevation=fixed[3] / 100.0,  # in m
+        speed=(fixed[4] / 100.0) / 1000.0 * 3600.0,  # km/h
+        course=fixed[5] / 100.0,  # degree
+        ehpe=fixed[6] * 1e-2 * 0x10,  # in m
+        sat=fixed[7],
+        serial=np.zeros(len(track), dtype=np.int64),
+        track_id=track)
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """
+    LEB128 encoding of unsigned integers, 7 bits per byte, all values at once
+    """
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest != 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max(initial=0))):
+        idx = np.flatnonzero(lengths > k)
+        byte = (values[idx] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= np.where(lengths[idx] > k + 1, np.uint64(0x80), np.uint64(0))
+        out[starts[idx] + k] = byte
+    return out.tobytes()
+
+
+def decode_varints(buf) -> np.ndarray:
+    data = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    values = (data[starts] & 0x7f).astype(np.uint64)
+    for k in range(1, int(lengths.max(initial=0))):
+        idx = np.flatnonzero(lengths > k)
+        values[idx] |= (data[starts[idx] + k] & 0x7f).astype(np.uint64) << np.uint64(7 * k)
+    return values
+
+
+def encode_chunk(fixed: np.ndarray) -> bytes:
+    values = fixed.copy()
+    values[_DELTA, 1:] = np.diff(fixed[_DELTA], axis=1)
+    deltas = values[_DELTA]
+    values[_DELTA] = (deltas << 1) ^ (deltas >> 63)
+    return encode_varints(values.view(np.uint64).ravel())
+
+
+def decode_chunk(buf, num_points: int) -> np.ndarray:
+    values = decode_varints(buf)
+    if len(values) != len(COLUMNS) * num_points:
+        raise Exception("Corrupted chunk: {} values for {} points".format(len(values), num_points))
+    values = values.reshape(len(COLUMNS), num_points)
+    fixed = values.view(np.int64)
+    zigzag = values[_DELTA]
+    fixed[_DELTA] = np.cumsum((zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64),
+                              axis=1)
+    return fixed
+
+
+class TrackFileWriter(export.TrackWriter):
+    """
+    Writes tracks to a compact track file, opened in binary mode. It has the interface
+    of the export writers: write_tracks(), write_batches(), write_batch_tracks()...
+    The points of the current track are encoded by chunks of CHUNK_POINTS.
+    """
+    __slots__ = ['offset', 'pending', 'pending_points', 'index']
+
+    extension = export.TRACK_FILE_EXTENSION
+
+    def __init__(self, f):
+        super().__init__(f)
+        self.offset = 0
+        # Fixed-point columns of the points of the current track not written yet
+        self.pending = []
+        self.pending_points = 0
+        self.index = []
+
+    def _write(self, data: bytes):
+        self.f.write(data)
+        self.offset += len(data)
+
+    def begin(self):
+        self._write(pack(HEADER_FORMAT, TRACK_FILE_MAGIC, TRACK_FILE_VERSION, int(time.time() * 1000)))
+
+    def end(self):
+        index = np.array(self.index, dtype=INDEX_DTYPE)
+        index_offset = self.offset
+        self._write(index.tobytes())
+        self._write(pack(TRAILER_FORMAT, index_offset, len(index), TRACK_FILE_MAGIC))
+
+    def begin_track(self, name: str):
+        self.track_points = 0
+        self._start_stats(name)
+
+    def end_track(self):
+        self._flush(True)
+        self.track_idx += 1
+
+    def _flush(self, end_of_track: bool):
+        if not self.pending_points:
+            return
+        fixed = np.concatenate(self.pending, axis=1)
+        full = self.pending_points if end_of_track else self.pending_points - self.pending_points % CHUNK_POINTS
+        for start in range(0, full, CHUNK_POINTS):
+            self._write_chunk(fixed[:, start:start + CHUNK_POINTS])
+        self.pending = [fixed[:, full:]] if full < self.pending_points else []
+        self.pending_points -= full
+
+    def _write_chunk(self, fixed: np.ndarray):
+        data = encode_chunk(fixed)
+        lat, lon = fixed[1], fixed[2]
+        self.index.append((self.offset, len(data), self.track_idx, fixed.shape[1], fixed[0].min(), fixed[0].max(),
+                           lat.min(), lat.max(), lon.min(), lon.max()))
+        self._write(data)
+
+    def write_fixed(self, fixed: np.ndarray):
+        """
+        Writes points of the current track, given as fixed-point columns (see to_fixed())
+        """
+        n = fixed.shape[1]
+        if n == 0:
+            return
+        self.pending.append(fixed)
+        self.pending_points += n
+        self.track_points += n
+        self.num_points += n
+        if self.pending_points >= CHUNK_POINTS:
+            self._flush(False)
+
+    def _write_waypoints(self, batch):
+        self._add_stats(batch)
+        if self.stats is None:
+            self.write_fixed(to_fixed(batch))
+        else:
+            with self.stats.timer("export"):
+                self.write_fixed(to_fixed(batch))
+
+    def write_records(self, records):
+        """
+        Writes the valid waypoints of an iterable of records to the current track
+        """
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, CHUNK_POINTS))
+            if not chunk:
+                return
+            if self.stats is None:
+                points = archive.PointSet.from_records(chunk)
+            else:
+                # Record fields are decoded when accessed
+                with self.stats.timer("decode"):
+                    points = archive.PointSet.from_records(chunk)
+            if len(points):
+                self._write_waypoints(points)
+
+
+class TrackPoint:
+    """
+    Point read from a track file, with the waypoint fields of pygotu.GTRecord
+    """
+    __slots__ = ('idx',) + COLUMNS
+
+    valid = True
+    kind = "WP"
+    is_waypoint = True
+
+    def __init__(self, idx: int, epoch_ms: int, lat: float, lon: float, elevation: float, speed: float,
+                 course: float, ehpe: float, sat: int):
+        self.idx = idx
+        self.epoch_ms = epoch_ms
+        self.lat = lat
+        self.lon = lon
+        self.elevation = elevation
+        self.speed = speed
+        self.course = course
+        self.ehpe = ehpe
+        self.sat = sat
+
+    @property
+    def datetime(self):
+        return pygotu.epoch_ms_to_datetime(self.epoch_ms)
+
+    @property
+    def localtime(self):
+        return self.datetime - pygotu.LOCAL_OFFSET
+
+    @property
+    def isotime(self):
+        return pygotu.format_isotime(self.epoch_ms)
+
+    def __str__(self):
+        return "{0.datetime:%Y/%m/%d %H:%M:%S} WP LATLON:({0.lat}, {0.lon}) ele:{0.elevation} speed:{0.speed} ehpe={0.ehpe}".format(self)
+
+
+class TrackFile:
+    """
+    Track file written by TrackFileWriter. Only the chunks holding the requested
+    time window, box or track are read and decoded.
+    """
+    __slots__ = ['path', 'f', 'created', 'index']
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, "rb")
+        magic, version, self.created = unpack_from(HEADER_FORMAT, self.f.read(HEADER_SIZE).ljust(HEADER_SIZE))
+        if magic != TRACK_FILE_MAGIC or version != TRACK_FILE_VERSION:
+            raise Exception("Not a track file: {}".format(path))
+        self.f.seek(-TRAILER_SIZE, 2)
+        index_offset, num_chunks, magic = unpack_from(TRAILER_FORMAT, self.f.read(TRAILER_SIZE))
+        if magic != TRACK_FILE_MAGIC:
+            raise Exception("Incomplete track file: {}".format(path))
+        self.f.seek(index_offset)
+        self.index = np.frombuffer(self.f.read(num_chunks * INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    @property
+    def num_points(self) -> int:
+        return int(self.index['num_points'].sum())
+
+    @property
+    def num_tracks(self) -> int:
+        return len(np.unique(self.index['track']))
+
+    def _chunks(self, window: pygotu.TimeWindow, bbox: tuple, track: int) -> np.ndarray:
+        selected = np.ones(len(self.index), dtype=bool)
+        if window is not None and window.since is not None:
+            selected &= self.index['last_ms'] >= window.since
+        if window is not None and window.until is not None:
+            selected &= self.index['first_ms'] <= window.until
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = (int(np.rint(v * 10000000.0)) for v in bbox)
+            selected &= ((self.index['min_lat'] <= max_lat) & (self.index['max_lat'] >= min_lat) &
+                         (self.index['min_lon'] <= max_lon) & (self.index['max_lon'] >= min_lon))
+        if track is not None:
+            selected &= self.index['track'] == track
+        return self.index[selected]
+
+    def _read(self, chunks: np.ndarray, window: pygotu.TimeWindow, bbox: tuple) -> archive.PointSet:
+        fixed = []
+        tracks = []
+        for chunk in chunks:
+            self.f.seek(int(chunk['offset']))
+            fixed.append(decode_chunk(self.f.read(int(chunk['size'])), int(chunk['num_points'])))
+            tracks.append(np.full(int(chunk['num_points']), chunk['track'], dtype=np.int64))
+        if not fixed:
+            return archive.PointSet()
+        points = from_fixed(np.concatenate(fixed, axis=1), np.concatenate(tracks))
+
+        # The chunks also hold points outside of the window and the box
+        mask = np.ones(len(points), dtype=bool) if window is None else window.mask(points.epoch_ms)
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            mask &= (points.lat >= min_lat) & (points.lat <= max_lat) & (points.lon >= min_lon) & (points.lon <= max_lon)
+        return points if mask.all() else points.select(mask)
+
+    def read(self, window: pygotu.TimeWindow=None, bbox: tuple=None, track: int=None) -> archive.PointSet:
+        """
+        Points of the file, all of them by default, or within a time window, a bounding
+        box (min lat, min lon, max lat, max lon) and of a track, as NumPy columns.
+        PointSet.track_id is the index of the track in the file.
+        """
+        return self._read(self._chunks(window, bbox, track), window, bbox)
+
+    def _chunk_records(self, window: pygotu.TimeWindow, bbox: tuple, track: int):
+        """
+        Yields the track index and the TrackPoint objects of each selected chunk
+        """
+        idx = 0
+        chunks = self._chunks(window, bbox, track)
+        for i in range(len(chunks)):
+            points = self._read(chunks[i:i + 1], window, bbox)
+            records = [TrackPoint(idx + j, *values)
+                       for j, values in enumerate(zip(*(getattr(points, name).tolist() for name in COLUMNS)))]
+            idx += len(records)
+            yield int(chunks[i]['track']), records
+
+    def records(self, window: pygotu.TimeWindow=None, bbox: tuple=None, track: int=None):
+        """
+        Yields the points as TrackPoint objects, decoded by chunks
+        """
+        for _, records in self._chunk_records(window, bbox, track):
+            yield from records
+
+    def tracks(self, window: pygotu.TimeWindow=None, bbox: tuple=None):
+        """
+        Yields the tracks as pygotu.GTTrack objects of TrackPoint, like GT200Dev.all_tracks()
+        """
+        track_idx = None
+        records = []
+        for chunk_track, chunk_records in self._chunk_records(window, bbox, None):
+            if chunk_track != track_idx and records:
+                yield pygotu.GTTrack(track_idx, records)
+                records = []
+            track_idx = chunk_track
+            records += chunk_records
+        if records:
+            yield pygotu.GTTrack(track_idx, records)
+
+    def __str__(self):
+        if not len(self.index):
+            return "{}: empty".format(self.path)
+        return "{}: {} tracks, {} points, {} chunks, {} - {}".format(
+            self.path, self.num_tracks, self.num_points, len(self.index),
+            pygotu.format_isotime(int(self.index['first_ms'].min())),
+            pygotu.format_isotime(int(self.index['last_ms'].max())))
+
+
+def _parse_time(value: str) -> int:
+    utc_time = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if utc_time.tzinfo is not None:
+        utc_time = utc_time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return pygotu.datetime_to_epoch_ms(utc_time)
+
+
+def _parse_times(values: list) -> np.ndarray:
+    """
+    Epoch ms of GPX times: UTC ones, like the ones written by export, are parsed at once
+    """
+    if all(value.endswith("Z") for value in values):
+        return np.array([value[:-1] for value in values], dtype='datetime64[ms]').astype(np.int64)
+    return np.array([_parse_time(value) for value in values], dtype=np.int64)
+
+
+# Numeric trkpt children read, pygotu extensions included, and local names of the tags by qualified name
+_GPX_FIELDS = ('ele', 'sat', 'speed', 'course', 'ehpe')
+_GPX_TAGS = {}
+# Elements whose time and fields are not the ones of the next trkpt
+_GPX_OTHER_POINTS = ('metadata', 'wpt', 'rtept')
+
+
+def _gpx_points(columns: dict, track_idx: int) -> archive.PointSet:
+    n = len(columns['lat'])
+    return archive.PointSet.from_columns(
+        epoch_ms=_parse_times(columns['time']),
+        lat=np.array(columns['lat'], dtype=np.float64),
+        lon=np.array(columns['lon'], dtype=np.float64),
+        elevation=np.array(columns['ele'], dtype=np.float64),
+        speed=np.array(columns['speed'], dtype=np.float64),
+        course=np.array(columns['course'], dtype=np.float64),
+        ehpe=np.array(columns['ehpe'], dtype=np.float64),
+        sat=np.array(columns['sat'], dtype=np.float64),
+        serial=np.zeros(n, dtype=np.int64),
+        track_id=np.full(n, track_idx, dtype=np.int64))
+
+
+def read_gpx(path: str):
+    """
+    Yields the points of each track of a GPX file, as an archive.PointSet. The numeric
+    fields missing from a point, like the pygotu extensions of other loggers, are 0.
+    The points without a time are skipped.
+    """
+    track_idx = 0
+    columns = {name: [] for name in _GPX_FIELDS + ('time', 'lat', 'lon')}
+    point = dict.fromkeys(_GPX_FIELDS, "0")
+    point_time = None
+    untimed = 0
+    # The elements end before their parent, so the point fields are known when the trkpt ends
+    for _, elem in ElementTree.iterparse(path):
+        tag = _GPX_TAGS.get(elem.tag)
+        if tag is None:
+            tag = _GPX_TAGS[elem.tag] = elem.tag.rpartition("}")[2]
+        if tag in point:
+            point[tag] = elem.text or "0"
+        elif tag == "time":
+            point_time = elem.text.strip() if elem.text else None
+        elif tag in _GPX_OTHER_POINTS:
+            # Fields of the metadata or of a point out of the tracks
+            point = dict.fromkeys(_GPX_FIELDS, "0")
+            point_time = None
+        elif tag == "trkpt":
+            if point_time:
+                columns['lat'].append(elem.get("lat"))
+                columns['lon'].append(elem.get("lon"))
+                columns['time'].append(point_time)
+                for name, value in point.items():
+                    columns[name].append(value)
+            else:
+                untimed += 1
+            point = dict.fromkeys(_GPX_FIELDS, "0")
+            point_time = None
+            elem.clear()
+        elif tag == "trk":
+            if columns['lat']:
+                yield _gpx_points(columns, track_idx)
+                track_idx += 1
+            columns = {name: [] for name in columns}
+            elem.clear()
+    if untimed:
+        log.warning("Skipped %s points without a time in %s", untimed, path)
+
+
+def convert(source: str, destination: str, export_format: str=None, window: pygotu.TimeWindow=None,
+            simplifier=None, track_stats: bool=False) -> int:
+    """
+    Converts a track file or a GPX file to any export format, track files included, the
+    tracks going through simplifier (a simplify.TrackSimplifier) when given. With
+    track_stats, the statistics of the tracks, before their simplification, are saved to a
+    sidecar JSON file.
+    Returns the number of points written.
+    """
+    with open(source, "rb") as f:
+        is_track_file = f.read(len(TRACK_FILE_MAGIC)) == TRACK_FILE_MAGIC
+    if is_track_file:
+        with TrackFile(source) as track_file:
+            points = track_file.read(window)
+        tracks = points.tracks() if len(points) else ()
+    else:
+        tracks = read_gpx(source)
+        if window is not None:
+            tracks = (points.select(window.mask(points.epoch_ms)) for points in tracks)
+    if simplifier is not None:
+        tracks = simplifier.process_batches(tracks)
+
+    export_format = export.format_for(destination, export_format)
+    with open(destination, "wb" if export.is_binary(export_format) else "w") as f:
+        writer = export.writer_for(f, destination, export_format)
+        if track_stats:
+            (writer if simplifier is None else simplifier).collect_stats()
+        writer.write_batch_tracks(tracks)
+    log.info("Converted %s points in %s tracks to %s", writer.num_points, writer.track_idx, destination)
+    if track_stats:
+        trackstats.save_stats(destination, (writer if simplifier is None else simplifier).track_stats)
+    return writer.num_points
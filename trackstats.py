@@ -0,0 +1,242 @@
+import json
+import logging
+
+import numpy as np
+
+import gtbatch
+import segment
+
+log = logging.getLogger(__name__)
+
+# Intervals ending at a point at least this fast, in km/h, count as moving time
+MOVING_SPEED = 1.0
+
+STATS_EXTENSION = ".stats.json"
+
+
+def haversine(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """
+    Great circle distances between the points of two arrays, in m, see segment.haversine()
+    """
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    a = (np.sin((phi2 - phi1) / 2) ** 2 +
+         np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * segment.EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def stats_path(destination_file: str) -> str:
+    """
+    Sidecar JSON file of the track statistics of an exported file
+    """
+    return destination_file + STATS_EXTENSION
+
+
+class TrackStats:
+    """
+    Statistics of a track, accumulated over chunks of its points given as columns,
+    like a gtbatch.RecordBatch of waypoints or an archive.PointSet: the chunks are
+    processed with array operations, only the last point being kept between them.
+    Records held in page buffers are decoded as columns too, other ones are accumulated
+    one by one. Distances are in m, durations in s and speeds in km/h.
+    """
+    __slots__ = ['num_points', 'first_ms', 'last_ms', 'distance', 'moving_ms', 'max_speed',
+                 'elevation_gain', 'elevation_loss', 'sat_total', 'last_lat', 'last_lon', 'last_elevation']
+
+    def __init__(self):
+        self.num_points = 0
+        self.first_ms = None
+        self.last_ms = None
+        self.distance = 0.0
+        self.moving_ms = 0
+        self.max_speed = 0.0
+        self.elevation_gain = 0.0
+        self.elevation_loss = 0.0
+        self.sat_total = 0
+        self.last_lat = None
+        self.last_lon = None
+        self.last_elevation = None
+
+    @classmethod
+    def of_points(cls, points) -> 'TrackStats':
+        stats = cls()
+        stats.add(points)
+        return stats
+
+    @classmethod
+    def of_records(cls, records) -> 'TrackStats':
+        stats = cls()
+        stats.add_records(records)
+        return stats
+
+    def add(self, points) -> 'TrackStats':
+        """
+        Adds the next points of the track, as columns
+        """
+        n = len(points.epoch_ms)
+        if n == 0:
+            return self
+        epoch_ms = points.epoch_ms
+        lat = points.lat
+        lon = points.lon
+        elevation = points.elevation
+        # Intervals end at the points of the chunk, starting at the previous one
+        speed = points.speed
+        if self.num_points:
+            epoch_ms = np.concatenate(([self.last_ms], epoch_ms))
+            lat = np.concatenate(([self.last_lat], lat))
+            lon = np.concatenate(([self.last_lon], lon))
+            elevation = np.concatenate(([self.last_elevation], elevation))
+        else:
+            self.first_ms = int(epoch_ms[0])
+            speed = speed[1:]
+
+        if len(epoch_ms) > 1:
+            self.distance += float(haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]).sum())
+            self.moving_ms += int(np.diff(epoch_ms)[speed >= MOVING_SPEED].sum())
+            climb = np.diff(elevation)
+            self.elevation_gain += float(climb[climb > 0].sum())
+            self.elevation_loss -= float(climb[climb < 0].sum())
+        self.max_speed = max(self.max_speed, float(points.speed.max()))
+        self.sat_total += int(points.sat.sum())
+        self.num_points += n
+        self.last_ms = int(epoch_ms[-1])
+        self.last_lat = float(lat[-1])
+        self.last_lon = float(lon[-1])
+        self.last_elevation = float(elevation[-1])
+        return self
+
+    def add_records(self, records) -> 'TrackStats':
+        """
+        Adds the valid waypoints of an iterable of records. Records held in page buffers,
+        like pygotu.LazyGTRecord, are added as columns, see gtbatch.decode_records().
+        """
+        records = list(records)
+        batch = gtbatch.decode_records(records)
+        if batch is not None:
+            return self.add(batch.waypoints())
+        return self._add_waypoints(rec for rec in records if rec.valid and rec.is_waypoint)
+
+    def add_waypoints(self, points) -> 'TrackStats':
+        """
+        Adds the next points of the track, as waypoint records, converted to columns
+        when they are held in page buffers
+        """
+        points = list(points)
+        batch = gtbatch.decode_records(points)
+        if batch is not None:
+            return self.add(batch)
+        return self._add_waypoints(points)
+
+    def _add_waypoints(self, points) -> 'TrackStats':
+        points = iter(points)
+        if not self.num_points:
+            first = next(points, None)
+            if first is None:
+                return self
+            self.first_ms = self.last_ms = first.epoch_ms
+            self.last_lat = first.lat
+            self.last_lon = first.lon
+            self.last_elevation = first.elevation
+            self.max_speed = max(self.max_speed, first.speed)
+            self.sat_total += first.sat
+            self.num_points = 1
+
+        haversine = segment.haversine
+        last_ms = self.last_ms
+        last_lat = self.last_lat
+        last_lon = self.last_lon
+        last_elevation = self.last_elevation
+        distance = moving_ms = gain = loss = 0.0
+        max_speed = self.max_speed
+        sat_total = 0
+        n = 0
+        for rec in points:
+            epoch_ms = rec.epoch_ms
+            lat = rec.lat
+            lon = rec.lon
+            elevation = rec.elevation
+            speed = rec.speed
+            distance += haversine(last_lat, last_lon, lat, lon)
+            if speed >= MOVING_SPEED:
+                moving_ms += epoch_ms - last_ms
+            if elevation > last_elevation:
+                gain += elevation - last_elevation
+            else:
+                loss += last_elevation - elevation
+            if speed > max_speed:
+                max_speed = speed
+            sat_total += rec.sat
+            n += 1
+            last_ms = epoch_ms
+            last_lat = lat
+            last_lon = lon
+            last_elevation = elevation
+
+        self.distance += distance
+        self.moving_ms += int(moving_ms)
+        self.elevation_gain += gain
+        self.elevation_loss += loss
+        self.max_speed = max_speed
+        self.sat_total += sat_total
+        self.num_points += n
+        self.last_ms = last_ms
+        self.last_lat = last_lat
+        self.last_lon = last_lon
+        self.last_elevation = last_elevation
+        return self
+
+    @property
+    def duration(self) -> float:
+        return 0.0 if self.first_ms is None else (self.last_ms - self.first_ms) / 1000.0
+
+    @property
+    def moving_time(self) -> float:
+        return self.moving_ms / 1000.0
+
+    @property
+    def avg_moving_speed(self) -> float:
+        return self.distance / self.moving_time * 3.6 if self.moving_ms else 0.0
+
+    @property
+    def avg_sat(self) -> float:
+        return self.sat_total / self.num_points if self.num_points else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "points": self.num_points,
+            "start_ms": self.first_ms,
+            "end_ms": self.last_ms,
+            "duration_s": self.duration,
+            "distance_m": round(self.distance, 1),
+            "moving_time_s": self.moving_time,
+            "avg_moving_speed_kmh": round(self.avg_moving_speed, 2),
+            "max_speed_kmh": round(self.max_speed, 2),
+            "elevation_gain_m": round(self.elevation_gain, 2),
+            "elevation_loss_m": round(self.elevation_loss, 2),
+            "avg_sat": round(self.avg_sat, 2),
+        }
+
+    def __str__(self):
+        return "{0.num_points} points, {1:.3f} km, moving {0.moving_time:.0f} s of {0.duration:.0f} s, " \
+               "max {0.max_speed:.1f} km/h, +{0.elevation_gain:.0f} m -{0.elevation_loss:.0f} m, " \
+               "{0.avg_sat:.1f} satellites".format(self, self.distance / 1000.0)
+
+
+def write_stats(path: str, track_stats: list):
+    """
+    Writes the statistics of tracks, given as (name, TrackStats) pairs, to a JSON file
+    """
+    with open(path, "w") as f:
+        json.dump({"tracks": [dict(name=name, **stats.to_dict()) for name, stats in track_stats]}, f, indent=2)
+
+
+def save_stats(destination_file: str, track_stats: list) -> str:
+    """
+    Writes the statistics of the tracks exported to destination_file to its sidecar file
+    """
+    path = stats_path(destination_file)
+    write_stats(path, track_stats)
+    for name, stats in track_stats:
+        log.info("%s: %s", name, stats)
+    return path